@@ -0,0 +1,140 @@
+# compares peak RSS of the streaming ingestion pipeline with loading a whole upload at once
+# usage (from backend/): python -m benchmarks.bench_ingestion_memory [--sizes 2 8 32] [--dimensions 256]
+# each run is its own process so peak RSS is not shared; embeddings are fake, no OpenAI calls are made
+import os
+import sys
+import json
+import zlib
+import time
+import shutil
+import random
+import argparse
+import resource
+import tempfile
+import subprocess
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+WORDS = ("document analiza model retea vector text pagina capitol rezultat metoda sistem date "
+         "learning network layer gradient summary question answer context index search").split()
+
+
+class FakeEmbeddings(Embeddings):
+    """Deterministic vectors derived from a hash of the text."""
+
+    def __init__(self, dimensions: int):
+        self.dimensions = dimensions
+
+    def _embed(self, text: str) -> list:
+        rng = np.random.default_rng(zlib.crc32(text.encode("utf-8")))
+        vector = rng.normal(size=self.dimensions).astype(np.float32)
+        return (vector / np.linalg.norm(vector)).tolist()
+
+    def embed_documents(self, texts: list) -> list:
+        return [self._embed(text) for text in texts]
+
+    def embed_query(self, text: str) -> list:
+        return self._embed(text)
+
+
+def peak_rss_mb() -> float:
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def make_text_file(path: str, size_mb: int, seed: int = 0):
+    rnd = random.Random(seed)
+    target = size_mb * 1024 * 1024
+    written = 0
+    with open(path, "w", encoding="utf-8") as f:
+        while written < target:
+            paragraph = " ".join(rnd.choice(WORDS) for _ in range(rnd.randint(40, 160))) + ".\n\n"
+            f.write(paragraph)
+            written += len(paragraph)
+
+
+def run_mode(mode: str, path: str, dimensions: int) -> dict:
+    import nlp.embeddings as embeddings_module
+    embeddings_module._embeddings = FakeEmbeddings(dimensions)
+
+    from documents.utils import load_pages, save_in_vectorstore
+    from langchain_text_splitters import RecursiveCharacterTextSplitter
+    from langchain_chroma import Chroma
+    from langchain.schema import Document
+
+    rss_before = peak_rss_mb()
+    start = time.perf_counter()
+    if mode == "streaming":
+        # Document.content is spooled like in run_ingestion
+        with tempfile.TemporaryFile("w+", encoding="utf-8") as text_spool:
+            def tracked(pages):
+                for i, page in enumerate(pages):
+                    if i:
+                        text_spool.write("\n")
+                    text_spool.write(page.page_content)
+                    yield page
+
+            save_in_vectorstore(tracked(load_pages(path, "text/plain")), file_id=1, user_id=1)
+            text_spool.seek(0)
+            content = text_spool.read()
+    else:
+        # the intake before streaming: whole file in memory, every chunk embedded in one call
+        with open(path, "rb") as f:
+            data = f.read()
+        documents = [Document(page_content=data.decode("utf-8"), metadata={"source": path})]
+        splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=200)
+        docs = splitter.split_documents(documents)
+        for idx, doc in enumerate(docs):
+            doc.metadata.update(file_id=1, user_id=1, chunk_id=idx)
+        Chroma.from_documents(
+            documents=docs, embedding=embeddings_module._embeddings,
+            persist_directory=os.path.abspath("vectorstore/1/1")
+        )
+        content = "\n".join(doc.page_content for doc in documents)
+
+    return {
+        "mode": mode,
+        "file_mb": round(os.path.getsize(path) / (1024 * 1024), 1),
+        "seconds": round(time.perf_counter() - start, 1),
+        "content_mb": round(len(content) / (1024 * 1024), 1),
+        "peak_rss_mb": round(peak_rss_mb(), 1),
+        "peak_rss_delta_mb": round(peak_rss_mb() - rss_before, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Peak RSS of document ingestion by file size.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[2, 8], help="text file sizes in MB")
+    parser.add_argument("--dimensions", type=int, default=256)
+    parser.add_argument("--worker", default=None, help=argparse.SUPPRESS)
+    parser.add_argument("--path", default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        print(json.dumps(run_mode(args.worker, args.path, args.dimensions)))
+        return
+
+    backend_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    print(f"{'mode':<12}{'file MB':>10}{'seconds':>10}{'text MB':>10}{'peak MB':>10}{'peak +MB':>10}")
+    for size in args.sizes:
+        for mode in ("eager", "streaming"):
+            work_dir = tempfile.mkdtemp(prefix="bench_ingestion_")
+            try:
+                path = os.path.join(work_dir, "upload.txt")
+                make_text_file(path, size)
+                output = subprocess.run(
+                    [sys.executable, "-m", "benchmarks.bench_ingestion_memory", "--worker", mode,
+                     "--path", path, "--dimensions", str(args.dimensions)],
+                    capture_output=True, text=True, check=True, cwd=work_dir,
+                    env={**os.environ, "PYTHONPATH": backend_dir,
+                         "CHUNK_EMBEDDING_STORE_PATH": os.path.join(work_dir, "chunks.sqlite")},
+                ).stdout
+                r = json.loads(output.strip().splitlines()[-1])
+                print(f"{r['mode']:<12}{r['file_mb']:>10}{r['seconds']:>10}{r['content_mb']:>10}"
+                      f"{r['peak_rss_mb']:>10}{r['peak_rss_delta_mb']:>10}")
+            finally:
+                shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+# compares conversation memory hit ratio and latency of the in-process and sqlite shared state
+# backends with 1, 4 and 8 worker processes, each request landing on a random worker like behind uvicorn
+# usage (from backend/): python -m benchmarks.bench_shared_state [--workers 1 4 8] [--requests 2000]
+# no database or OpenAI calls: a miss stands for a rehydration from the messages table
+import os
+import sys
+import time
+import random
+import shutil
+import argparse
+import tempfile
+import multiprocessing
+from cryptography.fernet import Fernet
+
+WINDOW = 5
+
+
+def worker(backend: str, path: str, conversations: int, requests: int, seed: int, start_event, results):
+    from conversations.utils import MessageEncryptor
+    from nlp.shared_state import make_list_store, SqliteListStore
+
+    if backend == "sqlite":
+        store = SqliteListStore("bench_memories", conversations, 3600, path=path, encryptor=MessageEncryptor())
+        appends = SqliteListStore("bench_appends", conversations, 3600, path=path)
+    else:
+        store = make_list_store("bench_memories", conversations, 3600, backend="memory")
+        appends = None
+
+    rnd = random.Random(seed)
+    hits = 0
+    latencies = []
+    start_event.wait()
+    started = time.perf_counter()
+    for i in range(requests):
+        key = str(rnd.randrange(conversations))
+        t = time.perf_counter()
+        # one question: read the memory, rehydrate it on a miss, append the exchange
+        items = store.get(key)
+        if items is None:
+            store.create(key, [{"type": "human", "content": "earlier question"},
+                               {"type": "ai", "content": "earlier answer " * 40}])
+        else:
+            hits += 1
+        store.append(key, [{"type": "human", "content": f"question {i}"},
+                           {"type": "ai", "content": "answer " * 80}], max_len=2 * WINDOW)
+        latencies.append(time.perf_counter() - t)
+        if appends is not None:
+            appends.append(key, [seed])
+    results.put((hits, time.perf_counter() - started, latencies))
+
+
+def run(backend: str, workers: int, conversations: int, requests: int) -> dict:
+    work_dir = tempfile.mkdtemp(prefix="bench_shared_state_")
+    path = os.path.join(work_dir, "state.sqlite")
+    ctx = multiprocessing.get_context("spawn")
+    start_event = ctx.Event()
+    results = ctx.Queue()
+    per_worker = requests // workers
+    try:
+        processes = [
+            ctx.Process(target=worker, args=(backend, path, conversations, per_worker, seed, start_event, results))
+            for seed in range(workers)
+        ]
+        for process in processes:
+            process.start()
+        time.sleep(1.0)  # let every worker import and open its store
+        start_event.set()
+        outcomes = [results.get() for _ in processes]
+        for process in processes:
+            process.join()
+
+        latencies = sorted(latency for _, _, worker_latencies in outcomes for latency in worker_latencies)
+        total = per_worker * workers
+        appended = None
+        if backend == "sqlite":
+            # every worker's appends must all be there, none lost to a concurrent writer
+            from nlp.shared_state import SqliteListStore
+            appends = SqliteListStore("bench_appends", conversations, 3600, path=path)
+            appended = sum(len(appends.get(key) or []) for key in appends.keys())
+        return {
+            "backend": backend,
+            "workers": workers,
+            "requests": total,
+            "hit_ratio": round(sum(hits for hits, _, _ in outcomes) / total, 3),
+            "req_per_s": round(total / max(seconds for _, seconds, _ in outcomes), 1),
+            "p50_ms": round(latencies[len(latencies) // 2] * 1000, 2),
+            "p95_ms": round(latencies[int(len(latencies) * 0.95)] * 1000, 2),
+            "appends_kept": f"{appended}/{total}" if appended is not None else "-",
+        }
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Conversation memory hit ratio and latency by shared state backend.")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 4, 8])
+    parser.add_argument("--conversations", type=int, default=200)
+    parser.add_argument("--requests", type=int, default=2000, help="total requests of a run")
+    args = parser.parse_args()
+
+    # every worker must decrypt what the others wrote
+    os.environ.setdefault("MESSAGE_ENCRYPTION_KEY", Fernet.generate_key().decode())
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+    print(f"{'backend':<10}{'workers':>8}{'requests':>10}{'hit ratio':>11}{'req/s':>10}"
+          f"{'p50 ms':>9}{'p95 ms':>9}{'appends kept':>15}")
+    for workers in args.workers:
+        for backend in ("memory", "sqlite"):
+            r = run(backend, workers, args.conversations, args.requests)
+            print(f"{r['backend']:<10}{r['workers']:>8}{r['requests']:>10}{r['hit_ratio']:>11}{r['req_per_s']:>10}"
+                  f"{r['p50_ms']:>9}{r['p95_ms']:>9}{r['appends_kept']:>15}")
+
+
+if __name__ == "__main__":
+    main()
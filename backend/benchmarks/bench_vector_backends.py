@@ -0,0 +1,118 @@
+# compares query latency and RSS of the chroma and numpy (memory-mapped) vectorstore backends
+# usage (from backend/): python -m benchmarks.bench_vector_backends [--chunks 3000] [--queries 200]
+# each backend runs in its own process so RSS numbers don't mix; no OpenAI calls are made
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+import numpy as np
+
+DIMENSIONS = 1536  # text-embedding-3-small
+
+
+def rss_mb() -> float:
+    """Current resident set size of this process, from /proc (Linux)."""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except FileNotFoundError:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    return 0.0
+
+
+def make_data(chunks: int, queries: int, seed: int = 0):
+    rng = np.random.default_rng(seed)
+    vectors = rng.normal(size=(chunks, DIMENSIONS)).astype(np.float32)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    query_vectors = rng.normal(size=(queries, DIMENSIONS)).astype(np.float32)
+    query_vectors /= np.linalg.norm(query_vectors, axis=1, keepdims=True)
+    return vectors, query_vectors
+
+
+def run_backend(backend: str, chunks: int, queries: int, k: int, dtype: str) -> dict:
+    from nlp.dense_index import DenseVectorStore
+    from langchain_chroma import Chroma
+
+    vectors, query_vectors = make_data(chunks, queries)
+    ids = [str(i) for i in range(chunks)]
+    texts = [f"chunk {i}" for i in range(chunks)]
+    metadatas = [{"chunk_id": i, "file_id": 1} for i in range(chunks)]
+    persist_dir = tempfile.mkdtemp(prefix=f"bench_{backend}_")
+
+    try:
+        if backend == "numpy":
+            DenseVectorStore.write(persist_dir, ids, texts, vectors, metadatas, dtype=dtype)
+        else:
+            store = Chroma(persist_directory=persist_dir)
+            for start in range(0, chunks, 1000):
+                store._collection.add(
+                    ids=ids[start:start + 1000],
+                    embeddings=vectors[start:start + 1000],
+                    documents=texts[start:start + 1000],
+                    metadatas=metadatas[start:start + 1000],
+                )
+            del store
+
+        rss_before = rss_mb()
+        start = time.perf_counter()
+        if backend == "numpy":
+            store = DenseVectorStore(persist_dir)
+        else:
+            store = Chroma(persist_directory=persist_dir)
+        open_ms = (time.perf_counter() - start) * 1000
+
+        latencies = []
+        for query in query_vectors:
+            start = time.perf_counter()
+            store.similarity_search_by_vector_with_relevance_scores(query.tolist(), k=k)
+            latencies.append((time.perf_counter() - start) * 1000)
+
+        latencies = np.array(latencies)
+        return {
+            "backend": backend if backend != "numpy" else f"numpy-{dtype}",
+            "chunks": chunks,
+            "open_ms": round(open_ms, 2),
+            "p50_ms": round(float(np.percentile(latencies, 50)), 3),
+            "p95_ms": round(float(np.percentile(latencies, 95)), 3),
+            "mean_ms": round(float(latencies.mean()), 3),
+            "rss_delta_mb": round(rss_mb() - rss_before, 1),
+            "rss_mb": round(rss_mb(), 1),
+        }
+    finally:
+        shutil.rmtree(persist_dir, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare chroma and numpy vectorstore backends.")
+    parser.add_argument("--chunks", type=int, default=3000)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=20)
+    parser.add_argument("--worker", default=None, help=argparse.SUPPRESS)
+    parser.add_argument("--dtype", default="float32", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        print(json.dumps(run_backend(args.worker, args.chunks, args.queries, args.k, args.dtype)))
+        return
+
+    print(f"{'backend':<16}{'chunks':>8}{'open ms':>10}{'p50 ms':>10}{'p95 ms':>10}{'rss +MB':>10}{'rss MB':>10}")
+    for backend, dtype in [("chroma", "float32"), ("numpy", "float32"), ("numpy", "float16")]:
+        output = subprocess.run(
+            [sys.executable, "-m", "benchmarks.bench_vector_backends", "--worker", backend, "--dtype", dtype,
+             "--chunks", str(args.chunks), "--queries", str(args.queries), "--k", str(args.k)],
+            capture_output=True, text=True, check=True,
+        ).stdout
+        r = json.loads(output.strip().splitlines()[-1])
+        print(f"{r['backend']:<16}{r['chunks']:>8}{r['open_ms']:>10}{r['p50_ms']:>10}{r['p95_ms']:>10}"
+              f"{r['rss_delta_mb']:>10}{r['rss_mb']:>10}")
+
+
+if __name__ == "__main__":
+    main()
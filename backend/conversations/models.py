@@ -16,6 +16,8 @@ class Conversation(Base):
     user = relationship("User", back_populates="conversations")
     document = relationship("Document", back_populates="conversations")
     messages = relationship("Message", back_populates="conversation", cascade="all, delete-orphan")
+    history_summary = relationship("ConversationSummary", back_populates="conversation", uselist=False,
+                                   cascade="all, delete-orphan")
 
 class Message(Base):
     __tablename__="messages"
@@ -38,4 +40,28 @@ class Message(Base):
     @content.setter
     def content(self, value: str):
         """Encrypt the content when set."""
-        self.encrypted_content = self._encryptor.encrypt_message(value)
\ No newline at end of file
+        self.encrypted_content = self._encryptor.encrypt_message(value)
+
+class ConversationSummary(Base):
+    """Running summary of the turns of a conversation older than its memory window.
+
+    Updated incrementally, covered_message_id is the last message folded into it.
+    Encrypted like the messages it summarizes.
+    """
+    __tablename__="conversation_summaries"
+
+    id = Column(Integer, primary_key=True, index=True)
+    conversation_id = Column(Integer, ForeignKey("conversations.id"), unique=True, index=True)
+    encrypted_summary = Column(String)
+    covered_message_id = Column(Integer, nullable=False)
+    updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
+
+    conversation = relationship("Conversation", back_populates="history_summary")
+
+    @property
+    def summary(self) -> str:
+        return Message._encryptor.decrypt_message(self.encrypted_summary)
+
+    @summary.setter
+    def summary(self, value: str):
+        self.encrypted_summary = Message._encryptor.encrypt_message(value)
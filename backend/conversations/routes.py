@@ -1,10 +1,12 @@
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, HTTPException, BackgroundTasks
 from sqlalchemy.orm import Session
 from typing import List
 from database.db import SessionLocal
 from auth.security import get_current_user
 from conversations import schemas, models
 from auth.models import User
+from nlp.conversation_memory import conversation_memories
+from nlp.history import acompact_history
 
 router = APIRouter(prefix="/conversations", tags=["Conversations"])
 
@@ -59,6 +61,7 @@ async def get_conversation(
 async def add_message(
     conversation_id: int,
     message: schemas.MessageCreate,
+    background_tasks: BackgroundTasks,
     current_user: User = Depends(get_current_user),
     db: Session = Depends(get_db)
 ):
@@ -78,6 +81,9 @@ async def add_message(
     db.add(db_message)
     db.commit()
     db.refresh(db_message)
+    if message.role == "assistant":
+        # turns pushed out of the memory window are folded into the conversation's summary
+        background_tasks.add_task(acompact_history, conversation_id)
     return db_message
 
 @router.get("/{conversation_id}/messages", response_model=List[schemas.MessageResponse])
@@ -115,6 +121,7 @@ async def delete_conversation(
     
     db.delete(conversation)
     db.commit()
+    conversation_memories.invalidate(conversation_id)
     return conversation
 
 @router.patch("/{conversation_id}", response_model=schemas.ConversationResponse)
@@ -1,8 +1,9 @@
 # fisier temporar
 from database.db import Base, engine
 from auth.models import User
-from documents.models import Document, DocumentSummary
-from conversations.models import Conversation, Message
+from documents.models import Document, DocumentSummary, DocumentIngestion
+from conversations.models import Conversation, Message, ConversationSummary
+from nlp.models import GroupSummary
 
 Base.metadata.create_all(engine)
 
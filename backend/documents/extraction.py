@@ -0,0 +1,148 @@
+import os
+import math
+import time
+import threading
+import multiprocessing
+import pypdf
+from datetime import datetime
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+from langchain.schema import Document
+from langchain_community.document_loaders import PyPDFLoader, Docx2txtLoader
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# processes extracting PDF pages and DOCX files, 1 or less extracts in the ingestion thread
+EXTRACTION_WORKERS = int(os.getenv("EXTRACTION_WORKERS", str(os.cpu_count() or 1)))
+# minimum pages of a PDF extracted by one task. Every task re-reads the page tree, so long
+# documents are cut in about TASKS_PER_WORKER ranges per worker instead of many small ones.
+PDF_PAGES_PER_TASK = int(os.getenv("PDF_PAGES_PER_TASK", "20"))
+TASKS_PER_WORKER = 4
+# seconds a file may spend in extraction before ingestion fails
+EXTRACTION_TIMEOUT = float(os.getenv("EXTRACTION_TIMEOUT", "600"))
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_extraction_pool() -> ProcessPoolExecutor:
+    """Returns the process pool shared by every ingestion of the process, created on first use."""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            # spawned workers don't inherit the server's threads and locks like forked ones would
+            _pool = ProcessPoolExecutor(
+                max_workers=EXTRACTION_WORKERS, mp_context=multiprocessing.get_context("spawn")
+            )
+        return _pool
+
+
+def _clean_pdf_metadata(metadata: dict) -> dict:
+    """Normalizes PDF document info like PyPDFLoader: lowercase keys without the leading
+    slash, string or int values, dates in ISO format, page_count and file_path aliased."""
+    aliases = {"page_count": "total_pages", "file_path": "source"}
+    cleaned = {}
+    for key, value in metadata.items():
+        if type(value) not in (str, int):
+            value = str(value)
+        key = key.lstrip("/").lower()
+        if key in ("creationdate", "moddate"):
+            try:
+                cleaned[key] = datetime.strptime(value.replace("'", ""), "D:%Y%m%d%H%M%S%z").isoformat("T")
+            except ValueError:
+                cleaned[key] = value
+        elif key in aliases:
+            cleaned[aliases[key]] = value
+            cleaned[key] = value
+        else:
+            cleaned[key] = value.strip() if isinstance(value, str) else value
+    return cleaned
+
+
+def read_pdf_layout(file_path: str):
+    """Returns (document metadata, page labels) of a PDF, computed once and shared by its tasks."""
+    reader = pypdf.PdfReader(file_path)
+    # same document metadata as PyPDFLoader
+    doc_metadata = _clean_pdf_metadata(
+        {"producer": "PyPDF", "creator": "PyPDF", "creationdate": ""}
+        | dict(reader.metadata or {})
+        | {"source": file_path, "total_pages": len(reader.pages)}
+    )
+    # page_labels walks the whole document, tasks get their slice instead of recomputing it
+    return doc_metadata, reader.page_labels
+
+
+def extract_pdf_pages(file_path: str, start: int, page_labels: list, doc_metadata: dict) -> list:
+    """Extracts the pages from start on, one per label, as (text, metadata) pairs. Runs in a pool worker."""
+    reader = pypdf.PdfReader(file_path)
+    pages = []
+    for offset, page_label in enumerate(page_labels):
+        page_number = start + offset
+        text = reader.pages[page_number].extract_text(extraction_mode="plain").strip()
+        pages.append((text, doc_metadata | {"page": page_number, "page_label": page_label}))
+    return pages
+
+
+def extract_docx(file_path: str) -> list:
+    """Extracts a DOCX body as a single (text, metadata) pair. Runs in a pool worker."""
+    import docx2txt  # optional like for Docx2txtLoader, only needed once a DOCX is uploaded
+    return [(docx2txt.process(file_path), {"source": file_path})]
+
+
+def _run_tasks(tasks: list, timeout: float, max_in_flight: int):
+    """Runs (function, args) tasks on the pool and yields their pages in task order.
+
+    At most max_in_flight tasks are submitted ahead of the one being consumed, so
+    extracted text doesn't pile up when embedding is slower than extraction.
+    Raises TimeoutError once the whole file took longer than timeout. Tasks that
+    already started can't be interrupted, they finish in the background.
+    """
+    pool = get_extraction_pool()
+    deadline = time.monotonic() + timeout
+    pending = deque()
+    remaining = iter(tasks)
+    try:
+        for func, args in remaining:
+            pending.append(pool.submit(func, *args))
+            if len(pending) >= max_in_flight:
+                break
+        while pending:
+            future = pending.popleft()
+            try:
+                pages = future.result(timeout=max(0.0, deadline - time.monotonic()))
+            except FutureTimeoutError:
+                raise TimeoutError(f"Text extraction took longer than {timeout:.0f} seconds")
+            for func, args in remaining:
+                pending.append(pool.submit(func, *args))
+                break
+            for text, metadata in pages:
+                yield Document(page_content=text, metadata=metadata)
+    finally:
+        for future in pending:
+            future.cancel()
+
+
+def lazy_load_pdf(file_path: str, workers: int = EXTRACTION_WORKERS,
+                  pages_per_task: int = PDF_PAGES_PER_TASK, timeout: float = EXTRACTION_TIMEOUT):
+    """Yields the pages of a PDF in order, extracting page ranges in parallel across the pool."""
+    if workers <= 1:
+        yield from PyPDFLoader(file_path).lazy_load()
+        return
+
+    doc_metadata, page_labels = read_pdf_layout(file_path)
+    pages_per_task = max(pages_per_task, math.ceil(len(page_labels) / (TASKS_PER_WORKER * workers)))
+    tasks = [
+        (extract_pdf_pages, (file_path, start, page_labels[start:start + pages_per_task], doc_metadata))
+        for start in range(0, len(page_labels), pages_per_task)
+    ]
+    yield from _run_tasks(tasks, timeout, max_in_flight=2 * workers)
+
+
+def lazy_load_docx(file_path: str, workers: int = EXTRACTION_WORKERS, timeout: float = EXTRACTION_TIMEOUT):
+    """Yields the body of a DOCX as one page, extracted by a pool worker."""
+    if workers <= 1:
+        yield from Docx2txtLoader(file_path).lazy_load()
+        return
+    yield from _run_tasks([(extract_docx, (file_path,))], timeout, max_in_flight=1)
@@ -0,0 +1,90 @@
+import os
+import tempfile
+from datetime import datetime
+from database.db import SessionLocal
+from documents.models import Document, DocumentIngestion
+from documents.utils import load_pages, save_in_vectorstore
+
+# percent reached when each stage starts. Pages are extracted, chunked and embedded as one
+# streaming stage, for PDFs its percent moves from 10 to 85 with the pages read.
+STAGE_PERCENT = {
+    "queued": 0,
+    "extracting": 5,
+    "embedding": 10,
+    "indexing": 90,
+    "complete": 100,
+}
+
+
+def _set_stage(db, ingestion: DocumentIngestion, stage: str, percent: int = None, error: str = None):
+    ingestion.stage = stage
+    ingestion.percent = STAGE_PERCENT.get(stage, ingestion.percent) if percent is None else percent
+    ingestion.error = error
+    ingestion.updated_at = datetime.utcnow()
+    if stage in ("complete", "failed"):
+        ingestion.finished_at = ingestion.updated_at
+    db.commit()
+
+
+def run_ingestion(document_id: int, user_id: int):
+    """Background task turning a saved upload into chunks, embeddings and a lexical index.
+
+    Each stage is written to the document's DocumentIngestion row, a failure is
+    stored there with its message. The uploaded file is removed once ingestion
+    completes and kept after a failure, a retry resumes from the chunks already stored.
+    """
+    db = SessionLocal()
+    try:
+        ingestion = db.query(DocumentIngestion).filter(DocumentIngestion.document_id == document_id).first()
+        document = db.query(Document).filter(Document.id == document_id).first()
+        if ingestion is None or document is None:
+            print(f"Document {document_id} was deleted before ingestion started")
+            return
+        file_path = ingestion.file_path
+
+        # Document.content keeps the full text. Pages are appended to a temporary file as they
+        # are chunked and the text is read back once the chunks, vectors and index are released
+        text_spool = tempfile.TemporaryFile("w+", encoding="utf-8")
+        pages_read = {"done": 0, "total": None}
+
+        def tracked(pages):
+            for page in pages:
+                page.metadata["source"] = document.filename
+                if pages_read["done"]:
+                    text_spool.write("\n")
+                text_spool.write(page.page_content)
+                pages_read["done"] += 1
+                pages_read["total"] = page.metadata.get("total_pages")
+                yield page
+
+        def progress(stage, done, total):
+            if stage == "embedding":
+                start, end = STAGE_PERCENT["embedding"], STAGE_PERCENT["indexing"] - 5
+                percent = start
+                if pages_read["total"]:
+                    percent += (end - start) * pages_read["done"] // pages_read["total"]
+                _set_stage(db, ingestion, "embedding", percent)
+            else:
+                _set_stage(db, ingestion, stage)
+
+        try:
+            _set_stage(db, ingestion, "extracting")
+            pages = tracked(load_pages(file_path, ingestion.content_type))
+            stats = save_in_vectorstore(pages, file_id=document_id, user_id=user_id, progress=progress)
+            text_spool.seek(0)
+            document.content = text_spool.read()
+            ingestion.chunk_count = stats["chunk_count"]
+            ingestion.duplicate_chunks = stats["duplicate_chunks"]
+            ingestion.chunks_per_second = stats["chunks_per_second"]
+            ingestion.file_path = None
+            _set_stage(db, ingestion, "complete")
+            os.remove(file_path)
+            print(f"Document {document_id} ingested")
+        except Exception as e:
+            print(f"Error ingesting document {document_id}: {e}")
+            db.rollback()
+            _set_stage(db, ingestion, "failed", ingestion.percent, error=str(e))
+        finally:
+            text_spool.close()
+    finally:
+        db.close()
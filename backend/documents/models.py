@@ -14,6 +14,8 @@ class Document(Base):
     user = relationship("User", back_populates="documents")
     conversations = relationship("Conversation", back_populates="document")
     summary = relationship("DocumentSummary", back_populates="document", uselist=False)
+    ingestion = relationship("DocumentIngestion", back_populates="document", uselist=False,
+                             cascade="all, delete-orphan")
 
 class DocumentSummary(Base):
     __tablename__ = "document_summaries"
@@ -26,4 +28,26 @@ class DocumentSummary(Base):
     chunk_count = Column(Integer)
     processing_time = Column(Float)
 
-    document = relationship("Document", back_populates="summary")
\ No newline at end of file
+    document = relationship("Document", back_populates="summary")
+
+class DocumentIngestion(Base):
+    """Progress of the background ingestion of an uploaded document."""
+    __tablename__ = "document_ingestions"
+
+    id = Column(Integer, primary_key=True, index=True)
+    document_id = Column(Integer, ForeignKey("documents.id", ondelete="CASCADE"), unique=True, nullable=False)
+    # queued, extracting, chunking, embedding, indexing, complete, failed
+    stage = Column(String, nullable=False, default="queued")
+    percent = Column(Integer, nullable=False, default=0)
+    error = Column(Text, nullable=True)
+    # the saved upload, kept after a failure so the ingestion can be retried
+    file_path = Column(String, nullable=True)
+    content_type = Column(String, nullable=True)
+    chunk_count = Column(Integer, nullable=True)
+    duplicate_chunks = Column(Integer, nullable=True)
+    chunks_per_second = Column(Float, nullable=True)
+    started_at = Column(DateTime, default=datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.utcnow)
+    finished_at = Column(DateTime, nullable=True)
+
+    document = relationship("Document", back_populates="ingestion")
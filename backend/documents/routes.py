@@ -1,14 +1,17 @@
-from fastapi import APIRouter, UploadFile, File, HTTPException, UploadFile, Depends
+from fastapi import APIRouter, UploadFile, File, HTTPException, UploadFile, Depends, BackgroundTasks
 from sqlalchemy.orm import Session
 from typing import List
 from documents import schemas
-from documents.utils import extract_text_from_file, save_in_vectorstore, delete_from_vectorstore
-from documents.models import Document
+from documents.utils import save_upload, delete_from_vectorstore
+from documents.ingestion import run_ingestion
+from documents.models import Document, DocumentIngestion
 from conversations.models import Conversation
+from nlp.conversation_memory import conversation_memories
 from database.db import SessionLocal
 from auth.security import get_current_user
 
 import os
+from datetime import datetime
 
 router = APIRouter(prefix="/documents", tags=["Documents"])
 
@@ -21,10 +24,12 @@ def get_db():
 
 @router.post("/upload", response_model=schemas.DocumentResponse)
 async def upload_document(
+    background_tasks: BackgroundTasks,
     file: UploadFile = File(...), 
     db: Session = Depends(get_db), 
     current_user=Depends(get_current_user)
 ):
+    """Saves the upload and queues its ingestion, progress is reported by /documents/{id}/status."""
     if file.content_type not in [
         "application/pdf",
         "application/vnd.openxmlformats-officedocument.wordprocessingml.document",
@@ -32,19 +37,23 @@ async def upload_document(
     ]:
         raise HTTPException(status_code=400, detail="Unsupported file type.")
     try:
-        text, docs = await extract_text_from_file(file)
+        file_path = await save_upload(file)
 
+        # content is filled in once the text is extracted
         new_document = Document(
             filename=file.filename,
-            content=text,
+            content="",
             user_id=current_user.id
         )
+        new_document.ingestion = DocumentIngestion(
+            stage="queued", percent=0, file_path=file_path, content_type=file.content_type
+        )
 
         db.add(new_document)
         db.commit()
         db.refresh(new_document)
 
-        save_in_vectorstore(docs, file_id=new_document.id, user_id=current_user.id)
+        background_tasks.add_task(run_ingestion, new_document.id, current_user.id)
 
         return { 
             "id": new_document.id, 
@@ -58,6 +67,75 @@ async def upload_document(
         )
     
 
+@router.put("/{document_id}", response_model=schemas.DocumentResponse)
+async def update_document(
+    document_id: int,
+    background_tasks: BackgroundTasks,
+    file: UploadFile = File(...),
+    db: Session = Depends(get_db),
+    current_user = Depends(get_current_user)
+):
+    """Replaces a document with a new version, keeping its conversations.
+
+    The new version is ingested like an upload, but only chunks whose text is not
+    already stored for the document are embedded and vanished chunks are removed.
+    Progress is reported by /documents/{id}/status.
+    """
+    if file.content_type not in [
+        "application/pdf",
+        "application/vnd.openxmlformats-officedocument.wordprocessingml.document",
+        "text/plain"
+    ]:
+        raise HTTPException(status_code=400, detail="Unsupported file type.")
+
+    document = db.query(Document).filter(
+        Document.id == document_id,
+        Document.user_id == current_user.id
+    ).first()
+
+    if not document:
+        raise HTTPException(status_code=404, detail="Document not found")
+
+    ingestion = document.ingestion
+    if ingestion is not None and ingestion.stage not in ("complete", "failed"):
+        raise HTTPException(status_code=409, detail="The document is still being processed.")
+
+    try:
+        file_path = await save_upload(file)
+
+        # upload kept by a failed ingestion of the previous version
+        if ingestion is not None and ingestion.file_path and os.path.exists(ingestion.file_path):
+            os.remove(ingestion.file_path)
+        if ingestion is None:
+            ingestion = document.ingestion = DocumentIngestion()
+        ingestion.stage = "queued"
+        ingestion.percent = 0
+        ingestion.error = None
+        ingestion.file_path = file_path
+        ingestion.content_type = file.content_type
+        ingestion.started_at = datetime.utcnow()
+        ingestion.finished_at = None
+
+        # the stored summary describes the previous version
+        if document.summary is not None:
+            db.delete(document.summary)
+        document.filename = file.filename
+        db.commit()
+
+        background_tasks.add_task(run_ingestion, document.id, current_user.id)
+
+        return {
+            "id": document.id,
+            "user_id": document.user_id,
+            "filename": document.filename
+        }
+    except Exception as e:
+        db.rollback()
+        raise HTTPException(
+            status_code=500,
+            detail=f"Error processing file: {str(e)}"
+        )
+
 @router.get("/my_files", response_model=List[schemas.DocumentBrief])
 def get_my_files(
     db: Session = Depends(get_db), 
@@ -113,6 +191,12 @@ async def delete_document(
 
         for conv in conversations:
             db.delete(conv)
+            conversation_memories.invalidate(conv.id)
+
+        # upload kept by a failed ingestion
+        ingestion = document.ingestion
+        if ingestion is not None and ingestion.file_path and os.path.exists(ingestion.file_path):
+            os.remove(ingestion.file_path)
 
         db.delete(document)
         db.commit()
@@ -141,15 +225,68 @@ async def check_document_status(
 
     if not document:
         raise HTTPException(status_code=404, detail="Document not found")
-    
-    vector_path = f"./vectorstore/{current_user.id}/{document_id}"
-    exists = os.path.exists(vector_path)
+
+    ingestion = document.ingestion
+    if ingestion is None:
+        # documents uploaded before ingestion progress was tracked
+        vector_path = f"./vectorstore/{current_user.id}/{document_id}"
+        exists = os.path.exists(vector_path)
+        return {
+            "id": document.id,
+            "filename": document.filename,
+            "processingComplete": exists,
+            "status": "complete" if exists else "processing",
+            "stage": "complete" if exists else None,
+            "percent": 100 if exists else 0
+        }
+
+    return {
+        "id": document.id,
+        "filename": document.filename,
+        "processingComplete": ingestion.stage == "complete",
+        "status": ingestion.stage if ingestion.stage in ("complete", "failed") else "processing",
+        "stage": ingestion.stage,
+        "percent": ingestion.percent,
+        "error": ingestion.error,
+        "chunk_count": ingestion.chunk_count,
+        "duplicate_chunks": ingestion.duplicate_chunks,
+        "chunks_per_second": ingestion.chunks_per_second
+    }
+
+@router.post("/{document_id}/ingestion/retry", response_model=schemas.DocumentStatus)
+async def retry_ingestion(
+    document_id: int,
+    background_tasks: BackgroundTasks,
+    db: Session = Depends(get_db),
+    current_user = Depends(get_current_user)
+):
+    """Queues a failed ingestion again, chunks stored before the failure are not re-embedded."""
+    document = db.query(Document).filter(
+        Document.id == document_id,
+        Document.user_id == current_user.id
+    ).first()
+
+    if not document:
+        raise HTTPException(status_code=404, detail="Document not found")
+
+    ingestion = document.ingestion
+    if ingestion is None or ingestion.stage != "failed":
+        raise HTTPException(status_code=409, detail="Only a failed ingestion can be retried.")
+    if not ingestion.file_path or not os.path.exists(ingestion.file_path):
+        raise HTTPException(status_code=410, detail="The uploaded file is no longer available, upload it again.")
+
+    ingestion.stage = "queued"
+    ingestion.error = None
+    db.commit()
+    background_tasks.add_task(run_ingestion, document.id, current_user.id)
 
     return {
         "id": document.id,
         "filename": document.filename,
-        "processingComplete": exists,
-        "status": "complete" if exists else "processing"
+        "processingComplete": False,
+        "status": "processing",
+        "stage": ingestion.stage,
+        "percent": ingestion.percent
     }
 
 
@@ -27,6 +27,12 @@ class DocumentStatus(DocumentBase):
     id: int
     processingComplete: bool
     status: str
+    stage: Optional[str] = None
+    percent: int = 0
+    error: Optional[str] = None
+    chunk_count: Optional[int] = None
+    duplicate_chunks: Optional[int] = None
+    chunks_per_second: Optional[float] = None
     
     model_config = {
         "from_attributes": True
@@ -1,57 +1,92 @@
 import os 
-from langchain_community.document_loaders import TextLoader, PyPDFLoader, Docx2txtLoader
+import time
+import json
+import hashlib
+import tempfile
+import uuid
+import numpy as np
+from documents.extraction import lazy_load_pdf, lazy_load_docx
 from langchain.schema import Document
 from langchain_text_splitters import CharacterTextSplitter, RecursiveCharacterTextSplitter
 from langchain_openai import OpenAIEmbeddings, OpenAI
 from langchain_chroma import Chroma
 import shutil
+from fastapi.concurrency import run_in_threadpool
+from nlp.lexical import build_lexical_index, drop_lexical_index
+from nlp.embeddings import get_embeddings, batch_by_tokens, embed_batches
+from nlp.dense_index import DenseVectorStore, DenseIndexWriter
+from nlp.dedup import mark_near_duplicates
+from nlp.answer_cache import answer_cache
+from nlp.retrieval_cache import retrieval_candidates
+from nlp.vectorstores import (
+    VECTORSTORE_MODE, VECTORSTORE_BACKEND, DENSE_INDEX_DTYPE, get_persist_dir, invalidate_vectorstore, make_chunk_id,
+    open_user_collection, open_file_collection, delete_from_user_collection, has_file_store, has_collection_chunks
+)
 
 from dotenv import load_dotenv
 
 load_dotenv()
 
-async def extract_text_from_file(file):
-    file_path = f"temp/{file.filename}"
+# bytes of an upload held in memory at a time while it is written to temp/
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+# text files are split in blocks of about this many characters, cut on blank lines
+TEXT_BLOCK_SIZE = 64 * 1024
+
+async def save_upload(file) -> str:
+    """Streams an upload to a unique file in temp/ and returns its path.
+
+    The file is copied UPLOAD_CHUNK_SIZE bytes at a time and disk writes run in the
+    threadpool, so large uploads neither fill memory nor block the event loop.
+    """
     os.makedirs("temp", exist_ok=True)
+    file_path = os.path.join("temp", f"{uuid.uuid4().hex}_{os.path.basename(file.filename)}")
+
+    f = await run_in_threadpool(open, file_path, "wb")
+    try:
+        while True:
+            chunk = await file.read(UPLOAD_CHUNK_SIZE)
+            if not chunk:
+                break
+            await run_in_threadpool(f.write, chunk)
+    finally:
+        await run_in_threadpool(f.close)
 
-    # Save the file to a temporary location
-    with open(file_path, "wb") as f:
-        f.write(await file.read())
+    return file_path
 
+def lazy_load_text(file_path: str):
+    """Yields a text file in blocks of about TEXT_BLOCK_SIZE characters ending on a blank line."""
+    with open(file_path, "r", encoding="utf-8") as f: # utf-8 encoding supports special characters
+        block = []
+        size = 0
+        for line in f:
+            block.append(line)
+            size += len(line)
+            if size >= TEXT_BLOCK_SIZE and not line.strip():
+                yield Document(page_content="".join(block), metadata={"source": file_path})
+                block = []
+                size = 0
+        if block:
+            yield Document(page_content="".join(block), metadata={"source": file_path})
+
+def load_pages(file_path: str, content_type: str):
+    """Yields the pages of a saved upload one at a time, with null characters removed."""
     # Extract text based on file type
-    if file.content_type == "application/pdf":
-        # reader = PdfReader(file_path)
-        # text = " ".join([page.extract_text() for page in reader.pages])
-        loader = PyPDFLoader(file_path)
-    elif file.content_type == "text/plain":
-        with open(file_path, "r") as f:
-            # text = f.read()
-            # loader = TextLoader(file_path)
-            loader = TextLoader(file_path, encoding="utf-8") # utf-8 encoding supports special characters
-    elif file.content_type == "application/vnd.openxmlformats-officedocument.wordprocessingml.document":
-        # doc = Document(file_path)
-        # text = " ".join([para.text for para in doc.paragraphs])
-        loader = Docx2txtLoader(file_path)
+    # PDF page ranges and DOCX files are extracted on the process pool of documents.extraction
+    if content_type == "application/pdf":
+        pages = lazy_load_pdf(file_path)
+    elif content_type == "text/plain":
+        pages = lazy_load_text(file_path)
+    elif content_type == "application/vnd.openxmlformats-officedocument.wordprocessingml.document":
+        # a docx body is a single zipped XML part, it is loaded as one page
+        pages = lazy_load_docx(file_path)
     else:
-        os.remove(file_path)
         raise ValueError("Unsupported file type")
-    
-    documents = loader.load()
-    cleaned_docs = []
-    # Clean up null characters from the text
-    for doc in documents:
-        cleaned_text = doc.page_content.replace("\x00", "")
-        cleaned_doc = Document(page_content=cleaned_text, metadata=doc.metadata)
-        cleaned_docs.append(cleaned_doc)
-
-    full_text =  "\n".join([doc.page_content for doc in cleaned_docs])
 
-    # Clean up the temporary file
-    os.remove(file_path)
+    for doc in pages:
+        yield Document(page_content=doc.page_content.replace("\x00", ""), metadata=doc.metadata)
 
-    return full_text, cleaned_docs
-
-def save_in_vectorstore(documents, file_id: int, user_id: int):
+def iter_chunks(documents, file_id: int, user_id: int):
+    """Splits pages into chunks as they arrive, with the metadata the NLP pipeline relies on."""
     # RercursiveCharacterTextSplitter has better performance than CharacterTextSplitter
     text_splitter = RecursiveCharacterTextSplitter(
         chunk_size=1000,
@@ -59,35 +94,225 @@ def save_in_vectorstore(documents, file_id: int, user_id: int):
         separators=["\n\n", "\n", ".", "!", "?", ",", " ", ""],
         length_function=len
         )
-    docs = text_splitter.split_documents(documents=documents)
 
-    for idx, doc in enumerate(docs):
-        doc.metadata["file_id"] = file_id
-        doc.metadata["user_id"] = user_id
-        doc.metadata["chunk_id"] = idx
-        doc.metadata["source"] = documents[0].metadata.get("source", "")
-        doc.metadata["chunk_size"] = len(doc.page_content)
+    chunk_id = 0
+    source = None
+    for page in documents:
+        if source is None:
+            source = page.metadata.get("source", "")
+        for doc in text_splitter.split_documents([page]):
+            doc.metadata["file_id"] = file_id
+            doc.metadata["user_id"] = user_id
+            doc.metadata["chunk_id"] = chunk_id
+            doc.metadata["source"] = source
+            doc.metadata["chunk_size"] = len(doc.page_content)
+            chunk_id += 1
+            yield doc
 
-    embeddings = OpenAIEmbeddings(model="text-embedding-3-small")
+def chunk_hash(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
 
-    persist_dir = f"./vectorstore/{user_id}/{file_id}"
+def load_stored_chunks(collection, persist_dir: str, file_id: int, per_user: bool = False) -> dict:
+    """Returns {id: (text hash, embedding, dup_of)} of the chunks a document already has in its store.
+    Embeddings are float32 rows of one array, texts are not kept."""
+    if collection is not None:
+        # a per_user collection holds every document of the user
+        where = {"file_id": file_id} if per_user else None
+        stored = collection.get(where=where, include=["documents", "embeddings", "metadatas"])
+    elif DenseVectorStore.exists(persist_dir):
+        store = DenseVectorStore(persist_dir)
+        stored = store.get(include=["documents", "embeddings", "metadatas"])
+        store.close()
+    else:
+        return {}
+    embeddings = np.asarray(stored["embeddings"], dtype=np.float32)
+    return {
+        chunk_id: (chunk_hash(text), embedding, (metadata or {}).get("dup_of"))
+        for chunk_id, text, embedding, metadata
+        in zip(stored["ids"], stored["documents"], embeddings, stored["metadatas"])
+    }
+
+def spool_chunks(spool, docs: list):
+    """Appends chunks to a text spool file, one JSON line each."""
+    for doc in docs:
+        spool.write(json.dumps([doc.page_content, doc.metadata], ensure_ascii=False) + "\n")
+
+def read_spooled_chunks(spool):
+    """Yields the chunks of a spool file as Documents, in the order they were written."""
+    spool.seek(0)
+    for line in spool:
+        text, metadata = json.loads(line)
+        yield Document(page_content=text, metadata=metadata)
+
+def forget_cached_file(user_id: int, file_id: int):
+    """Drops the cached store handle, answers and retrieval candidates of a document."""
+    invalidate_vectorstore(user_id, file_id)
+    answer_cache.invalidate_file(file_id)
+    retrieval_candidates.invalidate_file(file_id)
+
+def save_in_vectorstore(documents, file_id: int, user_id: int, progress=None) -> dict:
+    """Splits, embeds and indexes a document, or a new version of it. Errors are raised to the caller.
+
+    documents can be any iterable of pages, a lazy loader is consumed as chunks
+    are embedded and written batch by batch, so pages are never all in memory.
+    Chunks wait for the lexical index in a temporary spool file and dense store
+    vectors in the DenseIndexWriter's files, neither is kept in memory.
+    Near duplicates of an earlier chunk of the document are stored and indexed with
+    a dup_of link to it, searches rank them after a chunk of the same group.
+    Chunks are matched to the ones already stored for the document by content
+    hash: only new texts are embedded, moved chunks get their new chunk_id with
+    the stored vector and chunks missing from the new version are deleted. The
+    same applies to chunks left by an interrupted run.
+    progress, if given, is called as progress(stage, chunks_done, None) after each
+    written batch and once more when the lexical index is built.
+    Returns the chunk counts and the embedding throughput.
+    """
+    report = progress or (lambda stage, done, total: None)
+
+    persist_dir = get_persist_dir(user_id, file_id)
+    # a cached handle would not see the new chunks, cached answers were built from the old ones
+    forget_cached_file(user_id, file_id)
     os.makedirs(persist_dir, exist_ok=True)
 
     print("persist_dir =", persist_dir)
-    print("persist_dir absolut =", os.path.abspath(persist_dir))
+
+    # chunks are spooled to disk until the lexical index is built from them
+    spool = tempfile.TemporaryFile("w+", encoding="utf-8")
+    dense_writer = None
 
     try:
-        vector_store = Chroma.from_documents(
-            documents=docs,
-            embedding=embeddings,
-            persist_directory=persist_dir
-        )
-        print(f"Documents saved in vector store at {persist_dir}")
+        # a new version goes where the document already is, so no stale chunks are left in the
+        # other layout, VECTORSTORE_MODE and VECTORSTORE_BACKEND only apply to new documents
+        if has_file_store(user_id, file_id):
+            per_user = False
+            dense = DenseVectorStore.exists(persist_dir)
+            # left over by earlier versions that wrote per-file stores next to migrated chunks
+            delete_from_user_collection(user_id, file_id)
+        else:
+            per_user = VECTORSTORE_MODE == "per_user" or has_collection_chunks(user_id, file_id)
+            dense = VECTORSTORE_BACKEND == "numpy"
+
+        if per_user:
+            # one collection per user, chunks are told apart by their file_id metadata
+            collection = open_user_collection(user_id, create=True)._collection
+        elif dense:
+            collection = None  # the dense files are written once every chunk is embedded
+            dense_writer = DenseIndexWriter(persist_dir, dtype=DENSE_INDEX_DTYPE)
+        else:
+            collection = open_file_collection(user_id, file_id)._collection
+
+        stored_chunks = load_stored_chunks(collection, persist_dir, file_id, per_user=per_user)
+        stored_vectors = {text_hash: embedding for text_hash, embedding, _ in stored_chunks.values()}
+
+        duplicates = 0
+
+        def counted_chunks():
+            """Chunks of the document with their dup_of links, counting the near duplicates."""
+            nonlocal duplicates
+            for doc in mark_near_duplicates(iter_chunks(documents, file_id, user_id)):
+                if "dup_of" in doc.metadata:
+                    duplicates += 1
+                yield doc
+
+        def pending_batches():
+            """(batch, chunks of the batch to write, chunks of those to embed) triples."""
+            for batch in batch_by_tokens(counted_chunks(), lambda doc: doc.page_content):
+                if collection is None:
+                    to_write = batch  # the dense matrix is rewritten whole
+                else:
+                    # a chunk already stored under its id with the same text and dup_of link stays as it is
+                    to_write = [
+                        doc for doc in batch
+                        if stored_chunks.get(make_chunk_id(file_id, doc.metadata["chunk_id"]), (None, None, None))[::2]
+                        != (chunk_hash(doc.page_content), doc.metadata.get("dup_of"))
+                    ]
+                to_embed = [doc for doc in to_write if chunk_hash(doc.page_content) not in stored_vectors]
+                yield batch, to_write, to_embed
+
+        # chunks past the end of the new version, dense stores key chunks by chunk_id alone
+        store_id = (lambda doc: make_chunk_id(file_id, doc.metadata["chunk_id"])) if collection is not None \
+            else (lambda doc: str(doc.metadata["chunk_id"]))
+        stale_ids = set(stored_chunks)
+
+        start_time = time.time()
+        chunk_count = 0
+        embedded = 0
+        reused = 0
+        batches = embed_batches(pending_batches(), lambda triple: [doc.page_content for doc in triple[2]])
+        for (batch, to_write, to_embed), vectors in batches:
+            new_vectors = {chunk_hash(doc.page_content): vector for doc, vector in zip(to_embed, vectors)}
+            write_vectors = []
+            for doc in to_write:
+                key = chunk_hash(doc.page_content)
+                write_vectors.append(new_vectors[key] if key in new_vectors else stored_vectors[key])
+            if collection is not None:
+                if to_write:
+                    # upsert with deterministic ids, writing a batch twice is harmless
+                    collection.upsert(
+                        ids=[store_id(doc) for doc in to_write],
+                        embeddings=write_vectors,
+                        documents=[doc.page_content for doc in to_write],
+                        metadatas=[dict(doc.metadata) for doc in to_write]
+                    )
+            else:
+                dense_writer.add(
+                    ids=[store_id(doc) for doc in to_write],
+                    texts=[doc.page_content for doc in to_write],
+                    vectors=write_vectors,
+                    metadatas=[dict(doc.metadata) for doc in to_write]
+                )
+            stale_ids.difference_update(store_id(doc) for doc in batch)
+            spool_chunks(spool, batch)
+            chunk_count += len(batch)
+            embedded += len(to_embed)
+            reused += len(batch) - len(to_embed)
+            report("embedding", chunk_count, None)
+        embedding_seconds = time.time() - start_time
+
+        if collection is not None and stale_ids:
+            collection.delete(ids=list(stale_ids))
+
+        if per_user:
+            print(f"Documents saved in the collection of user {user_id}")
+        elif dense:
+            dense_writer.commit()
+            print(f"Documents saved in dense index at {persist_dir}")
+        else:
+            print(f"Documents saved in vector store at {persist_dir}")
+
+        report("indexing", chunk_count, chunk_count)
+        build_lexical_index(persist_dir, read_spooled_chunks(spool))
     except Exception as e:
         print(f"Error saving documents to vector store: {e}")
+        raise
+    finally:
+        spool.close()
+        if dense_writer is not None:
+            dense_writer.close()
+        # searches during the run may have cached the old store, answers or candidates again
+        forget_cached_file(user_id, file_id)
+
+    stats = {
+        "chunk_count": chunk_count,
+        "embedded_chunks": embedded,
+        "reused_chunks": reused,
+        "removed_chunks": len(stale_ids),
+        "duplicate_chunks": duplicates,
+        "embedding_seconds": round(embedding_seconds, 3),
+        "chunks_per_second": round(chunk_count / embedding_seconds, 1) if embedding_seconds > 0 else None,
+    }
+    print(f"Ingested {stats['chunk_count']} chunks ({embedded} embedded, {reused} reused, "
+          f"{len(stale_ids)} removed, {duplicates} near duplicates linked) at {stats['chunks_per_second']} chunks/s")
+    return stats
 
 def delete_from_vectorstore(file_id: int, user_id: int):
-    persist_dir = f"./vectorstore/{user_id}/{file_id}"
+    persist_dir = get_persist_dir(user_id, file_id)
+    forget_cached_file(user_id, file_id)
+    drop_lexical_index(persist_dir)
+
+    # chunks of documents ingested in per_user mode or migrated into the user collection
+    delete_from_user_collection(user_id, file_id)
+
     if os.path.exists(persist_dir):
         shutil.rmtree(persist_dir)
         print(f"Deleted vector store at {persist_dir}")
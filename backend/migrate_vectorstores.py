@@ -0,0 +1,94 @@
+# compacts the per-file chroma or dense stores of ./vectorstore/{user_id}/{file_id} into one collection per user
+# usage: python migrate_vectorstores.py [--user USER_ID] [--dry-run]
+import os
+import shutil
+import argparse
+from dotenv import load_dotenv
+
+load_dotenv()
+
+from nlp.lexical import INDEX_FILENAME, get_lexical_index, drop_lexical_index
+from nlp.vectorstores import (
+    VECTORSTORE_ROOT, get_persist_dir, has_file_store, close_vectorstore,
+    invalidate_vectorstore, make_chunk_id, open_user_collection, open_vectorstore
+)
+
+BATCH_SIZE = 500
+
+
+def migrate_file(user_id: int, file_id: int, dry_run: bool = False) -> int:
+    """Copies the chunks of one per-file store into the user collection, then removes the store."""
+    persist_dir = get_persist_dir(user_id, file_id)
+    store = open_vectorstore(user_id, file_id)
+    data = store.get(include=["embeddings", "documents", "metadatas"])
+    chunk_count = len(data["ids"])
+    print(f"User {user_id}, file {file_id}: {chunk_count} chunks")
+    if dry_run:
+        return chunk_count
+
+    # the lexical index stays in the per-file dir, make sure it exists before the chroma files go away
+    get_lexical_index(persist_dir, store)
+
+    collection = open_user_collection(user_id, create=True)._collection
+    for start in range(0, chunk_count, BATCH_SIZE):
+        end = start + BATCH_SIZE
+        metadatas = data["metadatas"][start:end]
+        for metadata in metadatas:
+            metadata["file_id"] = file_id
+            metadata["user_id"] = user_id
+        # stored embeddings are copied as they are, nothing is re-embedded
+        collection.upsert(
+            ids=[
+                make_chunk_id(file_id, metadata.get("chunk_id", start + i))
+                for i, metadata in enumerate(metadatas)
+            ],
+            embeddings=data["embeddings"][start:end],
+            documents=data["documents"][start:end],
+            metadatas=metadatas,
+        )
+
+    # close the per-file store, then keep only the lexical index in its directory. Open files
+    # can't be removed on Windows, so the handle is released now rather than when collected.
+    invalidate_vectorstore(user_id, file_id)
+    close_vectorstore(store)
+    del store, data
+    drop_lexical_index(persist_dir)
+    for name in os.listdir(persist_dir):
+        path = os.path.join(persist_dir, name)
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        elif name != INDEX_FILENAME:
+            os.remove(path)
+    return chunk_count
+
+
+def migrate(user_filter: int = None, dry_run: bool = False):
+    if not os.path.exists(VECTORSTORE_ROOT):
+        print("Nothing to migrate, the vectorstore folder does not exist.")
+        return
+
+    migrated_files = 0
+    migrated_chunks = 0
+    for user_dir in sorted(os.listdir(VECTORSTORE_ROOT)):
+        if not user_dir.isdigit() or (user_filter is not None and int(user_dir) != user_filter):
+            continue
+        user_id = int(user_dir)
+        for file_dir in sorted(os.listdir(os.path.join(VECTORSTORE_ROOT, user_dir))):
+            if not file_dir.isdigit() or not has_file_store(user_id, int(file_dir)):
+                continue
+            try:
+                migrated_chunks += migrate_file(user_id, int(file_dir), dry_run=dry_run)
+                migrated_files += 1
+            except Exception as e:
+                print(f"Error migrating user {user_id}, file {file_dir}: {e}")
+
+    action = "Would migrate" if dry_run else "Migrated"
+    print(f"{action} {migrated_files} files ({migrated_chunks} chunks)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compact per-file vectorstores into per-user collections.")
+    parser.add_argument("--user", type=int, default=None, help="only migrate this user")
+    parser.add_argument("--dry-run", action="store_true", help="only report what would be migrated")
+    args = parser.parse_args()
+    migrate(user_filter=args.user, dry_run=args.dry_run)
@@ -0,0 +1,137 @@
+import os
+import json
+import time
+import base64
+import hashlib
+import threading
+import numpy as np
+from nlp.shared_state import make_list_store
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# groups of answers kept, a group holds the last ANSWER_CACHE_GROUP_SIZE answers on the same
+# documents with the same history
+ANSWER_CACHE_SIZE = int(os.getenv("ANSWER_CACHE_SIZE", "1000"))
+ANSWER_CACHE_GROUP_SIZE = 20
+ANSWER_CACHE_TTL = float(os.getenv("ANSWER_CACHE_TTL", "86400"))  # seconds
+# minimum cosine similarity between two questions for a stored answer to be reused
+ANSWER_CACHE_THRESHOLD = float(os.getenv("ANSWER_CACHE_THRESHOLD", "0.95"))
+
+
+def history_fingerprint(memory, history_summary: str = None) -> str:
+    """Hash of the remembered messages and the summary of older turns,
+    answers only match questions asked with the same history."""
+    # read once, with a shared state backend every read is a query
+    messages = memory.chat_memory.messages if memory is not None else []
+    if not messages and not history_summary:
+        return ""
+    digest = hashlib.sha1()
+    if history_summary:
+        digest.update(history_summary.encode("utf-8"))
+        digest.update(b"\0")
+    for msg in messages:
+        digest.update(msg.type.encode("utf-8"))
+        digest.update(b"\0")
+        digest.update(msg.content.encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+def _unit(vector) -> np.ndarray:
+    vector = np.asarray(vector, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm > 0 else vector
+
+
+def _encode_vector(vector: np.ndarray) -> str:
+    return base64.b64encode(vector.astype(np.float32).tobytes()).decode("ascii")
+
+
+def _decode_vector(value: str) -> np.ndarray:
+    return np.frombuffer(base64.b64decode(value), dtype=np.float32)
+
+
+class AnswerCache:
+    """Semantic cache of /nlp/ask answers.
+
+    Entries are grouped by (file ids, history fingerprint, fusion mode) and a
+    question hits when its embedding is within the cosine threshold of a
+    stored question. Groups live in a list store, in-process or shared between
+    workers (see SHARED_STATE_BACKEND): at most max_size groups of the last
+    ANSWER_CACHE_GROUP_SIZE answers, least recently used groups are evicted
+    and entries older than the TTL are ignored.
+    """
+
+    def __init__(self, max_size: int = ANSWER_CACHE_SIZE, ttl: float = ANSWER_CACHE_TTL,
+                 threshold: float = ANSWER_CACHE_THRESHOLD, backend: str = None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.threshold = threshold
+        self.groups = make_list_store("answers", max_size, ttl, backend=backend)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    @staticmethod
+    def make_group(file_ids: list, history_fp: str, fusion: str) -> tuple:
+        return (tuple(sorted(file_ids)), history_fp, fusion)
+
+    @staticmethod
+    def _key(group: tuple) -> str:
+        file_ids, history_fp, fusion = group
+        return json.dumps([list(file_ids), history_fp, fusion])
+
+    def lookup(self, group: tuple, query_embedding):
+        """Returns (result, similarity) of the closest stored question above the threshold, or None."""
+        query = _unit(query_embedding)
+        now = time.time()
+        entries = [entry for entry in self.groups.get(self._key(group)) or [] if now - entry["created"] <= self.ttl]
+
+        if entries:
+            vectors = np.stack([_decode_vector(entry["vector"]) for entry in entries])
+            similarities = vectors @ query
+            best = int(np.argmax(similarities))
+            if similarities[best] >= self.threshold:
+                with self._lock:
+                    self.hits += 1
+                return entries[best]["result"], float(similarities[best])
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def store(self, group: tuple, query_embedding, result: dict):
+        self.groups.append(self._key(group), [{
+            "vector": _encode_vector(_unit(query_embedding)),
+            "result": result,
+            "created": time.time(),
+        }], max_len=ANSWER_CACHE_GROUP_SIZE)
+
+    def invalidate_file(self, file_id: int):
+        """Drops every answer built from a document, used when it is deleted or re-ingested."""
+        stale = [key for key in self.groups.keys() if file_id in json.loads(key)[0]]
+        removed = sum(1 for key in stale if self.groups.delete(key))
+        with self._lock:
+            self.invalidations += removed
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "backend": type(self.groups).__name__,
+                "size": self.groups.size(),
+                "max_size": self.max_size,
+                "ttl_seconds": self.ttl,
+                "threshold": self.threshold,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.groups.evictions,
+                "invalidations": self.invalidations,
+                "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+            }
+
+
+answer_cache = AnswerCache()
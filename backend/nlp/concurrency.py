@@ -0,0 +1,26 @@
+import os
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# threads for blocking work of the NLP pipeline (chroma queries, BM25, sqlite, decryption)
+NLP_EXECUTOR_WORKERS = int(os.getenv("NLP_EXECUTOR_WORKERS", "8"))
+# concurrent calls to the OpenAI chat and embeddings APIs per worker process
+NLP_MAX_CONCURRENT_LLM = int(os.getenv("NLP_MAX_CONCURRENT_LLM", "16"))
+NLP_MAX_CONCURRENT_EMBEDDINGS = int(os.getenv("NLP_MAX_CONCURRENT_EMBEDDINGS", "16"))
+
+executor = ThreadPoolExecutor(max_workers=NLP_EXECUTOR_WORKERS, thread_name_prefix="nlp")
+
+# asyncio primitives bind to the running loop on first use, creating them at import is safe
+llm_semaphore = asyncio.Semaphore(NLP_MAX_CONCURRENT_LLM)
+embeddings_semaphore = asyncio.Semaphore(NLP_MAX_CONCURRENT_EMBEDDINGS)
+
+
+async def run_blocking(func, *args, **kwargs):
+    """Runs a blocking call on the bounded NLP executor without stalling the event loop."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor, functools.partial(func, *args, **kwargs))
@@ -0,0 +1,140 @@
+import os
+import threading
+from langchain.memory import ConversationBufferWindowMemory
+from langchain_core.chat_history import BaseChatMessageHistory
+from langchain.schema import HumanMessage, AIMessage
+from conversations.models import Message
+from nlp.shared_state import make_list_store
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# user/assistant exchanges a conversation remembers
+MEMORY_WINDOW = 5
+CONVERSATION_MEMORY_CACHE_SIZE = int(os.getenv("CONVERSATION_MEMORY_CACHE_SIZE", "1024"))
+CONVERSATION_MEMORY_TTL = float(os.getenv("CONVERSATION_MEMORY_TTL", "1800"))  # seconds of inactivity
+
+
+class SharedChatMessageHistory(BaseChatMessageHistory):
+    """Messages of one conversation kept in a list store, read and appended in place.
+
+    With the sqlite backend every worker sees the same messages, and messages
+    added by two workers at the same time are both kept.
+    """
+
+    def __init__(self, store, key: str, max_messages: int):
+        self.store = store
+        self.key = key
+        self.max_messages = max_messages
+
+    @property
+    def messages(self) -> list:
+        items = self.store.get(self.key) or []
+        return [
+            HumanMessage(content=item["content"]) if item["type"] == "human" else AIMessage(content=item["content"])
+            for item in items
+        ]
+
+    def add_messages(self, messages) -> None:
+        self.store.append(
+            self.key,
+            [{"type": message.type, "content": message.content} for message in messages],
+            max_len=self.max_messages
+        )
+
+    def add_message(self, message) -> None:
+        self.add_messages([message])
+
+    def clear(self) -> None:
+        self.store.delete(self.key)
+
+
+def new_memory(chat_memory, window: int = MEMORY_WINDOW) -> ConversationBufferWindowMemory:
+    return ConversationBufferWindowMemory(
+        chat_memory=chat_memory,
+        memory_key="chat_history",
+        k=window,  # number of exchanges to keep in memory
+        return_messages=True
+    )
+
+
+def load_recent_messages(db, conversation_id: int, window: int = MEMORY_WINDOW) -> list:
+    """Last window user/assistant exchanges of a conversation, oldest first.
+
+    Only these rows are read and decrypted, whatever the length of the conversation.
+    """
+    rows = db.query(Message).filter(
+        Message.conversation_id == conversation_id
+    ).order_by(Message.timestamp.desc(), Message.id.desc()).limit(2 * window).all()
+    return list(reversed(rows))
+
+
+class ConversationMemoryStore:
+    """Conversation memories kept in a bounded list store with idle TTL, keyed by conversation id.
+
+    The store is in-process or shared between workers, see SHARED_STATE_BACKEND.
+    A missing or evicted memory is rebuilt from the conversation's last messages,
+    so eviction only costs one small query.
+    """
+
+    def __init__(self, max_size: int = CONVERSATION_MEMORY_CACHE_SIZE, ttl: float = CONVERSATION_MEMORY_TTL,
+                 window: int = MEMORY_WINDOW, backend: str = None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.window = window
+        # messages are encrypted at rest like in the database
+        self.store = make_list_store("conversation_memories", max_size, ttl,
+                                     encryptor=Message._encryptor, backend=backend)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def get(self, db, conversation_id: int):
+        """Returns the memory of a conversation, rehydrating it from the database on a miss."""
+        key = str(conversation_id)
+        hit = self.store.get(key) is not None
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+        if not hit:
+            items = [
+                {"type": "human" if msg.role == "user" else "ai", "content": msg.content}
+                for msg in load_recent_messages(db, conversation_id, self.window)
+                if msg.role in ("user", "assistant")
+            ]
+            # a worker that rehydrated it meanwhile wins, both read the same rows
+            self.store.create(key, items)
+
+        return new_memory(SharedChatMessageHistory(self.store, key, 2 * self.window), self.window)
+
+    def invalidate(self, conversation_id: int):
+        """Forgets a conversation's memory, used when the conversation is deleted."""
+        if self.store.delete(str(conversation_id)):
+            with self._lock:
+                self.invalidations += 1
+
+    def clear(self):
+        self.store.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "backend": type(self.store).__name__,
+                "size": self.store.size(),
+                "max_size": self.max_size,
+                "ttl_seconds": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.store.evictions,
+                "invalidations": self.invalidations,
+                "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+            }
+
+
+conversation_memories = ConversationMemoryStore()
@@ -0,0 +1,116 @@
+import os
+import hashlib
+import numpy as np
+from nlp.lexical import tokenize
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# chunks whose estimated Jaccard similarity of word shingles reaches this are near duplicates,
+# 0 turns detection off
+NEAR_DUPLICATE_THRESHOLD = float(os.getenv("NEAR_DUPLICATE_THRESHOLD", "0.8"))
+# words per shingle, single words would make every chunk on the same topic look alike
+SHINGLE_SIZE = 3
+
+# MinHash signatures of MINHASH_BANDS * MINHASH_ROWS values. Two chunks become candidates when
+# one band is equal, about 95% of pairs at 0.8 similarity and almost none under 0.5, then
+# candidates are checked against the threshold.
+MINHASH_BANDS = 16
+MINHASH_ROWS = 8
+
+_rng = np.random.default_rng(20240601)
+# multiply-shift hash functions, uint64 arithmetic wraps around
+_MULTIPLIERS = _rng.integers(1, 2 ** 63, size=MINHASH_BANDS * MINHASH_ROWS, dtype=np.uint64) | np.uint64(1)
+_OFFSETS = _rng.integers(0, 2 ** 63, size=MINHASH_BANDS * MINHASH_ROWS, dtype=np.uint64)
+
+
+def _shingle_hashes(text: str) -> np.ndarray:
+    """64 bit hashes of the word shingles of a text, tokenized like the lexical index.
+    Empty for texts shorter than one shingle."""
+    tokens = tokenize(text)
+    shingles = {" ".join(tokens[i:i + SHINGLE_SIZE]) for i in range(len(tokens) - SHINGLE_SIZE + 1)}
+    return np.array(
+        [int.from_bytes(hashlib.blake2b(s.encode("utf-8"), digest_size=8).digest(), "big") for s in shingles],
+        dtype=np.uint64,
+    )
+
+
+def minhash(text: str):
+    """MinHash signature of a text, equal positions estimate the Jaccard similarity of two texts.
+    None for texts shorter than one shingle, they have nothing to compare."""
+    hashes = _shingle_hashes(text)
+    if hashes.size == 0:
+        return None
+    with np.errstate(over="ignore"):
+        values = (hashes[:, None] * _MULTIPLIERS + _OFFSETS) >> np.uint64(32)
+    return values.min(axis=0)
+
+
+class NearDuplicateIndex:
+    """LSH index of MinHash signatures finding earlier texts similar to a new one."""
+
+    def __init__(self, threshold: float = NEAR_DUPLICATE_THRESHOLD):
+        self.threshold = threshold
+        self.bands = [{} for _ in range(MINHASH_BANDS)]  # band bytes -> [key]
+        self.signatures = {}  # key -> signature
+
+    def find_or_add(self, key, text: str):
+        """Returns the key of an earlier near duplicate of text, or adds text under key and returns None.
+        Texts shorter than SHINGLE_SIZE words are never duplicates and are not added."""
+        signature = minhash(text)
+        if signature is None:
+            return None
+        band_keys = [signature[i * MINHASH_ROWS:(i + 1) * MINHASH_ROWS].tobytes() for i in range(MINHASH_BANDS)]
+
+        checked = set()
+        for band, band_key in zip(self.bands, band_keys):
+            for other_key in band.get(band_key, ()):
+                if other_key in checked:
+                    continue
+                checked.add(other_key)
+                if np.mean(signature == self.signatures[other_key]) >= self.threshold:
+                    return other_key
+
+        self.signatures[key] = signature
+        for band, band_key in zip(self.bands, band_keys):
+            band.setdefault(band_key, []).append(key)
+        return None
+
+
+def mark_near_duplicates(chunks, threshold: float = NEAR_DUPLICATE_THRESHOLD):
+    """Yields chunks as they arrive, setting metadata["dup_of"] to the chunk_id of an earlier
+    near duplicate of the same document, if there is one."""
+    if threshold <= 0:
+        yield from chunks
+        return
+    index = NearDuplicateIndex(threshold)
+    for doc in chunks:
+        if not doc.page_content.strip():
+            yield doc
+            continue
+        original = index.find_or_add(doc.metadata["chunk_id"], doc.page_content)
+        if original is not None:
+            doc.metadata["dup_of"] = original
+        yield doc
+
+
+def rank_repeats_last(metadatas: list, k: int) -> list:
+    """Picks k results from metadatas, best first, and returns their indices.
+
+    A chunk whose near duplicate group (the original and its dup_of links) already has
+    a chunk among the picks gives way to the next results, it only fills the slots left
+    at the end. Chunks differing in an amount or a date stay retrievable.
+    """
+    picks, repeats, groups = [], [], set()
+    for i, metadata in enumerate(metadatas):
+        if len(picks) >= k:
+            break
+        metadata = metadata or {}
+        group = (metadata.get("file_id"), metadata.get("dup_of", metadata.get("chunk_id")))
+        if group in groups:
+            repeats.append(i)
+            continue
+        groups.add(group)
+        picks.append(i)
+    return picks + repeats[:k - len(picks)]
@@ -0,0 +1,244 @@
+import os
+import json
+import math
+import shutil
+import tempfile
+import numpy as np
+from langchain.schema import Document
+
+EMBEDDINGS_FILENAME = "embeddings.npy"
+NORMS_FILENAME = "norms.npy"
+CHUNKS_FILENAME = "chunks.json"
+
+# rows scored per matmul, bounds the float32 temporaries when the matrix is stored as float16
+BLOCK_ROWS = 16384
+
+
+def _matches(metadata: dict, where: dict) -> bool:
+    """Supports the metadata filters used by the app: equality and $in on top-level keys."""
+    for key, condition in where.items():
+        value = metadata.get(key)
+        if isinstance(condition, dict):
+            if "$in" in condition and value not in condition["$in"]:
+                return False
+            if "$eq" in condition and value != condition["$eq"]:
+                return False
+        elif value != condition:
+            return False
+    return True
+
+
+def _replace_file(persist_directory: str, filename: str, write_fn):
+    """Writes a store file through a temporary one, readers never see a partial file."""
+    path = os.path.join(persist_directory, filename)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        write_fn(f)
+    os.replace(tmp_path, path)
+
+
+class DenseVectorStore:
+    """Exact nearest-neighbour store over a memory-mapped .npy matrix of chunk embeddings.
+
+    For per-document stores of a few thousand chunks one matmul plus argpartition
+    is cheaper than going through chroma's client, SQLite and HNSW layers.
+    Distances are squared L2, like chroma's default, so relevance scores match.
+    """
+
+    def __init__(self, persist_directory: str, embedding_function=None):
+        self._persist_directory = persist_directory
+        self._embedding_function = embedding_function
+
+        matrix_path = os.path.join(persist_directory, EMBEDDINGS_FILENAME)
+        if not os.path.exists(matrix_path):
+            raise FileNotFoundError(f"Dense index does not exist: {matrix_path}")
+
+        # the OS pages the matrix in on demand and can share it between worker processes
+        self.matrix = np.load(matrix_path, mmap_mode="r")
+        self.norms = np.load(os.path.join(persist_directory, NORMS_FILENAME))
+        with open(os.path.join(persist_directory, CHUNKS_FILENAME), "r", encoding="utf-8") as f:
+            chunks = json.load(f)
+        self.ids = chunks["ids"]
+        self.texts = chunks["texts"]
+        self.metadatas = chunks["metadatas"]
+
+    @staticmethod
+    def exists(persist_directory: str) -> bool:
+        return os.path.exists(os.path.join(persist_directory, EMBEDDINGS_FILENAME))
+
+    @classmethod
+    def write(cls, persist_directory: str, ids: list, texts: list, embeddings, metadatas: list,
+              dtype: str = "float32"):
+        """Writes the matrix, norms and chunk data of a store. Files are replaced atomically."""
+        os.makedirs(persist_directory, exist_ok=True)
+        matrix = np.asarray(embeddings, dtype=np.float32)
+        if matrix.ndim != 2:
+            # an empty document has no rows to infer the dimension from
+            matrix = matrix.reshape(len(texts), -1) if len(texts) else np.zeros((0, 0), dtype=np.float32)
+        norms = np.einsum("ij,ij->i", matrix, matrix).astype(np.float32)
+
+        _replace_file(persist_directory, EMBEDDINGS_FILENAME, lambda f: np.save(f, matrix.astype(dtype)))
+        _replace_file(persist_directory, NORMS_FILENAME, lambda f: np.save(f, norms))
+        _replace_file(persist_directory, CHUNKS_FILENAME, lambda f: f.write(json.dumps(
+            {"ids": list(ids), "texts": list(texts), "metadatas": list(metadatas)}, ensure_ascii=False
+        ).encode("utf-8")))
+
+    @classmethod
+    def from_documents(cls, documents: list, embedding, persist_directory: str, ids: list = None,
+                       dtype: str = "float32"):
+        """Embeds the documents and writes a new store, mirroring Chroma.from_documents."""
+        texts = [doc.page_content for doc in documents]
+        metadatas = [dict(doc.metadata) for doc in documents]
+        ids = ids or [str(metadata.get("chunk_id", i)) for i, metadata in enumerate(metadatas)]
+        vectors = embedding.embed_documents(texts)
+        cls.write(persist_directory, ids, texts, vectors, metadatas, dtype=dtype)
+        return cls(persist_directory, embedding_function=embedding)
+
+    def _mapped(self) -> np.ndarray:
+        """Returns the memory map for one search, held by the caller until it finishes."""
+        matrix = self.matrix
+        if matrix is None:
+            raise ValueError(f"Dense index is closed: {self._persist_directory}")
+        return matrix
+
+    def _distances(self, matrix: np.ndarray, query: np.ndarray) -> np.ndarray:
+        # |x - q|^2 = |x|^2 + |q|^2 - 2 x.q, computed blockwise from the memory map
+        dots = np.empty(matrix.shape[0], dtype=np.float32)
+        for start in range(0, matrix.shape[0], BLOCK_ROWS):
+            block = np.asarray(matrix[start:start + BLOCK_ROWS], dtype=np.float32)
+            dots[start:start + BLOCK_ROWS] = block @ query
+        return np.maximum(self.norms + float(query @ query) - 2.0 * dots, 0.0)
+
+    def similarity_search_by_vector_with_relevance_scores(self, embedding, k: int = 4,
+                                                          filter: dict = None, **kwargs):
+        """Returns (Document, squared L2 distance) pairs, closest first."""
+        if len(self.ids) == 0:
+            return []
+        query = np.asarray(embedding, dtype=np.float32)
+        distances = self._distances(self._mapped(), query)
+
+        if filter:
+            mask = np.array([_matches(metadata, filter) for metadata in self.metadatas])
+            distances = np.where(mask, distances, np.inf)
+
+        k = min(k, distances.size)
+        candidates = np.argpartition(distances, k - 1)[:k]
+        candidates = candidates[np.argsort(distances[candidates], kind="stable")]
+        return [
+            (self._document(i), float(distances[i]))
+            for i in candidates.tolist() if np.isfinite(distances[i])
+        ]
+
+    def similarity_search_with_relevance_scores(self, query: str, k: int = 4, **kwargs):
+        embedding = self._embedding_function.embed_query(query)
+        results = self.similarity_search_by_vector_with_relevance_scores(embedding, k=k, **kwargs)
+        relevance_fn = self._select_relevance_score_fn()
+        return [(doc, relevance_fn(distance)) for doc, distance in results]
+
+    def _select_relevance_score_fn(self):
+        # same conversion as chroma's default l2 space
+        return lambda distance: 1.0 - distance / math.sqrt(2)
+
+    def _document(self, i: int) -> Document:
+        return Document(id=self.ids[i], page_content=self.texts[i], metadata=dict(self.metadatas[i]))
+
+    def get(self, ids: list = None, where: dict = None, include: list = None, **kwargs) -> dict:
+        """Returns stored chunks in the dict shape of Chroma.get."""
+        include = include or ["documents", "metadatas"]
+        matrix = self._mapped() if "embeddings" in include else None
+        positions = range(len(self.ids))
+        if ids is not None:
+            wanted = set(ids)
+            positions = [i for i in positions if self.ids[i] in wanted]
+        if where:
+            positions = [i for i in positions if _matches(self.metadatas[i], where)]
+        positions = list(positions)
+
+        result = {"ids": [self.ids[i] for i in positions]}
+        if "documents" in include:
+            result["documents"] = [self.texts[i] for i in positions]
+        if "metadatas" in include:
+            result["metadatas"] = [dict(self.metadatas[i]) for i in positions]
+        if "embeddings" in include:
+            result["embeddings"] = np.asarray(matrix[positions], dtype=np.float32)
+        return result
+
+    def close(self):
+        """Drops the store's reference to the memory map. Searches already running keep
+        their own reference, the mapping is released when the last of them finishes."""
+        self.matrix = None
+
+
+class DenseIndexWriter:
+    """Writes a store batch by batch for ingestion.
+
+    Vectors and chunk data are appended to temporary files in the store's directory
+    and commit turns them into the store's files, so the chunks of a large document
+    are never all in memory. The previous version stays readable until commit.
+    """
+
+    def __init__(self, persist_directory: str, dtype: str = "float32"):
+        os.makedirs(persist_directory, exist_ok=True)
+        self.persist_directory = persist_directory
+        self.dtype = dtype
+        self.count = 0
+        self.dimensions = None
+        self._vectors = tempfile.TemporaryFile(dir=persist_directory)  # float32 rows
+        # JSON values separated by commas, joined into chunks.json by commit
+        self._parts = {key: tempfile.TemporaryFile(dir=persist_directory) for key in ("ids", "texts", "metadatas")}
+
+    def add(self, ids: list, texts: list, vectors, metadatas: list):
+        if not ids:
+            return
+        rows = np.asarray(vectors, dtype=np.float32).reshape(len(ids), -1)
+        if self.dimensions is None:
+            self.dimensions = rows.shape[1]
+        elif rows.shape[1] != self.dimensions:
+            raise ValueError(f"Vectors of {rows.shape[1]} dimensions added to a {self.dimensions} dimension index")
+        self._vectors.write(rows.tobytes())
+        for key, values in (("ids", ids), ("texts", texts), ("metadatas", metadatas)):
+            part = self._parts[key]
+            for value in values:
+                if part.tell():
+                    part.write(b",")
+                part.write(json.dumps(value, ensure_ascii=False).encode("utf-8"))
+        self.count += len(ids)
+
+    def commit(self):
+        """Writes the matrix, norms and chunk data of the added chunks. Files are replaced atomically."""
+        rows, dimensions = self.count, self.dimensions or 0
+        norms = np.zeros(rows, dtype=np.float32)
+        matrix_path = os.path.join(self.persist_directory, EMBEDDINGS_FILENAME)
+        if rows and dimensions:
+            self._vectors.flush()
+            source = np.memmap(self._vectors, dtype=np.float32, mode="r", shape=(rows, dimensions))
+            matrix = np.lib.format.open_memmap(matrix_path + ".tmp", mode="w+", dtype=self.dtype,
+                                               shape=(rows, dimensions))
+            for start in range(0, rows, BLOCK_ROWS):
+                block = np.asarray(source[start:start + BLOCK_ROWS])
+                matrix[start:start + BLOCK_ROWS] = block
+                norms[start:start + BLOCK_ROWS] = np.einsum("ij,ij->i", block, block)
+            matrix.flush()
+            del matrix, source  # unmapped before the file is moved
+            os.replace(matrix_path + ".tmp", matrix_path)
+        else:
+            _replace_file(self.persist_directory, EMBEDDINGS_FILENAME,
+                          lambda f: np.save(f, np.zeros((rows, dimensions), dtype=self.dtype)))
+        _replace_file(self.persist_directory, NORMS_FILENAME, lambda f: np.save(f, norms))
+
+        def write_chunks(f):
+            for i, key in enumerate(("ids", "texts", "metadatas")):
+                f.write(f'{", " if i else "{"}"{key}": ['.encode("utf-8"))
+                part = self._parts[key]
+                part.seek(0)
+                shutil.copyfileobj(part, f)
+                f.write(b"]")
+            f.write(b"}")
+
+        _replace_file(self.persist_directory, CHUNKS_FILENAME, write_chunks)
+
+    def close(self):
+        """Removes the temporary files, after commit or when ingestion failed."""
+        self._vectors.close()
+        for part in self._parts.values():
+            part.close()
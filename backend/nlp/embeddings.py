@@ -0,0 +1,462 @@
+import os
+import re
+import time
+import hashlib
+import sqlite3
+import threading
+import unicodedata
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import openai
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_random_exponential
+from langchain_core.embeddings import Embeddings
+from langchain_openai import OpenAIEmbeddings
+from nlp.concurrency import run_blocking, embeddings_semaphore
+from nlp.tokens import count_tokens
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+EMBEDDING_MODEL = "text-embedding-3-small"
+
+QUERY_EMBEDDING_CACHE_SIZE = int(os.getenv("QUERY_EMBEDDING_CACHE_SIZE", "2048"))
+# path of the sqlite file for the on-disk tier, the tier is disabled when unset
+QUERY_EMBEDDING_CACHE_PATH = os.getenv("QUERY_EMBEDDING_CACHE_PATH")
+
+# content-addressed store of chunk embeddings, lets re-uploads skip chunks embedded before
+CHUNK_EMBEDDING_STORE_PATH = os.getenv("CHUNK_EMBEDDING_STORE_PATH", "./vectorstore/_chunk_embeddings.sqlite")
+CHUNK_EMBEDDING_STORE_MAX_MB = float(os.getenv("CHUNK_EMBEDDING_STORE_MAX_MB", "512"))
+
+# ingestion batches chunks up to EMBED_BATCH_TOKENS tokens (the API takes at most 2048 inputs
+# per request) and keeps EMBED_CONCURRENCY requests in flight
+EMBED_BATCH_TOKENS = int(os.getenv("EMBED_BATCH_TOKENS", "20000"))
+EMBED_BATCH_MAX_INPUTS = 2048
+EMBED_CONCURRENCY = int(os.getenv("EMBED_CONCURRENCY", "4"))
+# attempts per batch on rate limits and transient API errors, with exponential backoff
+EMBED_MAX_ATTEMPTS = int(os.getenv("EMBED_MAX_ATTEMPTS", "6"))
+
+_TRANSIENT_API_ERRORS = (
+    openai.RateLimitError,
+    openai.APIConnectionError,
+    openai.APITimeoutError,
+    openai.InternalServerError,
+)
+
+_WHITESPACE_RE = re.compile(r"\s+")
+
+_embeddings = None
+_embeddings_lock = threading.Lock()
+
+
+def normalize_query(text: str) -> str:
+    """Normalizes a question so trivially different spellings share a cache entry."""
+    text = unicodedata.normalize("NFC", text)
+    return _WHITESPACE_RE.sub(" ", text).strip().lower()
+
+
+def _to_blob(vector) -> bytes:
+    return np.asarray(vector, dtype=np.float32).tobytes()
+
+
+def _from_blob(blob: bytes) -> list:
+    return np.frombuffer(blob, dtype=np.float32).tolist()
+
+
+class _ThreadLocalConnection:
+    """One sqlite connection per thread, sqlite connections can't be shared between threads."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+    def get(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+
+class QueryEmbeddingCache:
+    """Two-tier cache of query embeddings: in-memory LRU and an optional sqlite file."""
+
+    def __init__(self, max_size: int = QUERY_EMBEDDING_CACHE_SIZE, path: str = QUERY_EMBEDDING_CACHE_PATH):
+        self.max_size = max_size
+        self.path = path
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._db = _ThreadLocalConnection(path) if path else None
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+        if self._db:
+            with self._db.get() as conn:
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS query_embeddings ("
+                    "key TEXT PRIMARY KEY, vector BLOB NOT NULL)"
+                )
+
+    @staticmethod
+    def make_key(model: str, text: str) -> str:
+        return f"{model}:{normalize_query(text)}"
+
+    def _remember(self, key: str, vector: list):
+        with self._lock:
+            self._entries[key] = vector
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def get(self, key: str):
+        with self._lock:
+            vector = self._entries.get(key)
+            if vector is not None:
+                self._entries.move_to_end(key)
+                self.memory_hits += 1
+                return vector
+
+        if self._db:
+            row = self._db.get().execute(
+                "SELECT vector FROM query_embeddings WHERE key = ?", (key,)
+            ).fetchone()
+            if row is not None:
+                vector = _from_blob(row[0])
+                self._remember(key, vector)
+                with self._lock:
+                    self.disk_hits += 1
+                return vector
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, key: str, vector: list):
+        self._remember(key, vector)
+        if self._db:
+            with self._db.get() as conn:
+                conn.execute(
+                    "INSERT OR REPLACE INTO query_embeddings (key, vector) VALUES (?, ?)",
+                    (key, _to_blob(vector)),
+                )
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.memory_hits + self.disk_hits + self.misses
+            hits = self.memory_hits + self.disk_hits
+            return {
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "disk_tier": bool(self.path),
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_ratio": round(hits / lookups, 4) if lookups else 0.0,
+            }
+
+
+query_embedding_cache = QueryEmbeddingCache()
+
+
+class ChunkEmbeddingStore:
+    """Content-addressed sqlite store of chunk embeddings keyed by hash of (model, chunk text).
+
+    Entries are evicted least recently used first once the vectors exceed max_bytes.
+    """
+
+    def __init__(self, path: str = CHUNK_EMBEDDING_STORE_PATH,
+                 max_bytes: int = int(CHUNK_EMBEDDING_STORE_MAX_MB * 1024 * 1024)):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._db = _ThreadLocalConnection(path)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        with self._db.get() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS chunk_embeddings ("
+                "key TEXT PRIMARY KEY, vector BLOB NOT NULL, "
+                "size INTEGER NOT NULL, last_used REAL NOT NULL)"
+            )
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_chunk_embeddings_last_used "
+                "ON chunk_embeddings (last_used)"
+            )
+
+    @staticmethod
+    def make_key(model: str, text: str) -> str:
+        return hashlib.sha256(f"{model}\0{text}".encode("utf-8")).hexdigest()
+
+    def get_many(self, keys: list) -> dict:
+        """Returns {key: vector} for the keys present in the store and marks them as used."""
+        found = {}
+        conn = self._db.get()
+        unique_keys = list(dict.fromkeys(keys))
+        # stay under sqlite's limit of host parameters per statement
+        for start in range(0, len(unique_keys), 500):
+            batch = unique_keys[start:start + 500]
+            placeholders = ",".join("?" * len(batch))
+            rows = conn.execute(
+                f"SELECT key, vector FROM chunk_embeddings WHERE key IN ({placeholders})", batch
+            ).fetchall()
+            for key, blob in rows:
+                found[key] = _from_blob(blob)
+
+        if found:
+            now = time.time()
+            with conn:
+                conn.executemany(
+                    "UPDATE chunk_embeddings SET last_used = ? WHERE key = ?",
+                    [(now, key) for key in found],
+                )
+
+        with self._lock:
+            self.hits += len(found)
+            self.misses += len(unique_keys) - len(found)
+        return found
+
+    def put_many(self, items: dict):
+        """Stores {key: vector} and evicts old entries if the store grew past its size limit."""
+        if not items:
+            return
+        now = time.time()
+        rows = []
+        for key, vector in items.items():
+            blob = _to_blob(vector)
+            rows.append((key, blob, len(blob), now))
+        with self._db.get() as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO chunk_embeddings (key, vector, size, last_used) VALUES (?, ?, ?, ?)",
+                rows,
+            )
+        self._evict()
+
+    def _evict(self):
+        conn = self._db.get()
+        total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM chunk_embeddings").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+
+        # evict down to 90% of the limit so every insert doesn't trigger another eviction
+        to_free = total - int(self.max_bytes * 0.9)
+        freed = 0
+        victims = []
+        for key, size in conn.execute("SELECT key, size FROM chunk_embeddings ORDER BY last_used"):
+            victims.append((key,))
+            freed += size
+            if freed >= to_free:
+                break
+        with conn:
+            conn.executemany("DELETE FROM chunk_embeddings WHERE key = ?", victims)
+        with self._lock:
+            self.evictions += len(victims)
+        print(f"Evicted {len(victims)} chunk embeddings ({freed} bytes)")
+
+    def stats(self) -> dict:
+        entries, total = self._db.get().execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM chunk_embeddings"
+        ).fetchone()
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": entries,
+                "bytes": total,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+            }
+
+
+_chunk_store = None
+_chunk_store_lock = threading.Lock()
+
+
+def get_chunk_embedding_store() -> ChunkEmbeddingStore:
+    """Returns the process-wide chunk embedding store, created on first use."""
+    global _chunk_store
+    with _chunk_store_lock:
+        if _chunk_store is None:
+            _chunk_store = ChunkEmbeddingStore()
+        return _chunk_store
+
+
+class CachedEmbeddings(Embeddings):
+    """Embeddings wrapper that serves repeated questions from the query embedding cache
+    and chunks embedded before from the chunk embedding store."""
+
+    def __init__(self, embeddings: Embeddings, model: str = EMBEDDING_MODEL,
+                 query_cache: QueryEmbeddingCache = query_embedding_cache, chunk_store=None):
+        self.embeddings = embeddings
+        self.model = model
+        self.query_cache = query_cache
+        self._chunk_store = chunk_store
+
+    @property
+    def chunk_store(self) -> ChunkEmbeddingStore:
+        return self._chunk_store or get_chunk_embedding_store()
+
+    def embed_documents(self, texts: list) -> list:
+        store = self.chunk_store
+        keys = [store.make_key(self.model, text) for text in texts]
+        vectors = store.get_many(keys)
+
+        # embed each unseen text once, even if it appears several times in the batch
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in vectors and key not in missing:
+                missing[key] = text
+        if missing:
+            new_vectors = self.embeddings.embed_documents(list(missing.values()))
+            new_items = dict(zip(missing.keys(), new_vectors))
+            store.put_many(new_items)
+            vectors.update(new_items)
+
+        print(f"Embedded {len(missing)} new chunks, reused {len(texts) - len(missing)} stored embeddings")
+        return [vectors[key] for key in keys]
+
+    def embed_query(self, text: str) -> list:
+        key = self.query_cache.make_key(self.model, text)
+        vector = self.query_cache.get(key)
+        if vector is None:
+            vector = self.embeddings.embed_query(text)
+            self.query_cache.put(key, vector)
+        return vector
+
+    async def aembed_query(self, text: str) -> list:
+        key = self.query_cache.make_key(self.model, text)
+        if self.query_cache.path:
+            vector = await run_blocking(self.query_cache.get, key)
+        else:
+            vector = self.query_cache.get(key)
+        if vector is None:
+            async with embeddings_semaphore:
+                vector = await self.embeddings.aembed_query(text)
+            await run_blocking(self.query_cache.put, key, vector)
+        return vector
+
+    async def aembed_queries(self, texts: list) -> list:
+        """Embeds several questions, those not in the query cache in a single request."""
+        keys = [self.query_cache.make_key(self.model, text) for text in texts]
+        if self.query_cache.path:
+            vectors = await run_blocking(lambda: [self.query_cache.get(key) for key in keys])
+        else:
+            vectors = [self.query_cache.get(key) for key in keys]
+
+        missing = {}
+        for key, text, vector in zip(keys, texts, vectors):
+            if vector is None and key not in missing:
+                missing[key] = text
+        if missing:
+            # the embeddings endpoint takes a list of inputs, questions are embedded like chunks
+            async with embeddings_semaphore:
+                new_vectors = await self.embeddings.aembed_documents(list(missing.values()))
+            new_items = dict(zip(missing.keys(), new_vectors))
+            await run_blocking(lambda: [self.query_cache.put(key, vector) for key, vector in new_items.items()])
+            vectors = [vector if vector is not None else new_items[key] for key, vector in zip(keys, vectors)]
+        return vectors
+
+    async def aembed_documents(self, texts: list) -> list:
+        # the chunk store is sqlite, the whole lookup/embed/store cycle runs off the event loop
+        return await run_blocking(self.embed_documents, texts)
+
+
+def get_embeddings() -> CachedEmbeddings:
+    """Returns the embeddings client shared by every vectorstore of the process."""
+    global _embeddings
+    with _embeddings_lock:
+        if _embeddings is None:
+            _embeddings = CachedEmbeddings(OpenAIEmbeddings(model=EMBEDDING_MODEL))
+        return _embeddings
+
+
+def embed_question(question: str) -> list:
+    """Embeds a question once so every retriever of a request can reuse the vector."""
+    return get_embeddings().embed_query(question)
+
+
+async def aembed_question(question: str) -> list:
+    """Async variant of embed_question."""
+    return await get_embeddings().aembed_query(question)
+
+
+async def aembed_questions(questions: list) -> list:
+    """Embeds a batch of questions in one request, see CachedEmbeddings.aembed_queries."""
+    return await get_embeddings().aembed_queries(questions)
+
+
+def batch_by_tokens(items, text_of, max_tokens: int = EMBED_BATCH_TOKENS,
+                    max_items: int = EMBED_BATCH_MAX_INPUTS):
+    """Groups items into lists whose texts add up to at most max_tokens tokens."""
+    batch = []
+    batch_tokens = 0
+    for item in items:
+        tokens = count_tokens(text_of(item), EMBEDDING_MODEL)
+        if batch and (batch_tokens + tokens > max_tokens or len(batch) >= max_items):
+            yield batch
+            batch = []
+            batch_tokens = 0
+        batch.append(item)
+        batch_tokens += tokens
+    if batch:
+        yield batch
+
+
+def _log_retry(retry_state):
+    print(f"Embedding request failed ({retry_state.outcome.exception()}), "
+          f"retry {retry_state.attempt_number} of {EMBED_MAX_ATTEMPTS - 1}")
+
+
+@retry(
+    retry=retry_if_exception_type(_TRANSIENT_API_ERRORS),
+    wait=wait_random_exponential(multiplier=1, max=60),
+    stop=stop_after_attempt(EMBED_MAX_ATTEMPTS),
+    before_sleep=_log_retry,
+    reraise=True,
+)
+def embed_with_retry(texts: list) -> list:
+    """Embeds chunk texts, retrying rate limits and transient API errors with backoff."""
+    if not texts:
+        return []
+    return get_embeddings().embed_documents(texts)
+
+
+_embedding_executor = None
+
+
+def embed_batches(batches, texts_of, concurrency: int = EMBED_CONCURRENCY):
+    """Embeds batches concurrently and yields (batch, vectors) in the order of the batches.
+
+    texts_of(batch) returns the texts to embed for a batch. At most concurrency
+    requests are in flight and the next batch is only pulled from the iterator
+    when one finishes, so lazy inputs stay lazy.
+    """
+    global _embedding_executor
+    with _embeddings_lock:
+        if _embedding_executor is None:
+            _embedding_executor = ThreadPoolExecutor(max_workers=EMBED_CONCURRENCY, thread_name_prefix="embed")
+
+    pending = deque()
+    batches = iter(batches)
+    try:
+        for batch in batches:
+            pending.append((batch, _embedding_executor.submit(embed_with_retry, texts_of(batch))))
+            if len(pending) >= concurrency:
+                break
+        while pending:
+            batch, future = pending.popleft()
+            vectors = future.result()
+            for next_batch in batches:
+                pending.append((next_batch, _embedding_executor.submit(embed_with_retry, texts_of(next_batch))))
+                break
+            yield batch, vectors
+    finally:
+        for _, future in pending:
+            future.cancel()
@@ -0,0 +1,67 @@
+import numpy as np
+
+FUSION_MODES = ("weighted", "rrf")
+
+# weights of the original hybrid search (70% semantic, 30% lexical)
+SEMANTIC_WEIGHT = 0.7
+LEXICAL_WEIGHT = 0.3
+
+# standard constant from the reciprocal rank fusion paper, damps the advantage of the very first ranks
+RRF_K = 60
+
+
+def top_k_positions(scores, k: int):
+    """Returns the positions of the k highest scores, best first."""
+    scores = np.asarray(scores, dtype=np.float32)
+    if scores.size == 0 or k <= 0:
+        return np.empty(0, dtype=np.int64)
+    if k < scores.size:
+        candidates = np.argpartition(-scores, k - 1)[:k]
+    else:
+        candidates = np.arange(scores.size)
+    return candidates[np.argsort(-scores[candidates], kind="stable")]
+
+
+def fuse_scores(semantic_positions, semantic_scores, lexical_scores, lexical_positions,
+                mode: str = "weighted", semantic_weight: float = SEMANTIC_WEIGHT,
+                lexical_weight: float = LEXICAL_WEIGHT):
+    """Fuses semantic and lexical results joined by chunk position.
+
+    semantic_positions/semantic_scores are the semantic hits (best first),
+    lexical_scores holds the BM25 score of every chunk and lexical_positions
+    the lexical candidates (best first). Returns (positions, fused_scores)
+    sorted by fused score.
+    """
+    if mode not in FUSION_MODES:
+        raise ValueError(f"Unknown fusion mode: {mode}")
+
+    semantic_positions = np.asarray(semantic_positions, dtype=np.int64)
+    lexical_positions = np.asarray(lexical_positions, dtype=np.int64)
+    lexical_scores = np.asarray(lexical_scores, dtype=np.float32)
+
+    candidates = np.union1d(semantic_positions, lexical_positions)
+    if candidates.size == 0:
+        return candidates, np.empty(0, dtype=np.float32)
+
+    # row of each candidate in the fused arrays
+    sem_rows = np.searchsorted(candidates, semantic_positions)
+    lex_rows = np.searchsorted(candidates, lexical_positions)
+
+    if mode == "weighted":
+        semantic = np.zeros(candidates.size, dtype=np.float32)
+        semantic[sem_rows] = np.asarray(semantic_scores, dtype=np.float32)
+
+        max_lexical = lexical_scores.max() if lexical_scores.size else 0.0
+        if max_lexical > 0:
+            lexical = lexical_scores[candidates] / max_lexical
+        else:
+            lexical = np.zeros(candidates.size, dtype=np.float32)
+
+        fused = semantic_weight * semantic + lexical_weight * lexical
+    else:
+        fused = np.zeros(candidates.size, dtype=np.float32)
+        fused[sem_rows] += 1.0 / (RRF_K + np.arange(1, sem_rows.size + 1))
+        fused[lex_rows] += 1.0 / (RRF_K + np.arange(1, lex_rows.size + 1))
+
+    order = np.argsort(-fused, kind="stable")
+    return candidates[order], fused[order]
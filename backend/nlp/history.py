@@ -0,0 +1,106 @@
+import os
+import threading
+from sqlalchemy.exc import IntegrityError
+from database.db import SessionLocal
+from conversations.models import Message, ConversationSummary
+from nlp.conversation_memory import MEMORY_WINDOW
+from nlp.concurrency import run_blocking
+from nlp.utils import agenerate_history_summary
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# messages that fell out of the memory window are folded into the running summary once there
+# are at least this many of them, a higher value means fewer LLM calls but a longer gap
+HISTORY_COMPACT_MIN_MESSAGES = int(os.getenv("HISTORY_COMPACT_MIN_MESSAGES", "2"))
+# most messages folded by one LLM call, older conversations catch up over several calls
+HISTORY_COMPACT_BATCH = 20
+
+# conversations being compacted by this process
+_compacting = set()
+_compacting_lock = threading.Lock()
+
+
+def load_history_summary(db, conversation_id: int):
+    """Returns the running summary of a conversation's older turns, or None if there is none yet."""
+    row = db.query(ConversationSummary).filter(ConversationSummary.conversation_id == conversation_id).first()
+    return row.summary if row is not None and row.encrypted_summary else None
+
+
+def load_pending_turns(db, conversation_id: int, window: int = MEMORY_WINDOW):
+    """Returns (summary, covered_message_id, last_message_id, turns) of a conversation.
+
+    turns are the (role, content) of the messages past the summary that already fell
+    out of the memory window, oldest first, at most HISTORY_COMPACT_BATCH of them,
+    and last_message_id the last of them. last_message_id is None while fewer than
+    HISTORY_COMPACT_MIN_MESSAGES are waiting.
+    """
+    row = db.query(ConversationSummary).filter(ConversationSummary.conversation_id == conversation_id).first()
+    covered = row.covered_message_id if row is not None else 0
+    summary = row.summary if row is not None and row.encrypted_summary else None
+
+    # messages past the summary in memory order, the newest 2 * window stay verbatim
+    rows = db.query(Message).filter(
+        Message.conversation_id == conversation_id,
+        Message.id > covered
+    ).order_by(Message.timestamp, Message.id).all()
+    rows = rows[:max(len(rows) - 2 * window, 0)][:HISTORY_COMPACT_BATCH]
+    if len(rows) < HISTORY_COMPACT_MIN_MESSAGES:
+        return summary, covered, None, []
+    turns = [(msg.role, msg.content) for msg in rows if msg.role in ("user", "assistant")]
+    return summary, covered, rows[-1].id, turns
+
+
+def save_history_summary(db, conversation_id: int, covered: int, summary: str, covered_message_id: int) -> bool:
+    """Stores the new summary unless another worker advanced it from covered meanwhile."""
+    row = db.query(ConversationSummary).filter(ConversationSummary.conversation_id == conversation_id).first()
+    current = row.covered_message_id if row is not None else 0
+    if current != covered:
+        return False
+    if row is None:
+        row = ConversationSummary(conversation_id=conversation_id)
+        db.add(row)
+    if summary is not None:
+        row.summary = summary
+    row.covered_message_id = covered_message_id
+    try:
+        db.commit()
+    except IntegrityError:
+        # another worker created the summary first
+        db.rollback()
+        return False
+    return True
+
+
+async def acompact_history(conversation_id: int, window: int = MEMORY_WINDOW):
+    """Background task folding the turns older than the memory window into the conversation's summary.
+
+    Only the messages added since the last update are sent to the LLM, with the
+    current summary. Runs after each saved answer, concurrent runs for the same
+    conversation in one process are skipped.
+    """
+    with _compacting_lock:
+        if conversation_id in _compacting:
+            return
+        _compacting.add(conversation_id)
+
+    db = SessionLocal()
+    try:
+        while True:
+            summary, covered, last_id, turns = await run_blocking(load_pending_turns, db, conversation_id, window)
+            if last_id is None:
+                return
+            if turns:
+                summary = await agenerate_history_summary(summary, turns)
+                if summary is None:
+                    return
+            if not await run_blocking(save_history_summary, db, conversation_id, covered, summary, last_id):
+                return
+            print(f"Conversation {conversation_id}: {len(turns)} messages folded into the history summary")
+    except Exception as e:
+        print(f"Error compacting history of conversation {conversation_id}: {e}")
+    finally:
+        with _compacting_lock:
+            _compacting.discard(conversation_id)
+        db.close()
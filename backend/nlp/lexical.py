@@ -0,0 +1,270 @@
+import os
+import re
+import time
+import pickle
+import threading
+import unicodedata
+from collections import OrderedDict
+from rank_bm25 import BM25Okapi
+from langchain.schema import Document
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+INDEX_FILENAME = "bm25_index.pkl"
+INDEX_VERSION = 3
+
+# small stopword lists, stored without diacritics since tokens are folded
+STOPWORDS = {
+    # english
+    "a", "an", "the", "and", "or", "but", "if", "of", "to", "in", "on", "at", "by",
+    "for", "with", "from", "as", "is", "are", "was", "were", "be", "been", "being",
+    "it", "its", "this", "that", "these", "those", "what", "which", "who", "whom",
+    "how", "why", "when", "where", "do", "does", "did", "can", "could", "should",
+    "would", "will", "shall", "may", "might", "not", "no", "so", "than", "then",
+    "there", "their", "they", "them", "he", "she", "we", "you", "i", "me", "my",
+    "our", "your", "his", "her", "about", "into", "also", "have", "has", "had",
+    # romanian
+    "si", "sau", "dar", "ca", "sa", "de", "la", "in", "din", "pe", "cu", "pentru",
+    "prin", "despre", "fara", "intre", "este", "sunt", "era", "fi", "fost", "au",
+    "am", "ai", "are", "avea", "un", "o", "unei", "unui", "niste", "cel", "cea",
+    "cei", "cele", "al", "ale", "lui", "ei", "el", "ea", "ele", "eu", "tu", "noi",
+    "voi", "se", "nu", "mai", "ce", "cum", "care", "cine", "cand", "unde", "daca",
+    "acest", "aceasta", "acesta", "aceste", "acestei", "acestui", "acel", "acea",
+    "iar", "ori", "deci", "doar", "tot", "toate", "toti", "fiecare", "ne", "va",
+    "le", "li", "mi", "ti", "isi", "imi", "iti", "m", "s", "n", "l",
+}
+
+_TOKEN_RE = re.compile(r"\w+", re.UNICODE)
+
+# romanian texts often use cedilla forms instead of the correct comma-below letters
+_CEDILLA_MAP = str.maketrans({"ş": "ș", "Ş": "Ș", "ţ": "ț", "Ţ": "Ț"})
+
+# in-memory LRU of loaded indexes with idle TTL, keyed by absolute persist dir. An index holds
+# every chunk text of its document, so only the recently searched documents are kept.
+# Entries carry the stamp of the file they were loaded from, an index rewritten by another
+# worker is reloaded on the next lookup.
+LEXICAL_INDEX_CACHE_SIZE = int(os.getenv("LEXICAL_INDEX_CACHE_SIZE", "32"))
+LEXICAL_INDEX_CACHE_TTL = float(os.getenv("LEXICAL_INDEX_CACHE_TTL", "900"))  # seconds of inactivity
+_loaded_indexes = OrderedDict()  # key -> (index, stamp, last_used)
+_indexes_lock = threading.Lock()
+_index_evictions = 0
+
+# indexes over several documents for cross-document questions, keyed by tuple of persist dirs
+COMBINED_INDEX_CACHE_SIZE = 16
+_combined_indexes = OrderedDict()  # key -> (index, stamps of the parts)
+
+
+def _fold_diacritics(text: str) -> str:
+    """Removes diacritics so 'învățare' and 'invatare' produce the same token."""
+    decomposed = unicodedata.normalize("NFKD", text)
+    return "".join(ch for ch in decomposed if not unicodedata.combining(ch))
+
+
+def tokenize(text: str) -> list:
+    """Tokenizes Romanian or English text for lexical search."""
+    text = _fold_diacritics(text.translate(_CEDILLA_MAP).lower())
+    return [
+        token for token in _TOKEN_RE.findall(text)
+        if token not in STOPWORDS and (len(token) > 1 or token.isdigit())
+    ]
+
+
+class LexicalIndex:
+    """BM25 index over the chunks of one document, with the chunk data needed to rebuild results."""
+
+    def __init__(self, chunk_ids: list, texts: list, metadatas: list):
+        self.chunk_ids = list(chunk_ids)
+        self.texts = list(texts)
+        self.metadatas = list(metadatas)
+        # (file_id, chunk_id) -> position, file_id keeps keys unique in combined indexes
+        self.positions = {
+            (metadata.get("file_id"), chunk_id): i
+            for i, (chunk_id, metadata) in enumerate(zip(self.chunk_ids, self.metadatas))
+        }
+        # tokens are produced one chunk at a time, BM25Okapi only keeps their counts.
+        # It divides by the corpus size, an empty document has nothing to index
+        self.bm25 = BM25Okapi(tokenize(text) for text in self.texts) if self.texts else None
+
+    def position_of(self, metadata: dict):
+        """Returns the position of the chunk described by a search hit's metadata, or None."""
+        return self.positions.get((metadata.get("file_id"), metadata.get("chunk_id")))
+
+    def get_scores(self, question: str):
+        """Returns the BM25 score of every chunk, in the order of chunk_ids."""
+        if self.bm25 is None:
+            return []
+        return self.bm25.get_scores(tokenize(question))
+
+    def get_scores_at(self, question: str, positions: list):
+        """Returns the BM25 scores of the chunks at the given positions only."""
+        if self.bm25 is None or not len(positions):
+            return []
+        return self.bm25.get_batch_scores(tokenize(question), list(positions))
+
+    def get_document(self, position: int):
+        """Rebuilds the chunk at the given position as a langchain Document."""
+        return Document(page_content=self.texts[position], metadata=dict(self.metadatas[position]))
+
+    def __len__(self):
+        return len(self.chunk_ids)
+
+
+def _index_stamp(key: str):
+    """Version of the saved index of a document: mtime and size of its file, None if there is none."""
+    try:
+        stat = os.stat(_index_path(key))
+    except OSError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+
+def _cached_index(key: str):
+    """Returns a loaded index and marks it used, or None. Drops expired indexes first,
+    and the index of key if its file changed since it was loaded."""
+    global _index_evictions
+    now = time.monotonic()
+    stamp = _index_stamp(key)
+    with _indexes_lock:
+        expired = [k for k, (_, _, last_used) in _loaded_indexes.items() if now - last_used > LEXICAL_INDEX_CACHE_TTL]
+        for k in expired:
+            del _loaded_indexes[k]
+        _index_evictions += len(expired)
+        entry = _loaded_indexes.get(key)
+        if entry is None:
+            return None
+        if entry[1] != stamp:
+            _forget(key)
+            return None
+        _loaded_indexes[key] = (entry[0], entry[1], now)
+        _loaded_indexes.move_to_end(key)
+        return entry[0]
+
+
+def _forget(key: str):
+    """Drops the index of a document and the combined indexes using it. Called with the lock held."""
+    _loaded_indexes.pop(key, None)
+    for combined_key in [k for k in _combined_indexes if key in k]:
+        del _combined_indexes[combined_key]
+
+
+def _remember_index(key: str, index: LexicalIndex, stamp):
+    global _index_evictions
+    with _indexes_lock:
+        _loaded_indexes[key] = (index, stamp, time.monotonic())
+        _loaded_indexes.move_to_end(key)
+        while len(_loaded_indexes) > LEXICAL_INDEX_CACHE_SIZE:
+            _loaded_indexes.popitem(last=False)
+            _index_evictions += 1
+
+
+def lexical_index_cache_stats() -> dict:
+    with _indexes_lock:
+        return {
+            "size": len(_loaded_indexes),
+            "max_size": LEXICAL_INDEX_CACHE_SIZE,
+            "ttl_seconds": LEXICAL_INDEX_CACHE_TTL,
+            "evictions": _index_evictions,
+            "combined_size": len(_combined_indexes),
+        }
+
+
+def _index_path(persist_dir: str) -> str:
+    return os.path.join(persist_dir, INDEX_FILENAME)
+
+
+def build_lexical_index(persist_dir: str, docs) -> LexicalIndex:
+    """Builds the BM25 index for the chunks of a document and saves it next to the vectorstore.
+    docs can be any iterable of chunks, it is read once."""
+    chunk_ids, texts, metadatas = [], [], []
+    for i, doc in enumerate(docs):
+        chunk_ids.append(doc.metadata.get("chunk_id", i))
+        texts.append(doc.page_content)
+        metadatas.append(dict(doc.metadata))
+    index = LexicalIndex(chunk_ids, texts, metadatas)
+
+    os.makedirs(persist_dir, exist_ok=True)
+    tmp_path = _index_path(persist_dir) + ".tmp"
+    with open(tmp_path, "wb") as f:
+        pickle.dump({"version": INDEX_VERSION, "index": index}, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, _index_path(persist_dir))  # atomic, readers never see a partial file
+
+    key = os.path.abspath(persist_dir)
+    with _indexes_lock:
+        # combined indexes still hold the chunks of the previous version
+        _forget(key)
+    _remember_index(key, index, _index_stamp(key))
+
+    print(f"Lexical index with {len(index)} chunks saved in {persist_dir}")
+    return index
+
+
+def _build_from_vectorstore(persist_dir: str, vectorstore) -> LexicalIndex:
+    """Builds the index for stores created before lexical indexes were saved at ingestion."""
+    all_docs = vectorstore.get(include=["documents", "metadatas"])
+    docs = [
+        Document(page_content=text, metadata=metadata or {})
+        for text, metadata in zip(all_docs["documents"], all_docs["metadatas"])
+    ]
+    docs.sort(key=lambda doc: doc.metadata.get("chunk_id", 0))
+    return build_lexical_index(persist_dir, docs)
+
+
+def get_lexical_index(persist_dir: str, vectorstore=None) -> LexicalIndex:
+    """Returns the lexical index for a document, loading it from disk on first use."""
+    key = os.path.abspath(persist_dir)
+    index = _cached_index(key)
+    if index is not None:
+        return index
+
+    path = _index_path(persist_dir)
+    # stamped before reading, a file replaced meanwhile is reloaded on the next lookup
+    stamp = _index_stamp(key)
+    if stamp is not None:
+        with open(path, "rb") as f:
+            data = pickle.load(f)
+        if data.get("version") == INDEX_VERSION:
+            index = data["index"]
+            _remember_index(key, index, stamp)
+            return index
+        print(f"Lexical index in {persist_dir} has an old format, rebuilding")
+
+    if vectorstore is None:
+        raise FileNotFoundError(f"Lexical index does not exist: {path}")
+    return _build_from_vectorstore(persist_dir, vectorstore)
+
+
+def get_combined_lexical_index(parts: list) -> LexicalIndex:
+    """Returns one BM25 index over several documents, parts being (persist_dir, vectorstore) pairs.
+
+    Scores from separate indexes aren't comparable (each has its own IDF), so
+    the chunks are indexed together. Combined indexes are kept in a small LRU.
+    """
+    key = tuple(sorted(os.path.abspath(persist_dir) for persist_dir, _ in parts))
+    stamps = tuple(_index_stamp(part_key) for part_key in key)
+    with _indexes_lock:
+        entry = _combined_indexes.get(key)
+        if entry is not None and entry[1] == stamps:
+            _combined_indexes.move_to_end(key)
+            return entry[0]
+
+    chunk_ids, texts, metadatas = [], [], []
+    for persist_dir, vectorstore in parts:
+        part = get_lexical_index(persist_dir, vectorstore)
+        chunk_ids.extend(part.chunk_ids)
+        texts.extend(part.texts)
+        metadatas.extend(part.metadatas)
+    index = LexicalIndex(chunk_ids, texts, metadatas)
+
+    with _indexes_lock:
+        _combined_indexes[key] = (index, stamps)
+        while len(_combined_indexes) > COMBINED_INDEX_CACHE_SIZE:
+            _combined_indexes.popitem(last=False)
+    return index
+
+
+def drop_lexical_index(persist_dir: str):
+    """Forgets the in-memory index of a document. The file goes away with the persist dir."""
+    with _indexes_lock:
+        _forget(os.path.abspath(persist_dir))
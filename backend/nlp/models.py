@@ -0,0 +1,18 @@
+from sqlalchemy import Column, Integer, String, Text, DateTime
+from database.db import Base
+from datetime import datetime
+
+class GroupSummary(Base):
+    """Summary of one group of chunks, keyed by a hash of the group text and prompt language.
+
+    Shared by every document, so re-uploads and page-range summaries only call
+    the LLM for groups whose text changed.
+    """
+    __tablename__ = "group_summaries"
+
+    id = Column(Integer, primary_key=True, index=True)
+    content_hash = Column(String(64), unique=True, index=True, nullable=False)
+    language = Column(String(8), nullable=False)
+    summary_text = Column(Text, nullable=False)
+    generated_at = Column(DateTime, default=datetime.utcnow)
+    last_used = Column(DateTime, default=datetime.utcnow)
@@ -0,0 +1,134 @@
+import os
+import time
+import threading
+from collections import OrderedDict
+import numpy as np
+from nlp.embeddings import get_embeddings
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+RETRIEVAL_CACHE_SIZE = int(os.getenv("RETRIEVAL_CACHE_SIZE", "512"))  # conversations
+RETRIEVAL_CACHE_TTL = float(os.getenv("RETRIEVAL_CACHE_TTL", "900"))  # seconds of inactivity
+# follow-up questions are answered from the cached candidates while the best of them reaches
+# this semantic relevance, on the scale of the stores' scores (0.7 is "relevant" for get_relevant_documents)
+RETRIEVAL_CACHE_MIN_SCORE = float(os.getenv("RETRIEVAL_CACHE_MIN_SCORE", "0.6"))
+
+
+class RetrievalCandidateCache:
+    """Candidate chunks of a conversation's last full retrieval, keyed by
+    (conversation_id, file_ids, fusion), with their vectors. LRU with idle TTL.
+
+    Follow-up questions are rescored against these chunks first, see candidate_search.
+    Vectors come from the chunk embedding store, chunks without a stored vector
+    are left out. Kept per process like the vectorstore cache.
+    """
+
+    def __init__(self, max_size: int = RETRIEVAL_CACHE_SIZE, ttl: float = RETRIEVAL_CACHE_TTL,
+                 min_score: float = RETRIEVAL_CACHE_MIN_SCORE):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.min_score = min_score
+        self._entries = OrderedDict()  # key -> (chunk_keys, vectors, last_used)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        # latency saved is estimated from the average full retrieval
+        self.full_searches = 0
+        self.full_seconds = 0.0
+        self.cached_seconds = 0.0
+
+    @staticmethod
+    def make_key(conversation_id: int, file_ids: list, fusion: str) -> tuple:
+        return (conversation_id, tuple(sorted(file_ids)), fusion)
+
+    def _expire(self, now: float):
+        """Drops entries idle for longer than the TTL. Called with the lock held."""
+        expired = [key for key, (_, _, last_used) in self._entries.items() if now - last_used > self.ttl]
+        for key in expired:
+            del self._entries[key]
+            self.evictions += 1
+
+    def get(self, key):
+        """Returns ([(file_id, chunk_id)], vectors) cached for key, or None."""
+        now = time.monotonic()
+        with self._lock:
+            self._expire(now)
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            self._entries[key] = (entry[0], entry[1], now)
+            self._entries.move_to_end(key)
+            return entry[0], entry[1]
+
+    def put(self, key, candidates: list):
+        """Caches the (file_id, chunk_id, text) candidates of a full retrieval, replacing the older ones."""
+        embeddings = get_embeddings()
+        store = embeddings.chunk_store
+        hashes = [store.make_key(embeddings.model, text) for _, _, text in candidates]
+        vectors = store.get_many(hashes)
+
+        chunk_keys, rows = [], []
+        for (file_id, chunk_id, _), chunk_hash in zip(candidates, hashes):
+            if chunk_hash in vectors:
+                chunk_keys.append((file_id, chunk_id))
+                rows.append(vectors[chunk_hash])
+        if not rows:
+            return
+        matrix = np.asarray(rows, dtype=np.float32)
+
+        now = time.monotonic()
+        with self._lock:
+            self._entries[key] = (chunk_keys, matrix, now)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def record(self, hit: bool, seconds: float):
+        """Counts a lookup and the time its retrieval took, cached or full."""
+        with self._lock:
+            if hit:
+                self.hits += 1
+                self.cached_seconds += seconds
+            else:
+                self.misses += 1
+                self.full_searches += 1
+                self.full_seconds += seconds
+
+    def invalidate_file(self, file_id: int):
+        """Drops the candidates of every conversation over a document that changed or was deleted."""
+        with self._lock:
+            stale = [key for key in self._entries if file_id in key[1]]
+            for key in stale:
+                del self._entries[key]
+            self.invalidations += len(stale)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            average_full = self.full_seconds / self.full_searches if self.full_searches else 0.0
+            return {
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "ttl_seconds": self.ttl,
+                "min_score": self.min_score,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+                "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+                "average_full_retrieval_ms": round(average_full * 1000, 2),
+                "average_cached_retrieval_ms": round(self.cached_seconds / self.hits * 1000, 2) if self.hits else 0.0,
+                "estimated_seconds_saved": round(max(average_full * self.hits - self.cached_seconds, 0.0), 3),
+            }
+
+
+retrieval_candidates = RetrievalCandidateCache()
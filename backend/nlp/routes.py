@@ -1,21 +1,43 @@
-from fastapi import APIRouter, Depends, HTTPException, Request, BackgroundTasks
-from nlp.schemas import QARequest
+from fastapi import APIRouter, Depends, HTTPException, Request, Response, BackgroundTasks
+from fastapi.responses import StreamingResponse
+from nlp.schemas import QARequest, BatchQARequest
 from auth.security import get_current_user
-from nlp.utils import get_vectorstore_for_file, hybrid_search, get_relevant_documents
-from nlp.utils import generate_answer_with_sources, generate_summary_for_chunks
-from langchain.memory import ConversationBufferWindowMemory
+from nlp.utils import get_vectorstore_for_file, get_vectorstore_for_files, ahybrid_search, get_relevant_documents
+from nlp.utils import candidate_search, batch_hybrid_search
+from nlp.utils import agenerate_answer_with_sources, astream_answer_with_sources, remember_exchange
+from nlp.summarization import asummarize_chunks
+from nlp.summary_jobs import summary_jobs
+from nlp.concurrency import run_blocking
+from nlp.vectorstores import vectorstore_cache
+from nlp.lexical import lexical_index_cache_stats
+from nlp.answer_cache import answer_cache, history_fingerprint
+from nlp.conversation_memory import conversation_memories
+from nlp.history import load_history_summary
+from nlp.retrieval_cache import retrieval_candidates
+from nlp.embeddings import aembed_question, aembed_questions, query_embedding_cache, get_chunk_embedding_store
 from conversations.models import Conversation, Message
 from documents.models import Document, DocumentSummary
 from conversations.schemas import MessageCreate
 from database.db import SessionLocal
 from sqlalchemy.orm import Session
+from typing import Literal
 import time
+import json
 import os
+import asyncio
 
 router = APIRouter(prefix="/nlp", tags=["NLP"])
 
-# dict for storing conversation memories
-conversation_memories = {}
+# answers one batch request generates at the same time, NLP_MAX_CONCURRENT_LLM still bounds the process
+BATCH_QA_CONCURRENCY = int(os.getenv("BATCH_QA_CONCURRENCY", "8"))
+
+def user_owns_documents(db: Session, user_id: int, file_ids: list) -> bool:
+    """Checks that every document belongs to the user before serving a cached answer."""
+    owned = db.query(Document.id).filter(
+        Document.id.in_(file_ids),
+        Document.user_id == user_id
+    ).count()
+    return owned == len(file_ids)
 
 def get_db():
     db = SessionLocal()
@@ -24,15 +46,9 @@ def get_db():
     finally:
         db.close()
 
-@router.post("/ask")
-async def ask_question(
-    qa: QARequest,
-    current_user = Depends(get_current_user),
-    db: Session = Depends(get_db)
-):
-    print("current_user.id =", current_user.id)
-    print("file_id =", qa.file_id)
-
+def load_conversation_memory(qa: QARequest, current_user, db: Session):
+    """Returns (memory, history_summary) of the request's conversation: the window memory of its
+    last messages and the running summary of the older ones. (None, None) without a conversation."""
     if hasattr(qa, 'conversation_id') and qa.conversation_id:
         # check if conv exists and owned by current user
         conversation = db.query(Conversation).filter(
@@ -43,43 +59,52 @@ async def ask_question(
         if not conversation:
             raise HTTPException(status_code=404, detail="Conversation not found or not owned by user.")
         
-        if qa.conversation_id not in conversation_memories:
-            memory = ConversationBufferWindowMemory(
-                memory_key="chat_history",
-                k=5,  # number of messages to keep in memory
-                return_messages=True
-            )
-
-            previous_messages = db.query(Message).filter(
-                Message.conversation_id == qa.conversation_id
-            ).order_by(Message.timestamp).all()
+        memory = conversation_memories.get(db, qa.conversation_id)
+        print("Using existing memory for conversation:", qa.conversation_id)
+        return memory, load_history_summary(db, qa.conversation_id)
 
-            for msg in previous_messages:
-                if msg.role == "user":
-                    memory.chat_memory.add_user_message(msg.content)
-                elif msg.role == "assistant":
-                    memory.chat_memory.add_ai_message(msg.content)
+    print("No conversation memory found, using default memory.")
+    return None, None
 
-            conversation_memories[qa.conversation_id] = memory
-
-        memory = conversation_memories.get(qa.conversation_id)
-        print("Using existing memory for conversation:", qa.conversation_id)
-    else:
-        memory = None
-        print("No conversation memory found, using default memory.")
-    
-    persist_dir = os.path.abspath(f"./vectorstore/{current_user.id}/{qa.file_id}")
-    print("persist_dir =", persist_dir)
+async def retrieve_documents(qa: QARequest, current_user, file_ids: list, query_embedding: list):
+    """Runs hybrid search over the request's documents, raising HTTP errors like /ask always did.
 
+    In a conversation, follow-up questions are first rescored against the candidates
+    of its last full search and only search the whole store when none scores high enough.
+    Returns (documents, scores), the scores decide which fragments fit the prompt budget.
+    """
     try:
-        vectorstore = get_vectorstore_for_file(persist_dir)
+        vectorstore = await run_blocking(get_vectorstore_for_files, current_user.id, file_ids)
         print("Vectorstore loaded OK")
     except Exception as e:
         print("Error loading vectorstore:", e)
         raise HTTPException(status_code=404, detail="Vector store not found for this file.")
     
     try:
-        relevant_docs = hybrid_search(vectorstore, qa.question, k=4)
+        cache_key = None
+        results = None
+        start_time = time.perf_counter()
+        if qa.conversation_id:
+            cache_key = retrieval_candidates.make_key(qa.conversation_id, file_ids, qa.fusion_mode)
+            candidates = retrieval_candidates.get(cache_key)
+            if candidates is not None:
+                results = await run_blocking(
+                    candidate_search, vectorstore, qa.question, candidates, k=4, fusion=qa.fusion_mode,
+                    query_embedding=query_embedding, min_score=retrieval_candidates.min_score
+                )
+
+        if results is None:
+            results, candidates = await ahybrid_search(
+                vectorstore, qa.question, k=4, fusion=qa.fusion_mode, query_embedding=query_embedding,
+                with_scores=True, with_candidates=True
+            )
+            if cache_key is not None:
+                await run_blocking(retrieval_candidates.put, cache_key, candidates)
+                retrieval_candidates.record(False, time.perf_counter() - start_time)
+        else:
+            retrieval_candidates.record(True, time.perf_counter() - start_time)
+            print("Retrieved from the conversation's cached candidates")
+        relevant_docs = [doc for doc, _ in results]
         print(f"Found {len(relevant_docs)} relevant documents")
     except Exception as e:
         print("Error finding relevant documents:", e)
@@ -87,34 +112,294 @@ async def ask_question(
 
     if not relevant_docs:
         raise HTTPException(status_code=404, detail="No relevant documents found.")
+    return relevant_docs, [score for _, score in results]
+
+def lookup_cached_answer(qa: QARequest, current_user, db: Session, memory, file_ids: list, cache_group: str,
+                         query_embedding: list):
+    """Returns a stored answer for a near-duplicate question, or None. Updates memory on a hit."""
+    cached = answer_cache.lookup(cache_group, query_embedding)
+    if cached is None or not user_owns_documents(db, current_user.id, file_ids):
+        return None
+
+    cached_result, similarity = cached
+    print(f"Answer cache hit (similarity {similarity:.3f})")
+    if memory:
+        remember_exchange(memory, qa.question, cached_result["answer"])
+    return cached_result
+
+def format_sse(event: str, data) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+@router.post("/ask")
+async def ask_question(
+    qa: QARequest,
+    current_user = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    print("current_user.id =", current_user.id)
+    print("file_ids =", qa.get_file_ids())
+
+    # DB reads and message decryption run on the NLP executor, the event loop stays free
+    memory, history_summary = await run_blocking(load_conversation_memory, qa, current_user, db)
+    file_ids = qa.get_file_ids()
+
+    # near-duplicate questions on the same documents and history reuse a stored answer
+    query_embedding = await aembed_question(qa.question)
+    # the fingerprint reads the remembered messages, a query with a shared state backend
+    cache_group = await run_blocking(
+        lambda: answer_cache.make_group(file_ids, history_fingerprint(memory, history_summary), qa.fusion_mode)
+    )
+    cached_result = await run_blocking(
+        lookup_cached_answer, qa, current_user, db, memory, file_ids, cache_group, query_embedding
+    )
+    if cached_result is not None:
+        return {**cached_result, "cached": True}
+
+    relevant_docs, scores = await retrieve_documents(qa, current_user, file_ids, query_embedding)
     
     try:
-        result = generate_answer_with_sources(qa.question, relevant_docs, memory)
+        result = await agenerate_answer_with_sources(
+            qa.question, relevant_docs, memory, scores, history_summary=history_summary
+        )
         print("Answer generated successfully")
-        return result
+        await run_blocking(answer_cache.store, cache_group, query_embedding, result)
+        return {**result, "cached": False}
     except Exception as e:
         print("Error generating answer:", e)
         raise HTTPException(status_code=500, detail="Error generating answer.")
 
+@router.post("/ask/stream")
+async def ask_question_stream(
+    qa: QARequest,
+    current_user = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    """Server-sent events variant of /ask: a sources event, token events as the model
+    generates them, then a done event with the full answer and totals."""
+    memory, history_summary = await run_blocking(load_conversation_memory, qa, current_user, db)
+    file_ids = qa.get_file_ids()
+
+    query_embedding = await aembed_question(qa.question)
+    # the fingerprint reads the remembered messages, a query with a shared state backend
+    cache_group = await run_blocking(
+        lambda: answer_cache.make_group(file_ids, history_fingerprint(memory, history_summary), qa.fusion_mode)
+    )
+    cached_result = await run_blocking(
+        lookup_cached_answer, qa, current_user, db, memory, file_ids, cache_group, query_embedding
+    )
+
+    if cached_result is not None:
+        async def cached_events():
+            yield "sources", cached_result["sources"]
+            yield "token", cached_result["answer"]
+            yield "done", {**cached_result, "cached": True}
+        events = cached_events()
+    else:
+        relevant_docs, scores = await retrieve_documents(qa, current_user, file_ids, query_embedding)
+        events = astream_answer_with_sources(
+            qa.question, relevant_docs, memory, scores, history_summary=history_summary
+        )
+
+    async def event_stream():
+        try:
+            async for event, data in events:
+                if event == "done" and not data.get("cached"):
+                    await run_blocking(answer_cache.store, cache_group, query_embedding, {
+                        "answer": data["answer"],
+                        "sources": data["sources"],
+                        "total_chunks_used": data["total_chunks_used"]
+                    })
+                    data = {**data, "cached": False}
+                yield format_sse(event, data)
+        except Exception as e:
+            print("Error streaming answer:", e)
+            yield format_sse("error", {"detail": "Error generating answer."})
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@router.post("/ask/batch")
+async def ask_question_batch(
+    batch: BatchQARequest,
+    current_user = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    """Answers many questions about one document, as server-sent events.
+
+    The store is opened once, the questions are embedded in one request and
+    retrieved with one matrix product, then answers are generated concurrently.
+    An answer event (index, question, answer, sources, total_chunks_used, cached)
+    is sent as soon as each answer is ready, an error event (index, detail) for a
+    question that failed, then a done event with the totals.
+    """
+    file_ids = [batch.file_id]
+    if not await run_blocking(user_owns_documents, db, current_user.id, file_ids):
+        raise HTTPException(status_code=404, detail="Document not found.")
+    try:
+        vectorstore = await run_blocking(get_vectorstore_for_file, current_user.id, batch.file_id)
+    except Exception as e:
+        print("Error loading vectorstore:", e)
+        raise HTTPException(status_code=404, detail="Vector store not found for this file.")
+
+    start_time = time.time()
+    questions = batch.questions
+    query_embeddings = await aembed_questions(questions)
+
+    # without a conversation, every question is looked up in the answer cache with an empty history
+    cache_group = answer_cache.make_group(file_ids, "", batch.fusion_mode)
+    cached = await run_blocking(lambda: [answer_cache.lookup(cache_group, vector) for vector in query_embeddings])
+    pending = [i for i, hit in enumerate(cached) if hit is None]
+
+    try:
+        retrieved = await run_blocking(
+            batch_hybrid_search, vectorstore, [questions[i] for i in pending],
+            [query_embeddings[i] for i in pending], k=4, fusion=batch.fusion_mode
+        ) if pending else []
+    except Exception as e:
+        print("Error finding relevant documents:", e)
+        raise HTTPException(status_code=500, detail=f"Error finding relevant documents: {str(e)}")
+
+    semaphore = asyncio.Semaphore(BATCH_QA_CONCURRENCY)
+
+    async def answer(index: int, results: list):
+        """Returns (index, result, error), errors are reported per question."""
+        if not results:
+            return index, None, "No relevant documents found."
+        try:
+            async with semaphore:
+                result = await agenerate_answer_with_sources(
+                    questions[index], [doc for doc, _ in results], None, [score for _, score in results]
+                )
+            await run_blocking(answer_cache.store, cache_group, query_embeddings[index], result)
+            return index, result, None
+        except Exception as e:
+            print(f"Error generating answer {index}: {e}")
+            return index, None, "Error generating answer."
+
+    async def event_stream():
+        answered = cached_count = failed = 0
+        for index, hit in enumerate(cached):
+            if hit is not None:
+                cached_count += 1
+                yield format_sse("answer", {"index": index, "question": questions[index], **hit[0], "cached": True})
+
+        tasks = [asyncio.create_task(answer(index, results)) for index, results in zip(pending, retrieved)]
+        try:
+            for next_answer in asyncio.as_completed(tasks):
+                index, result, error = await next_answer
+                if error is not None:
+                    failed += 1
+                    yield format_sse("error", {"index": index, "detail": error})
+                    continue
+                answered += 1
+                yield format_sse("answer", {"index": index, "question": questions[index], **result, "cached": False})
+        finally:
+            # the client went away, generations still queued are dropped
+            for task in tasks:
+                task.cancel()
+
+        yield format_sse("done", {
+            "questions": len(questions),
+            "answered": answered + cached_count,
+            "cached": cached_count,
+            "failed": failed,
+            "total_time_seconds": round(time.time() - start_time, 3)
+        })
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+def load_ordered_chunks(user_id: int, file_id: int) -> list:
+    """(text, metadata) pairs of a document's chunks in document order."""
+    vectorstore = get_vectorstore_for_file(user_id, file_id)
+    all_docs = vectorstore.get()
+    # stores don't return chunks in document order, summaries follow the text
+    return sorted(
+        zip(all_docs["documents"], [metadata or {} for metadata in all_docs["metadatas"]]),
+        key=lambda item: item[1].get("chunk_id", 0)
+    )
+
+async def run_summary_job(job, user_id: int, file_id: int, document_title: str):
+    """Background task generating a document summary, progress is reported on the job."""
+    db = SessionLocal()
+    try:
+        ordered = await run_blocking(load_ordered_chunks, user_id, file_id)
+        chunks = [text for text, _ in ordered]
+
+        chunk_count = len(chunks)
+        total_chars = sum(len(chunk) for chunk in chunks)
+        print(f"Total chunks: {chunk_count}, Total characters: {total_chars}")
+
+        start_time = time.time()
+        summary, stage_metrics = await asummarize_chunks(
+            chunks,
+            document_title=document_title,
+            progress=job.update_progress
+        )
+        processing_time = time.time() - start_time
+
+        new_summary = DocumentSummary(
+            document_id=file_id,
+            summary_text=summary,
+            chunk_count=chunk_count,
+            processing_time=processing_time
+        )
+        db.add(new_summary)
+        await run_blocking(db.commit)
+
+        job.complete({
+            "document_id": file_id,
+            "document_title": document_title,
+            "summary": summary,
+            "metrics": {
+                "chunk_count": chunk_count,
+                "total_characters": total_chars,
+                "processing_time_seconds": round(processing_time, 2),
+                **stage_metrics,
+                "cached": False
+            }
+        })
+
+    except FileNotFoundError:
+        job.fail("Vector store not found for this file.")
+    except Exception as e:
+        print(f"Error generating summary: {e}")
+        job.fail(f"Error generating summary: {str(e)}")
+    finally:
+        summary_jobs.finish(job)
+        db.close()
+
 @router.post("/summary/{file_id}")
 async def generate_document_summary(
     file_id: int,
+    response: Response,
+    background_tasks: BackgroundTasks,
     current_user = Depends(get_current_user),
     db: Session = Depends(get_db)
 ):
-    """Generates a summary for the document associated with the given file_id."""
-    document = db.query(Document).filter(
+    """Returns the stored summary of a document, or starts a background job generating it.
+
+    Concurrent requests for the same document share one job. Job progress is
+    polled from /nlp/summary/jobs/{job_id}.
+    """
+    document = await run_blocking(lambda: db.query(Document).filter(
         Document.id == file_id,
         Document.user_id == current_user.id
-    ).first()
+    ).first())
 
     if not document:
         raise HTTPException(status_code=404, detail="Document not found or not owned by user.")
     
     # Check if a summary already exists
-    existing_summary = db.query(DocumentSummary).filter(
+    existing_summary = await run_blocking(lambda: db.query(DocumentSummary).filter(
         DocumentSummary.document_id == file_id
-    ).first()
+    ).first())
 
     if existing_summary:
         return {
@@ -129,80 +414,113 @@ async def generate_document_summary(
             }
         }
 
-    persist_dir = os.path.abspath(f"./vectorstore/{current_user.id}/{file_id}")
     try:
-        vectorstore = get_vectorstore_for_file(persist_dir)
+        await run_blocking(get_vectorstore_for_file, current_user.id, file_id)
     except FileNotFoundError:
         raise HTTPException(status_code=404, detail="Vector store not found for this file.")
-    
-    all_docs = vectorstore.get()
-    chunks = all_docs["documents"]
 
-    chunk_count = len(chunks)
-    total_chars = sum(len(chunk) for chunk in chunks)
-    print(f"Total chunks: {chunk_count}, Total characters: {total_chars}")
+    job, created = summary_jobs.get_or_create(current_user.id, file_id)
+    if created:
+        background_tasks.add_task(run_summary_job, job, current_user.id, file_id, document.filename)
+    else:
+        print(f"Attached to running summary job {job.id} for document {file_id}")
 
-    start_time = time.time()
+    response.status_code = 202
+    return job.to_dict()
 
-    try:
-        summary = generate_summary_for_chunks(
-            chunks,
-            max_length=5000,
-            document_title=document.filename
-        )
+@router.get("/summary/jobs/{job_id}")
+async def get_summary_job(job_id: str, current_user = Depends(get_current_user)):
+    """Reports the status of a summary job, with the summary once it is completed."""
+    job = summary_jobs.get(job_id)
+    if job is None or job.user_id != current_user.id:
+        raise HTTPException(status_code=404, detail="Summary job not found.")
+    return job.to_dict()
 
-        processing_time = time.time() - start_time
+@router.post("/summary/{file_id}/pages")
+async def generate_page_range_summary(
+    file_id: int,
+    start_page: int,
+    end_page: int,
+    current_user = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    """Summarizes pages start_page..end_page (1-based, inclusive) of a PDF.
 
-        new_summary = DocumentSummary(
-            document_id=file_id,
-            summary_text=summary,
-            chunk_count=chunk_count,
-            processing_time=processing_time
-        )
-        db.add(new_summary)
-        db.commit()
+    Groups already summarized for the whole document, or for an overlapping
+    range, come from the group summary cache.
+    """
+    if start_page < 1 or end_page < start_page:
+        raise HTTPException(status_code=400, detail="Invalid page range.")
 
-        result = {
-            "document_id": file_id,
-            "document_title": document.filename,
-            "summary": summary,
-            "metrics": {
-                "chunk_count": chunk_count,
-                "total_characters": total_chars,
-                "processing_time_seconds": round(processing_time, 2),
-                "cached": False
-            }
-        }
+    document = await run_blocking(lambda: db.query(Document).filter(
+        Document.id == file_id,
+        Document.user_id == current_user.id
+    ).first())
+    if not document:
+        raise HTTPException(status_code=404, detail="Document not found or not owned by user.")
+
+    try:
+        ordered = await run_blocking(load_ordered_chunks, current_user.id, file_id)
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="Vector store not found for this file.")
+
+    if not any("page" in metadata for _, metadata in ordered):
+        raise HTTPException(status_code=400, detail="Document has no page information.")
 
-        return result
+    # loaders number pages from 0
+    chunks = [
+        text for text, metadata in ordered
+        if start_page - 1 <= metadata.get("page", -1) <= end_page - 1
+    ]
+    if not chunks:
+        raise HTTPException(status_code=404, detail="No content found in this page range.")
 
+    start_time = time.time()
+    try:
+        summary, stage_metrics = await asummarize_chunks(
+            chunks,
+            document_title=f"{document.filename} (pages {start_page}-{end_page})"
+        )
     except Exception as e:
-        print(f"Error generating summary: {e}")
+        print(f"Error generating page range summary: {e}")
         raise HTTPException(status_code=500, detail=f"Error generating summary: {str(e)}")
-    '''
+
     return {
         "document_id": file_id,
-        "document_title": "Example Document",
-        "summary": "This is a placeholder summary for the document.",
-    } '''
+        "document_title": document.filename,
+        "start_page": start_page,
+        "end_page": end_page,
+        "summary": summary,
+        "metrics": {
+            "chunk_count": len(chunks),
+            "processing_time_seconds": round(time.time() - start_time, 2),
+            **stage_metrics
+        }
+    }
 
 # TEST
 @router.get("/debug/search-comparison/{file_id}")
 async def compare_search_methods(
     file_id: int,
     query: str,
+    fusion: Literal["weighted", "rrf"] = "weighted",
     current_user = Depends(get_current_user)
 ):
-    persist_dir = f"./vectorstore/{current_user.id}/{file_id}"
-    vectorstore = get_vectorstore_for_file(persist_dir)
+    vectorstore = await run_blocking(get_vectorstore_for_file, current_user.id, file_id)
     
+    # embed the query once, both methods search from the same vector
+    query_embedding = await aembed_question(query)
+
     # Results from both methods
-    semantic_results = get_relevant_documents(vectorstore, query, k=3)
-    hybrid_results = hybrid_search(vectorstore, query, k=3)
+    semantic_results = await run_blocking(
+        get_relevant_documents, vectorstore, query, k=3, query_embedding=query_embedding
+    )
+    hybrid_results = await ahybrid_search(vectorstore, query, k=3, fusion=fusion, query_embedding=query_embedding)
     
     # Format results for easier comparison
     return {
         "query": query,
+        "fusion": fusion,
         "semantic_results": [
             {
                 "content": doc.page_content[:200] + "...",
@@ -215,4 +533,18 @@ async def compare_search_methods(
                 "metadata": doc.metadata
             } for doc in hybrid_results
         ]
-    }
\ No newline at end of file
+    }
+
+@router.get("/debug/cache-stats")
+async def get_cache_stats(current_user = Depends(get_current_user)):
+    """Returns hit, miss and eviction counters of the NLP caches."""
+    # the sqlite backed stores count their entries with queries
+    return await run_blocking(lambda: {
+        "vectorstores": vectorstore_cache.stats(),
+        "lexical_indexes": lexical_index_cache_stats(),
+        "query_embeddings": query_embedding_cache.stats(),
+        "chunk_embeddings": get_chunk_embedding_store().stats(),
+        "answers": answer_cache.stats(),
+        "conversation_memories": conversation_memories.stats(),
+        "retrieval_candidates": retrieval_candidates.stats()
+    })
@@ -1,10 +1,33 @@
-from pydantic import BaseModel
-from typing import List, Optional
+from pydantic import BaseModel, Field, model_validator
+from typing import List, Optional, Literal
+import os
+
+# most questions one batch request may ask
+BATCH_QA_MAX_QUESTIONS = int(os.getenv("BATCH_QA_MAX_QUESTIONS", "100"))
 
 class QARequest(BaseModel):
     question: str
-    file_id: int
+    file_id: Optional[int] = None
+    file_ids: Optional[List[int]] = None  # several documents for cross-document questions
     conversation_id: Optional[int] = None
+    fusion_mode: Literal["weighted", "rrf"] = "weighted"
+
+    @model_validator(mode="after")
+    def check_files(self):
+        if self.file_id is None and not self.file_ids:
+            raise ValueError("file_id or file_ids must be provided")
+        return self
+
+    def get_file_ids(self) -> List[int]:
+        """Returns the documents to search, file_id first, without duplicates."""
+        file_ids = ([self.file_id] if self.file_id is not None else []) + (self.file_ids or [])
+        return list(dict.fromkeys(file_ids))
+
+class BatchQARequest(BaseModel):
+    """Questions about one document, answered by /nlp/ask/batch."""
+    file_id: int
+    questions: List[str] = Field(min_length=1, max_length=BATCH_QA_MAX_QUESTIONS)
+    fusion_mode: Literal["weighted", "rrf"] = "weighted"
 
 class SourceInfo(BaseModel):
     chunk_id: int
@@ -15,3 +38,4 @@ class QAResponse(BaseModel):
     answer: str
     sources: List[SourceInfo]
     total_chunks_used: int
+    cached: bool = False
@@ -0,0 +1,286 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+from collections import OrderedDict
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# "memory" keeps state inside each process, "sqlite" shares it between the workers of a
+# host through one WAL-mode file, so a conversation keeps its memory on whichever worker
+# serves its next question
+SHARED_STATE_BACKEND = os.getenv("SHARED_STATE_BACKEND", "memory")
+SHARED_STATE_PATH = os.getenv("SHARED_STATE_PATH", "./vectorstore/_shared_state.sqlite")
+# last_used of a key read more recently than this is not rewritten, reads then take no write lock
+TOUCH_INTERVAL = 5.0  # seconds
+
+
+class InProcessListStore:
+    """Lists of JSON-compatible items keyed by string, with LRU and idle TTL eviction.
+
+    Items are kept as given, callers must not modify what they store or get.
+    """
+
+    def __init__(self, namespace: str, max_keys: int, ttl: float):
+        self.namespace = namespace
+        self.max_keys = max_keys
+        self.ttl = ttl
+        self._entries = OrderedDict()  # key -> (items, last_used)
+        self._lock = threading.Lock()
+        self.evictions = 0
+
+    def _expire(self, now: float):
+        """Drops keys idle for longer than the TTL. Called with the lock held."""
+        expired = [key for key, (_, last_used) in self._entries.items() if now - last_used > self.ttl]
+        for key in expired:
+            del self._entries[key]
+            self.evictions += 1
+
+    def _put(self, key: str, items: list, now: float):
+        self._entries[key] = (items, now)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_keys:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def get(self, key: str):
+        """Returns the items of key, or None if the key is missing or expired."""
+        now = time.monotonic()
+        with self._lock:
+            self._expire(now)
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            self._entries[key] = (entry[0], now)
+            self._entries.move_to_end(key)
+            return list(entry[0])
+
+    def create(self, key: str, items: list) -> list:
+        """Stores items under key unless another caller created it first. Returns the stored items."""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                return list(entry[0])
+            self._put(key, list(items), now)
+            return list(items)
+
+    def append(self, key: str, items: list, max_len: int = None):
+        """Appends items to key atomically, creating it, and keeps only the last max_len items."""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            current = (entry[0] if entry is not None else []) + list(items)
+            if max_len is not None:
+                current = current[-max_len:]
+            self._put(key, current, now)
+
+    def delete(self, key: str) -> bool:
+        with self._lock:
+            return self._entries.pop(key, None) is not None
+
+    def keys(self) -> list:
+        with self._lock:
+            return list(self._entries)
+
+    def size(self) -> int:
+        with self._lock:
+            return len(self._entries)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class SqliteListStore:
+    """InProcessListStore over a SQLite file in WAL mode, shared by every process opening it.
+
+    Items are rows of their own, so an append is one short write transaction
+    and workers never overwrite each other's items. An encryptor, if given,
+    encrypts items at rest like conversation messages in the database.
+    """
+
+    _schema_lock = threading.Lock()
+
+    def __init__(self, namespace: str, max_keys: int, ttl: float, path: str = SHARED_STATE_PATH,
+                 encryptor=None):
+        self.namespace = namespace
+        self.max_keys = max_keys
+        self.ttl = ttl
+        self.path = path
+        self.encryptor = encryptor
+        self._local = threading.local()
+        self.evictions = 0
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+        with self._schema_lock:
+            conn = self._conn()
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS state_keys ("
+                "namespace TEXT NOT NULL, key TEXT NOT NULL, last_used REAL NOT NULL, "
+                "PRIMARY KEY (namespace, key))"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS ix_state_keys_last_used ON state_keys (namespace, last_used)")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS state_items ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, namespace TEXT NOT NULL, key TEXT NOT NULL, "
+                "value TEXT NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS ix_state_items_key ON state_items (namespace, key, id)")
+
+    def _conn(self):
+        """One connection per thread, sqlite connections can't be shared between threads."""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            # autocommit, write transactions are opened explicitly with BEGIN IMMEDIATE
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _dumps(self, item) -> str:
+        value = json.dumps(item, ensure_ascii=False)
+        return self.encryptor.encrypt_message(value) if self.encryptor else value
+
+    def _loads(self, value: str):
+        return json.loads(self.encryptor.decrypt_message(value) if self.encryptor else value)
+
+    def _write(self, fn):
+        """Runs fn(conn) in a write transaction, wall clock time because processes share it."""
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            result = fn(conn, time.time())
+            conn.execute("COMMIT")
+            return result
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    def _evict(self, conn, now: float):
+        """Drops expired keys and the least recently used ones so a new key fits in max_keys.
+        Called in a write transaction, before the new key is inserted."""
+        stale = conn.execute(
+            "SELECT key FROM state_keys WHERE namespace = ? AND last_used < ?", (self.namespace, now - self.ttl)
+        ).fetchall()
+        count = conn.execute("SELECT COUNT(*) FROM state_keys WHERE namespace = ?", (self.namespace,)).fetchone()[0]
+        over = count - len(stale) - (self.max_keys - 1)
+        if over > 0:
+            stale += conn.execute(
+                "SELECT key FROM state_keys WHERE namespace = ? AND last_used >= ? ORDER BY last_used LIMIT ?",
+                (self.namespace, now - self.ttl, over)
+            ).fetchall()
+        for (key,) in stale:
+            self._delete(conn, key)
+        self.evictions += len(stale)
+
+    def _delete(self, conn, key: str):
+        conn.execute("DELETE FROM state_items WHERE namespace = ? AND key = ?", (self.namespace, key))
+        conn.execute("DELETE FROM state_keys WHERE namespace = ? AND key = ?", (self.namespace, key))
+
+    def get(self, key: str):
+        now = time.time()
+        conn = self._conn()
+        row = conn.execute(
+            "SELECT last_used FROM state_keys WHERE namespace = ? AND key = ?", (self.namespace, key)
+        ).fetchone()
+        if row is None or now - row[0] > self.ttl:
+            return None
+        values = conn.execute(
+            "SELECT value FROM state_items WHERE namespace = ? AND key = ? ORDER BY id", (self.namespace, key)
+        ).fetchall()
+        if now - row[0] > TOUCH_INTERVAL:
+            conn.execute(
+                "UPDATE state_keys SET last_used = ? WHERE namespace = ? AND key = ?", (now, self.namespace, key)
+            )
+        return [self._loads(value) for (value,) in values]
+
+    def create(self, key: str, items: list) -> list:
+        def create(conn, now):
+            exists = conn.execute(
+                "SELECT last_used FROM state_keys WHERE namespace = ? AND key = ?", (self.namespace, key)
+            ).fetchone()
+            if exists is not None and now - exists[0] <= self.ttl:
+                return None
+            self._delete(conn, key)  # items of an expired key
+            self._evict(conn, now)
+            conn.execute(
+                "INSERT OR REPLACE INTO state_keys (namespace, key, last_used) VALUES (?, ?, ?)",
+                (self.namespace, key, now)
+            )
+            conn.executemany(
+                "INSERT INTO state_items (namespace, key, value) VALUES (?, ?, ?)",
+                [(self.namespace, key, self._dumps(item)) for item in items]
+            )
+            return list(items)
+
+        created = self._write(create)
+        return created if created is not None else self.get(key) or []
+
+    def append(self, key: str, items: list, max_len: int = None):
+        values = [(self.namespace, key, self._dumps(item)) for item in items]
+
+        def append(conn, now):
+            known = conn.execute(
+                "SELECT last_used FROM state_keys WHERE namespace = ? AND key = ?", (self.namespace, key)
+            ).fetchone()
+            if known is not None and now - known[0] <= self.ttl:
+                conn.execute(
+                    "UPDATE state_keys SET last_used = ? WHERE namespace = ? AND key = ?", (now, self.namespace, key)
+                )
+            else:
+                self._delete(conn, key)  # items of an expired key
+                self._evict(conn, now)
+                conn.execute(
+                    "INSERT INTO state_keys (namespace, key, last_used) VALUES (?, ?, ?)", (self.namespace, key, now)
+                )
+            conn.executemany("INSERT INTO state_items (namespace, key, value) VALUES (?, ?, ?)", values)
+            if max_len is not None:
+                conn.execute(
+                    "DELETE FROM state_items WHERE namespace = ? AND key = ? AND id NOT IN ("
+                    "SELECT id FROM state_items WHERE namespace = ? AND key = ? ORDER BY id DESC LIMIT ?)",
+                    (self.namespace, key, self.namespace, key, max_len)
+                )
+
+        self._write(append)
+
+    def delete(self, key: str) -> bool:
+        def delete(conn, now):
+            known = conn.execute(
+                "SELECT 1 FROM state_keys WHERE namespace = ? AND key = ?", (self.namespace, key)
+            ).fetchone()
+            self._delete(conn, key)
+            return known is not None
+
+        return self._write(delete)
+
+    def keys(self) -> list:
+        rows = self._conn().execute(
+            "SELECT key FROM state_keys WHERE namespace = ? AND last_used >= ?",
+            (self.namespace, time.time() - self.ttl)
+        ).fetchall()
+        return [key for (key,) in rows]
+
+    def size(self) -> int:
+        return len(self.keys())
+
+    def clear(self):
+        def clear(conn, now):
+            conn.execute("DELETE FROM state_items WHERE namespace = ?", (self.namespace,))
+            conn.execute("DELETE FROM state_keys WHERE namespace = ?", (self.namespace,))
+
+        self._write(clear)
+
+
+def make_list_store(namespace: str, max_keys: int, ttl: float, encryptor=None, backend: str = None):
+    """Returns the list store of a namespace on the configured shared state backend."""
+    backend = backend or SHARED_STATE_BACKEND
+    if backend == "sqlite":
+        return SqliteListStore(namespace, max_keys, ttl, encryptor=encryptor)
+    if backend != "memory":
+        raise ValueError(f"Unknown shared state backend: {backend}")
+    return InProcessListStore(namespace, max_keys, ttl)
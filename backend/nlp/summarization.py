@@ -0,0 +1,245 @@
+import os
+import time
+import asyncio
+import hashlib
+from datetime import datetime
+from sqlalchemy.exc import IntegrityError
+from database.db import SessionLocal
+from nlp.models import GroupSummary
+from nlp.concurrency import run_blocking
+from nlp.utils import agenerate_summary, agenerate_final_summary, agenerate_merged_summary
+from nlp.utils import detect_language, SUMMARY_FAILED
+from nlp.tokens import count_tokens, CHAT_MODEL
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# tokens of chunk text summarized by one map call
+SUMMARY_GROUP_TOKENS = int(os.getenv("SUMMARY_GROUP_TOKENS", "1250"))
+# groups summarized at the same time by one summary job, on top of the process-wide LLM limit
+SUMMARY_MAX_CONCURRENCY = int(os.getenv("SUMMARY_MAX_CONCURRENCY", "8"))
+# tokens of section summaries the final summary is built from in one call,
+# above it summaries are merged in a tree first
+SUMMARY_REDUCE_TOKEN_BUDGET = int(os.getenv("SUMMARY_REDUCE_TOKEN_BUDGET", "8000"))
+
+# part of the group summary key, bump it when the section prompt changes
+SUMMARY_PROMPT_VERSION = "1"
+# once a group holds half of max_tokens it closes after any chunk whose hash
+# is divisible by this, so group boundaries follow the content instead of the offset
+# from the start of the document and an edit only changes the groups around it
+GROUP_ANCHOR_DIVISOR = 3
+
+
+def estimate_tokens(text: str) -> int:
+    return count_tokens(text, CHAT_MODEL)
+
+
+def _is_anchor(chunk: str) -> bool:
+    digest = hashlib.sha1(chunk.encode('utf-8')).digest()
+    return int.from_bytes(digest[:4], "big") % GROUP_ANCHOR_DIVISOR == 0
+
+
+def group_chunks(chunks: list, max_tokens: int = SUMMARY_GROUP_TOKENS) -> list:
+    """Drops exact repeats and joins the rest into groups of at most max_tokens tokens.
+
+    Near duplicates are kept, they can differ in an amount or a date. Boundaries
+    are content-defined, see GROUP_ANCHOR_DIVISOR.
+    """
+    unique_chunks = []
+    content_hashes = set()
+
+    for chunk in chunks:
+        chunk_hash = hashlib.md5(chunk.strip().encode('utf-8')).digest()
+        if chunk_hash not in content_hashes:
+            content_hashes.add(chunk_hash)
+            unique_chunks.append(chunk)
+
+    if len(unique_chunks) < len(chunks):
+        print(f"Reduced {len(chunks)} chunks to {len(unique_chunks)} unique chunks")
+
+    groups = []
+    current_group = []
+    current_tokens = 0
+
+    for chunk in unique_chunks:
+        tokens = estimate_tokens(chunk)
+        if current_group and current_tokens + tokens > max_tokens:
+            groups.append("\n\n".join(current_group))
+            current_group = [chunk]
+            current_tokens = tokens
+        else:
+            current_group.append(chunk)
+            current_tokens += tokens
+        if current_tokens >= max_tokens // 2 and _is_anchor(chunk):
+            groups.append("\n\n".join(current_group))
+            current_group = []
+            current_tokens = 0
+
+    if current_group:
+        groups.append("\n\n".join(current_group))
+
+    return groups
+
+
+def group_summary_key(text: str, lang: str) -> str:
+    return hashlib.sha256(f"{SUMMARY_PROMPT_VERSION}\0{lang}\0{text}".encode("utf-8")).hexdigest()
+
+
+def load_group_summaries(keys: list) -> dict:
+    """Returns {key: summary} of the stored group summaries and marks them as used."""
+    if not keys:
+        return {}
+    db = SessionLocal()
+    try:
+        rows = db.query(GroupSummary).filter(GroupSummary.content_hash.in_(keys)).all()
+        now = datetime.utcnow()
+        for row in rows:
+            row.last_used = now
+        db.commit()
+        return {row.content_hash: row.summary_text for row in rows}
+    finally:
+        db.close()
+
+
+def store_group_summaries(entries: list):
+    """Stores (key, language, summary) entries, keys stored meanwhile by another job are skipped."""
+    if not entries:
+        return
+    db = SessionLocal()
+    try:
+        for key, lang, summary in entries:
+            db.add(GroupSummary(content_hash=key, language=lang, summary_text=summary))
+            try:
+                db.commit()
+            except IntegrityError:
+                db.rollback()
+    finally:
+        db.close()
+
+
+def batch_for_budget(summaries: list, budget: int) -> list:
+    """Splits consecutive summaries into batches whose tokens fit the budget.
+
+    Every batch holds at least two summaries so each reduce level shrinks the list.
+    """
+    batches = []
+    current = []
+    current_tokens = 0
+    for summary in summaries:
+        tokens = estimate_tokens(summary)
+        if len(current) >= 2 and current_tokens + tokens > budget:
+            batches.append(current)
+            current = []
+            current_tokens = 0
+        current.append(summary)
+        current_tokens += tokens
+    if current:
+        if len(current) == 1 and batches:
+            batches[-1].append(current[0])
+        else:
+            batches.append(current)
+    return batches
+
+
+async def asummarize_chunks(chunks: list, max_tokens: int = SUMMARY_GROUP_TOKENS, document_title: str = None,
+                            max_concurrency: int = SUMMARY_MAX_CONCURRENCY,
+                            reduce_budget: int = SUMMARY_REDUCE_TOKEN_BUDGET, progress=None,
+                            use_cache: bool = True):
+    """Map-reduce summary of a document's chunks.
+
+    Groups are summarized concurrently, at most max_concurrency at a time. When the
+    group summaries exceed reduce_budget they are merged level by level until they
+    fit, then combined into the final summary. Returns (summary, metrics) where
+    metrics holds the timing of each stage.
+
+    With use_cache, group summaries are looked up in the group_summaries table
+    first and only groups whose text changed go to the LLM.
+
+    progress, if given, is called as progress(stage, done, total) when a stage
+    starts and each time one of its LLM calls finishes.
+    """
+    start_time = time.time()
+    semaphore = asyncio.Semaphore(max_concurrency)
+    report = progress or (lambda stage, done, total: None)
+
+    async def run_stage(stage, coros, already_done=0):
+        coros = list(coros)
+        done = already_done
+        total = len(coros) + already_done
+        report(stage, done, total)
+
+        async def bounded(coro):
+            nonlocal done
+            async with semaphore:
+                result = await coro
+            done += 1
+            report(stage, done, total)
+            return result
+
+        return await asyncio.gather(*(bounded(coro) for coro in coros))
+
+    if len(chunks) <= 3:
+        summary, = await run_stage("map", [agenerate_summary("\n\n".join(chunks))])
+        return summary, {
+            "group_count": 1,
+            "reduce_levels": 0,
+            "llm_calls": 1,
+            "cached_groups": 0,
+            "grouping_seconds": 0.0,
+            "map_seconds": round(time.time() - start_time, 2),
+            "reduce_seconds": 0.0,
+            "final_seconds": 0.0,
+        }
+
+    groups = await run_blocking(group_chunks, chunks, max_tokens)
+    grouping_seconds = time.time() - start_time
+    print(f"Created {len(groups)} groups of chunks")
+
+    map_start = time.time()
+    langs = await run_blocking(lambda: [detect_language(group) for group in groups])
+    keys = [group_summary_key(group, lang) for group, lang in zip(groups, langs)]
+    stored = await run_blocking(load_group_summaries, keys) if use_cache else {}
+
+    summaries = [stored.get(key) for key in keys]
+    missing = [i for i, summary in enumerate(summaries) if summary is None]
+    new_summaries = await run_stage(
+        "map", (agenerate_summary(groups[i], langs[i]) for i in missing), already_done=len(groups) - len(missing)
+    )
+    for i, summary in zip(missing, new_summaries):
+        summaries[i] = summary
+    if use_cache:
+        await run_blocking(store_group_summaries, [
+            (keys[i], langs[i], summary) for i, summary in zip(missing, new_summaries) if summary != SUMMARY_FAILED
+        ])
+    map_seconds = time.time() - map_start
+    llm_calls = len(missing)
+    print(f" ✓ {len(missing)} group summaries done in {map_seconds:.2f}s, {len(groups) - len(missing)} reused")
+
+    reduce_start = time.time()
+    reduce_levels = 0
+    while len(summaries) > 1 and sum(estimate_tokens(s) for s in summaries) > reduce_budget:
+        batches = batch_for_budget(summaries, reduce_budget)
+        summaries = await run_stage(
+            f"reduce_{reduce_levels + 1}", (agenerate_merged_summary(batch) for batch in batches)
+        )
+        reduce_levels += 1
+        llm_calls += len(batches)
+        print(f" ✓ Reduce level {reduce_levels}: merged into {len(summaries)} summaries")
+    reduce_seconds = time.time() - reduce_start
+
+    final_start = time.time()
+    final_summary, = await run_stage("final", [agenerate_final_summary(list(summaries), document_title=document_title)])
+    final_seconds = time.time() - final_start
+    print("Final summary generated successfully.")
+
+    return final_summary, {
+        "group_count": len(groups),
+        "reduce_levels": reduce_levels,
+        "llm_calls": llm_calls + 1,
+        "cached_groups": len(groups) - len(missing),
+        "grouping_seconds": round(grouping_seconds, 3),
+        "map_seconds": round(map_seconds, 2),
+        "reduce_seconds": round(reduce_seconds, 2),
+        "final_seconds": round(final_seconds, 2),
+    }
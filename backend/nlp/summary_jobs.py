@@ -0,0 +1,110 @@
+import os
+import time
+import uuid
+import threading
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# finished jobs stay queryable for this long, then the DocumentSummary row is the record
+SUMMARY_JOB_TTL = float(os.getenv("SUMMARY_JOB_TTL", "3600"))  # seconds
+
+
+class SummaryJob:
+    """State of one background summary run, reported by the job status endpoint."""
+
+    def __init__(self, user_id: int, document_id: int):
+        self.id = uuid.uuid4().hex
+        self.user_id = user_id
+        self.document_id = document_id
+        self.status = "pending"  # pending, running, completed, failed
+        self.stage = None
+        self.stage_done = 0
+        self.stage_total = 0
+        self.groups_done = 0
+        self.groups_total = 0
+        self.result = None
+        self.error = None
+        self.created = time.time()
+        self.finished = None
+
+    def update_progress(self, stage: str, done: int, total: int):
+        """Progress callback of asummarize_chunks."""
+        self.status = "running"
+        self.stage = stage
+        self.stage_done = done
+        self.stage_total = total
+        if stage == "map":
+            self.groups_done = done
+            self.groups_total = total
+
+    def complete(self, result: dict):
+        self.status = "completed"
+        self.result = result
+        self.finished = time.time()
+
+    def fail(self, error: str):
+        self.status = "failed"
+        self.error = error
+        self.finished = time.time()
+
+    def to_dict(self) -> dict:
+        return {
+            "job_id": self.id,
+            "document_id": self.document_id,
+            "status": self.status,
+            "stage": self.stage,
+            "stage_done": self.stage_done,
+            "stage_total": self.stage_total,
+            "groups_done": self.groups_done,
+            "groups_total": self.groups_total,
+            "result": self.result,
+            "error": self.error,
+        }
+
+
+class SummaryJobRegistry:
+    """In-process registry of summary jobs with at most one active job per document.
+
+    A request for a document that already has a pending or running job attaches
+    to it instead of starting a second LLM pipeline.
+    """
+
+    def __init__(self, ttl: float = SUMMARY_JOB_TTL):
+        self.ttl = ttl
+        self._jobs = {}  # job id -> job
+        self._active = {}  # document id -> job id
+        self._lock = threading.Lock()
+
+    def _prune(self, now: float):
+        """Forgets jobs finished longer than the TTL ago. Called with the lock held."""
+        expired = [job_id for job_id, job in self._jobs.items()
+                   if job.finished is not None and now - job.finished > self.ttl]
+        for job_id in expired:
+            del self._jobs[job_id]
+
+    def get_or_create(self, user_id: int, document_id: int):
+        """Returns (job, created): the active job of the document, or a new pending one."""
+        with self._lock:
+            self._prune(time.time())
+            job_id = self._active.get(document_id)
+            if job_id is not None:
+                return self._jobs[job_id], False
+            job = SummaryJob(user_id, document_id)
+            self._jobs[job.id] = job
+            self._active[document_id] = job.id
+            return job, True
+
+    def get(self, job_id: str):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def finish(self, job: SummaryJob):
+        """Releases the document so the next request can start a new job."""
+        with self._lock:
+            if self._active.get(job.document_id) == job.id:
+                del self._active[job.document_id]
+
+
+summary_jobs = SummaryJobRegistry()
@@ -0,0 +1,74 @@
+import os
+import math
+import threading
+import tiktoken
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+CHAT_MODEL = "gpt-4o-mini"
+
+# tokens of an answer prompt: instructions, question, context fragments and chat history
+ANSWER_PROMPT_TOKEN_BUDGET = int(os.getenv("ANSWER_PROMPT_TOKEN_BUDGET", "6000"))
+# share of what is left after instructions and question that chat history may take,
+# the rest goes to context fragments
+HISTORY_TOKEN_SHARE = float(os.getenv("HISTORY_TOKEN_SHARE", "0.3"))
+# longest running summary of the turns older than the memory window, taken from the history share
+HISTORY_SUMMARY_TOKENS = int(os.getenv("HISTORY_SUMMARY_TOKENS", "400"))
+
+_encodings = {}
+_encodings_lock = threading.Lock()
+
+
+def get_encoding(model: str):
+    """Returns the tiktoken encoding of a model, or None if it can't be loaded.
+
+    tiktoken downloads its BPE files on first use, without network access token
+    counts fall back to an estimate of 4 characters per token.
+    """
+    with _encodings_lock:
+        if model not in _encodings:
+            try:
+                try:
+                    _encodings[model] = tiktoken.encoding_for_model(model)
+                except KeyError:
+                    _encodings[model] = tiktoken.get_encoding("cl100k_base")
+            except Exception as e:
+                print(f"Could not load tiktoken encoding for {model}, estimating tokens: {e}")
+                _encodings[model] = None
+        return _encodings[model]
+
+
+def count_tokens(text: str, model: str = "text-embedding-3-small") -> int:
+    encoding = get_encoding(model)
+    if encoding is None:
+        return math.ceil(len(text) / 4)
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def truncate_to_tokens(text: str, max_tokens: int, model: str = CHAT_MODEL) -> str:
+    """Cuts text to its first max_tokens tokens."""
+    encoding = get_encoding(model)
+    if encoding is None:
+        return text[:max_tokens * 4]
+    tokens = encoding.encode(text, disallowed_special=())
+    if len(tokens) <= max_tokens:
+        return text
+    return encoding.decode(tokens[:max_tokens])
+
+
+def pack_by_score(costs: list, scores: list, budget: int) -> list:
+    """Returns the positions of the items to keep so their total cost fits the budget.
+
+    Items are taken from the highest score down, an item that doesn't fit is
+    skipped and smaller lower-scored ones may still fill the rest. Positions
+    are returned in their original order.
+    """
+    kept = []
+    used = 0
+    for i in sorted(range(len(costs)), key=lambda i: scores[i], reverse=True):
+        if used + costs[i] <= budget:
+            kept.append(i)
+            used += costs[i]
+    return sorted(kept)
@@ -1,11 +1,17 @@
 import os
-from langchain_chroma import Chroma
-from langchain_openai import OpenAIEmbeddings, ChatOpenAI
+import numpy as np
+from langchain_openai import ChatOpenAI
 from langchain.prompts import PromptTemplate
 from langchain.schema import HumanMessage, AIMessage
 from langchain.memory import ConversationBufferWindowMemory
-from rank_bm25 import BM25Okapi
-import hashlib
+from nlp.lexical import get_lexical_index, get_combined_lexical_index
+from nlp.vectorstores import open_vectorstore_for_files
+from nlp.embeddings import embed_question, aembed_question
+from nlp.concurrency import run_blocking, llm_semaphore
+from nlp.fusion import fuse_scores, top_k_positions, SEMANTIC_WEIGHT
+from nlp.dedup import rank_repeats_last
+from nlp.tokens import count_tokens, truncate_to_tokens, pack_by_score
+from nlp.tokens import CHAT_MODEL, ANSWER_PROMPT_TOKEN_BUDGET, HISTORY_TOKEN_SHARE, HISTORY_SUMMARY_TOKENS
 from langdetect import detect
 import langdetect.lang_detect_exception
 import time
@@ -14,23 +20,37 @@ from dotenv import load_dotenv
 
 load_dotenv()
 
-def get_vectorstore_for_file(persist_dir: str):
-    if not os.path.exists(persist_dir):
-        raise FileNotFoundError(f"Vectorstore directory does not exist: {persist_dir}")
-    embeddings = OpenAIEmbeddings(model="text-embedding-3-small")
+# hybrid search pulls k * CANDIDATE_POOL_FACTOR candidates (at least MIN_CANDIDATE_POOL) from each retriever
+CANDIDATE_POOL_FACTOR = 5
+MIN_CANDIDATE_POOL = 20
+
+# longest section sent to the LLM for one summary, in tokens
+SUMMARY_INPUT_TOKEN_LIMIT = 15000
+
+def get_vectorstore_for_file(user_id: int, file_id: int):
+    """Returns the vectorstore of a document from the process-wide cache of open stores."""
+    return get_vectorstore_for_files(user_id, [file_id])
+
+def get_vectorstore_for_files(user_id: int, file_ids: list):
+    """Returns one vectorstore searching all the given documents of a user."""
     try:
-        vectorstore = Chroma(
-            persist_directory=persist_dir,
-            embedding_function=embeddings
-        )
-        return vectorstore
+        return open_vectorstore_for_files(user_id, file_ids)
     except Exception as e:
         print("Error loading vectorstore:", e)
         raise
 
-def get_relevant_documents(vectorstore, question: str, k: int = 4):
+def semantic_search(vectorstore, query_embedding: list, k: int = 4):
+    """Similarity search from a precomputed query vector, returns (Document, relevance score) pairs."""
+    results = vectorstore.similarity_search_by_vector_with_relevance_scores(query_embedding, k=k)
+    # chroma returns distances here, convert them like similarity_search_with_relevance_scores does
+    relevance_fn = vectorstore._select_relevance_score_fn()
+    return [(doc, relevance_fn(distance)) for doc, distance in results]
+
+def get_relevant_documents(vectorstore, question: str, k: int = 4, query_embedding: list = None):
     """Retrieves relevant documents from the vectorstore based on the question."""
-    docs = vectorstore.similarity_search_with_relevance_scores(question, k=k)
+    if query_embedding is None:
+        query_embedding = embed_question(question)
+    docs = semantic_search(vectorstore, query_embedding, k=k)
 
     # Filter docs based on relevance score
     relevant_docs = [doc for doc, score in docs if score > 0.7]
@@ -44,55 +64,203 @@ def get_relevant_documents(vectorstore, question: str, k: int = 4):
 
     return relevant_docs
 
-def hybrid_search(vectorstore, question: str, k: int = 4):
-    # similarity search
-    semantic_results = vectorstore.similarity_search_with_relevance_scores(question, k=k)
+def get_lexical_index_for(vectorstore, persist_dir: str = None):
+    """Returns the BM25 index matching a vectorstore, combined when it spans several documents."""
+    if persist_dir is not None:
+        return get_lexical_index(persist_dir, vectorstore)
 
-    all_docs = vectorstore.get()
-    chunks = all_docs["documents"] # vs.get returns a dict with "documents" key
-    tokenized_content = [doc.split() for doc in chunks]
-
-    # BM25 search
-    bm25 = BM25Okapi(tokenized_content)
-    tokenized_query = question.split()
-    lexical_scores = bm25.get_scores(tokenized_query)
-
-    # combine results
-    combined_results = []
+    if hasattr(vectorstore, "file_parts"):
+        parts = vectorstore.file_parts()
+    else:
+        parts = [(vectorstore._persist_directory, vectorstore)]
+
+    if len(parts) == 1:
+        return get_lexical_index(*parts[0])
+    return get_combined_lexical_index(parts)
+
+def hybrid_search(vectorstore, question: str, k: int = 4, persist_dir: str = None,
+                  fusion: str = "weighted", candidate_k: int = None, query_embedding: list = None,
+                  with_scores: bool = False, with_candidates: bool = False):
+    """Combines semantic and BM25 results. fusion is "weighted" (70/30 score mix) or "rrf".
+
+    Returns the top k documents, or (document, fused score) pairs with with_scores.
+    with_candidates also returns the (file_id, chunk_id, text) of every candidate
+    both retrievers pooled, as (results, candidates).
+    """
+    # both retrievers return a larger pool so the lexical side can add chunks the semantic top-k missed
+    candidate_k = candidate_k or max(k * CANDIDATE_POOL_FACTOR, MIN_CANDIDATE_POOL)
+
+    # similarity search, from a cached query vector when the caller already embedded the question
+    if query_embedding is None:
+        query_embedding = embed_question(question)
+    semantic_results = semantic_search(vectorstore, query_embedding, k=candidate_k)
+
+    # BM25 index is built at ingestion and kept in memory, older stores get one built on first use
+    lexical_index = get_lexical_index_for(vectorstore, persist_dir)
+    lexical_scores = lexical_index.get_scores(question)
+    lexical_positions = top_k_positions(lexical_scores, candidate_k)
+
+    # join semantic hits to the lexical index by chunk id
+    semantic_positions, semantic_scores, semantic_docs = [], [], {}
+    unmatched = []
     for doc, sem_score in semantic_results:
-        doc_id = doc.metadata.get("id", None)
-        found_idx = None
-        
-        # find the index of the document in chunks
-        for i, content in enumerate(chunks):
-            if content == doc.page_content:
-                found_idx = i
-                break
-        
-        # combine semantic and lexical scores
-        if found_idx is not None:
-            lex_score = lexical_scores[found_idx]
-            # normalize lexical score (0 to 1)
-            norm_lex_score = lex_score / max(lexical_scores) if max(lexical_scores) > 0 else 0
-
-            # combine scores (70% semantic, 30% lexical)
-            combined_score = 0.7 * sem_score + 0.3 * norm_lex_score
-            combined_results.append((doc, combined_score))
-        else:
-            # if document not found in chunks, use only semantic score
-            combined_results.append((doc, sem_score * 0.7))
-
-    combined_results.sort(key=lambda x: x[1], reverse=True)
-
-    return [doc for doc, _ in combined_results[:k]]
-
-def generate_answer_with_sources(question: str, docs: list, memory=None) -> dict:
-    """Generates an answer with sources from the context."""
-    print(f"Starting generate_answer_with_sources with {len(docs)} documents")
+        position = lexical_index.position_of(doc.metadata)
+        if position is None:
+            # chunk missing from the lexical index, use only the semantic score
+            unmatched.append((doc, SEMANTIC_WEIGHT * sem_score))
+            continue
+        semantic_positions.append(position)
+        semantic_scores.append(sem_score)
+        semantic_docs[position] = doc
+
+    positions, scores = fuse_scores(
+        semantic_positions, semantic_scores, lexical_scores, lexical_positions, mode=fusion
+    )
+
+    positions, scores = positions.tolist(), scores.tolist()
+    picks = rank_repeats_last([lexical_index.metadatas[position] for position in positions], k)
+    combined_results = [
+        (semantic_docs.get(positions[i]) or lexical_index.get_document(positions[i]), scores[i]) for i in picks
+    ]
+    if unmatched and fusion == "weighted":
+        combined_results.extend(unmatched)
+        combined_results.sort(key=lambda x: x[1], reverse=True)
+        picks = rank_repeats_last([doc.metadata for doc, _ in combined_results], k)
+        combined_results = [combined_results[i] for i in picks]
+
+    results = combined_results[:k] if with_scores else [doc for doc, _ in combined_results[:k]]
+    if not with_candidates:
+        return results
+    candidates = {}
+    for doc, _ in semantic_results:
+        candidates[(doc.metadata.get("file_id"), doc.metadata.get("chunk_id"))] = doc.page_content
+    for position in lexical_positions.tolist():
+        metadata = lexical_index.metadatas[position]
+        candidates.setdefault((metadata.get("file_id"), metadata.get("chunk_id")), lexical_index.texts[position])
+    return results, [(file_id, chunk_id, text) for (file_id, chunk_id), text in candidates.items()]
+
+def _top_results(lexical_index, positions, scores, k: int) -> list:
+    """(document, score) pairs of the k best fused positions, near duplicates of a pick ranked last."""
+    positions, scores = positions.tolist(), scores.tolist()
+    picks = rank_repeats_last([lexical_index.metadatas[position] for position in positions], k)
+    return [(lexical_index.get_document(positions[i]), scores[i]) for i in picks]
+
+def candidate_search(vectorstore, question: str, candidates, k: int = 4, fusion: str = "weighted",
+                     query_embedding: list = None, min_score: float = 0.0):
+    """hybrid_search over a small candidate set instead of the whole store.
+
+    candidates are ([(file_id, chunk_id)], vectors) of chunks an earlier search pooled.
+    Semantic scores are computed locally from the chunk vectors with the store's
+    relevance function, BM25 scores only for these chunks. Returns (document, fused score)
+    pairs, or None when fewer than k candidates are left or the best semantic score is
+    under min_score, the caller then searches the whole store.
+    """
+    chunk_keys, vectors = candidates
+    lexical_index = get_lexical_index_for(vectorstore)
+    positions, rows = [], []
+    for row, (file_id, chunk_id) in enumerate(chunk_keys):
+        position = lexical_index.position_of({"file_id": file_id, "chunk_id": chunk_id})
+        if position is not None:
+            positions.append(position)
+            rows.append(row)
+    if len(positions) < k:
+        return None
+
+    if query_embedding is None:
+        query_embedding = embed_question(question)
+    query = np.asarray(query_embedding, dtype=np.float32)
+    # squared L2 distances like the stores return, turned into the same relevance scores
+    distances = ((vectors[rows] - query) ** 2).sum(axis=1)
+    relevance_fn = vectorstore._select_relevance_score_fn()
+    semantic_scores = np.array([relevance_fn(float(d)) for d in distances], dtype=np.float32)
+    if semantic_scores.max() < min_score:
+        return None
+
+    positions = np.asarray(positions, dtype=np.int64)
+    semantic_order = np.argsort(-semantic_scores, kind="stable")
+    lexical_at = np.asarray(lexical_index.get_scores_at(question, positions), dtype=np.float32)
+    lexical_scores = np.zeros(len(lexical_index), dtype=np.float32)
+    lexical_scores[positions] = lexical_at
+
+    fused_positions, fused = fuse_scores(
+        positions[semantic_order], semantic_scores[semantic_order], lexical_scores,
+        positions[np.argsort(-lexical_at, kind="stable")], mode=fusion
+    )
+    return _top_results(lexical_index, fused_positions, fused, k)
+
+async def ahybrid_search(vectorstore, question: str, k: int = 4, fusion: str = "weighted",
+                         query_embedding: list = None, with_scores: bool = False, with_candidates: bool = False):
+    """Async hybrid search: embeds through the async client, runs chroma and BM25 on the NLP executor."""
+    if query_embedding is None:
+        query_embedding = await aembed_question(question)
+    return await run_blocking(
+        hybrid_search, vectorstore, question, k=k, fusion=fusion, query_embedding=query_embedding,
+        with_scores=with_scores, with_candidates=with_candidates
+    )
+
+def batch_hybrid_search(vectorstore, questions: list, query_embeddings: list, k: int = 4,
+                        fusion: str = "weighted", candidate_k: int = None) -> list:
+    """hybrid_search for many questions over one store, with scores.
+
+    The store's chunk vectors are read once and every question is scored against
+    them in one matrix product, instead of one vectorstore query per question.
+    Returns one list of (document, fused score) pairs per question.
+    """
+    candidate_k = candidate_k or max(k * CANDIDATE_POOL_FACTOR, MIN_CANDIDATE_POOL)
+    lexical_index = get_lexical_index_for(vectorstore)
+    stored = vectorstore.get(include=["embeddings", "metadatas"])
+
+    # rows of the stored chunks that the lexical index knows, results are built from it
+    positions, rows = [], []
+    for row, metadata in enumerate(stored["metadatas"]):
+        position = lexical_index.position_of(metadata or {})
+        if position is not None:
+            positions.append(position)
+            rows.append(row)
+    if not rows:
+        return [[] for _ in questions]
+    positions = np.asarray(positions, dtype=np.int64)
+    matrix = np.asarray(stored["embeddings"], dtype=np.float32)[rows]
+    queries = np.asarray(query_embeddings, dtype=np.float32)
+
+    # squared L2 distances of every question to every chunk, like the stores return
+    distances = np.maximum(
+        np.einsum("ij,ij->i", matrix, matrix)[None, :]
+        + np.einsum("ij,ij->i", queries, queries)[:, None]
+        - 2.0 * queries @ matrix.T,
+        0.0
+    )
+    relevance = np.asarray(vectorstore._select_relevance_score_fn()(distances), dtype=np.float32)
+
+    results = []
+    for question, semantic in zip(questions, relevance):
+        semantic_top = top_k_positions(semantic, candidate_k)
+        lexical_scores = lexical_index.get_scores(question)
+        fused_positions, fused = fuse_scores(
+            positions[semantic_top], semantic[semantic_top], lexical_scores,
+            top_k_positions(lexical_scores, candidate_k), mode=fusion
+        )
+        results.append(_top_results(lexical_index, fused_positions, fused, k))
+    return results
+
+def build_answer_prompt(question: str, docs: list, memory=None, scores: list = None,
+                        budget: int = ANSWER_PROMPT_TOKEN_BUDGET, history_summary: str = None):
+    """Builds the QA prompt from the context fragments and chat history. Returns (prompt, sources_info).
+
+    The prompt is packed into budget tokens. Chat history takes at most
+    HISTORY_TOKEN_SHARE of what the instructions and question leave: the running
+    summary of older turns first, then the remembered messages in conversation
+    order, the oldest dropped once the budget is used. Fragments fill the rest
+    from the highest score down. Without scores, docs are taken as ordered from
+    most to least relevant. sources_info only lists the fragments that made it into the prompt.
+    """
+    print(f"Building answer prompt with {len(docs)} documents")
 
     print(f"Memory received: {memory is not None}")
+    # read once, with a shared state backend every read is a query
+    messages = memory.chat_memory.messages if memory else []
     if memory:
-        print(f"Memory messages count: {len(memory.chat_memory.messages)}")
+        print(f"Memory messages count: {len(messages)}")
     
     # Print info despre fiecare document pentru debugging
     for i, doc in enumerate(docs):
@@ -141,9 +309,6 @@ def generate_answer_with_sources(question: str, docs: list, memory=None) -> dict
                 "content_preview": doc.page_content[:100] + "..."
             })
     
-    context = "\n\n".join(context_parts)
-    print(f"Created context with {len(context_parts)} parts")
-
     lang = detect_language(question)
     
     # Alege promptul potrivit bazat pe limba detectată
@@ -197,47 +362,97 @@ def generate_answer_with_sources(question: str, docs: list, memory=None) -> dict
 
     
     try:
-        chat_history = ""
+        prompt_template = PromptTemplate(
+            template=template,
+            input_variables=["context", "question", "chat_history"]
+        )
+        available = budget - count_tokens(
+            prompt_template.format(context="", question=question, chat_history=""), CHAT_MODEL
+        )
+
+        chat_history_sections = []
+        history_tokens = 0
+        history_budget = int(max(available, 0) * HISTORY_TOKEN_SHARE)
+        if history_summary:
+            section = "Summary of earlier conversation:\n" + truncate_to_tokens(
+                history_summary, min(HISTORY_SUMMARY_TOKENS, history_budget)
+            )
+            cost = count_tokens(section, CHAT_MODEL) + 2
+            if cost <= history_budget:
+                chat_history_sections.append(section)
+                history_tokens += cost
+
         if memory:
-            messages = memory.chat_memory.messages
             if messages:
                 chat_history_parts = []
                 for msg in reversed(messages):
                     if isinstance(msg, HumanMessage):
-                        chat_history_parts.append(f"Human: {msg.content}")
+                        part = f"Human: {msg.content}"
                     elif isinstance(msg, AIMessage):
-                        chat_history_parts.append(f"AI: {msg.content}")
-                        
-                chat_history = "Previous conversation:\n" + "\n".join(chat_history_parts)
-            else:
-                chat_history = ""
-        else:
-            chat_history = ""
+                        part = f"AI: {msg.content}"
+                    else:
+                        continue
+                    # messages are read newest first, older ones are dropped once the budget is used
+                    cost = count_tokens(part, CHAT_MODEL) + 1
+                    if history_tokens + cost > history_budget:
+                        break
+                    chat_history_parts.append(part)
+                    history_tokens += cost
+
+                if chat_history_parts:
+                    chat_history_sections.append(
+                        "Previous conversation:\n" + "\n".join(reversed(chat_history_parts))
+                    )
+                print(f"Chat history: {len(chat_history_parts)} of {len(messages)} messages, {history_tokens} tokens")
+        chat_history = "\n\n".join(chat_history_sections)
+
+        # lowest scored fragments are dropped first
+        costs = [count_tokens(part, CHAT_MODEL) + 1 for part in context_parts]
+        if scores is None:
+            scores = [-i for i in range(len(context_parts))]
+        kept = pack_by_score(costs, scores, available - history_tokens)
+        context = "\n\n".join(context_parts[i] for i in kept)
+        sources_info = [sources_info[i] for i in kept]
+        print(f"Created context with {len(kept)} of {len(context_parts)} parts, "
+              f"{sum(costs[i] for i in kept)} tokens")
 
-        prompt_template = PromptTemplate(
-            template=template,
-            input_variables=["context", "question", "chat_history"]
-        )
-        
-        llm = ChatOpenAI(model="gpt-4o-mini", temperature=0)
         final_prompt = prompt_template.format(
             context=context, 
             question=question,
             chat_history=chat_history    
         )
-        
+        return final_prompt, sources_info
+
+    except Exception as e:
+        print(f"Error building prompt: {e}")
+        raise
+
+def remember_exchange(memory, question: str, answer: str):
+    """Adds a question and its answer to memory in one write. Blocking with a shared state backend."""
+    memory.chat_memory.add_messages([HumanMessage(content=question), AIMessage(content=answer)])
+
+def generate_answer_with_sources(question: str, docs: list, memory=None, scores: list = None,
+                                 history_summary: str = None) -> dict:
+    """Generates an answer with sources from the context."""
+    print(f"Starting generate_answer_with_sources with {len(docs)} documents")
+    final_prompt, sources_info = build_answer_prompt(
+        question, docs, memory, scores, history_summary=history_summary
+    )
+
+    try:
+        llm = ChatOpenAI(model="gpt-4o-mini", temperature=0)
+
         print("Sending request to OpenAI...")
         response = llm.invoke([HumanMessage(content=final_prompt)])
         print("Received response from OpenAI")
         
         if memory:
-            memory.chat_memory.add_user_message(question)
-            memory.chat_memory.add_ai_message(response.content.strip())
+            remember_exchange(memory, question, response.content.strip())
 
         result = {
             "answer": response.content.strip(),
             "sources": sources_info,
-            "total_chunks_used": len(docs)
+            "total_chunks_used": len(sources_info)
         }
         
         print("Result generated successfully")
@@ -247,6 +462,76 @@ def generate_answer_with_sources(question: str, docs: list, memory=None) -> dict
         print(f"Error in LLM call: {e}")
         raise
 
+async def agenerate_answer_with_sources(question: str, docs: list, memory=None, scores: list = None,
+                                        history_summary: str = None) -> dict:
+    """Async variant of generate_answer_with_sources, the LLM call doesn't block the event loop."""
+    print(f"Starting agenerate_answer_with_sources with {len(docs)} documents")
+    # memory reads are queries with a shared state backend, the prompt is built on the executor
+    final_prompt, sources_info = await run_blocking(
+        build_answer_prompt, question, docs, memory, scores, history_summary=history_summary
+    )
+
+    try:
+        llm = ChatOpenAI(model="gpt-4o-mini", temperature=0)
+
+        print("Sending request to OpenAI...")
+        async with llm_semaphore:
+            response = await llm.ainvoke([HumanMessage(content=final_prompt)])
+        print("Received response from OpenAI")
+
+        if memory:
+            await run_blocking(remember_exchange, memory, question, response.content.strip())
+
+        return {
+            "answer": response.content.strip(),
+            "sources": sources_info,
+            "total_chunks_used": len(sources_info)
+        }
+
+    except Exception as e:
+        print(f"Error in LLM call: {e}")
+        raise
+
+async def astream_answer_with_sources(question: str, docs: list, memory=None, scores: list = None,
+                                      history_summary: str = None):
+    """Streaming variant of generate_answer_with_sources.
+
+    Yields ("sources", sources_info) first, then ("token", text) for each chunk
+    of the completion, then ("done", result) with the full answer and totals.
+    Memory is updated once the completion is finished.
+    """
+    final_prompt, sources_info = await run_blocking(
+        build_answer_prompt, question, docs, memory, scores, history_summary=history_summary
+    )
+    yield "sources", sources_info
+
+    llm = ChatOpenAI(model="gpt-4o-mini", temperature=0)
+    start_time = time.time()
+    first_token_time = None
+    answer_parts = []
+
+    print("Streaming request to OpenAI...")
+    async with llm_semaphore:
+        async for chunk in llm.astream([HumanMessage(content=final_prompt)]):
+            if not chunk.content:
+                continue
+            if first_token_time is None:
+                first_token_time = time.time()
+            answer_parts.append(chunk.content)
+            yield "token", chunk.content
+
+    answer = "".join(answer_parts).strip()
+    if memory:
+        await run_blocking(remember_exchange, memory, question, answer)
+
+    yield "done", {
+        "answer": answer,
+        "sources": sources_info,
+        "total_chunks_used": len(sources_info),
+        "time_to_first_token_seconds": round(first_token_time - start_time, 3) if first_token_time else None,
+        "generation_time_seconds": round(time.time() - start_time, 3)
+    }
+
 def detect_language(text, sample_size=1000):
     """Detects the language of the provided text using a sample size."""
     try:
@@ -263,16 +548,15 @@ def detect_language(text, sample_size=1000):
         print(f"Error detecting language, defaulting to English: {e}")
         return 'en'
 
-def generate_summary(text):
-    """Generates a short summary of a section provided."""
+# returned instead of a section summary when the LLM call fails, never cached
+SUMMARY_FAILED = "Summary generation failed due to an error."
 
-    estimated_tokens = len(text) / 4
-    if estimated_tokens > 15000:  # gpt-4o-mini's token limit
-        text = text[:60000]  # preventive truncation
+def build_summary_prompt(text, lang=None):
+    """Builds the prompt summarizing one section, in the language of the section."""
 
-    llm = ChatOpenAI(model="gpt-4o-mini", temperature=0) 
+    text = truncate_to_tokens(text, SUMMARY_INPUT_TOKEN_LIMIT)  # preventive truncation
 
-    lang = detect_language(text)
+    lang = lang or detect_language(text)
 
     if lang == 'en':
         prompt = f"""
@@ -302,19 +586,33 @@ def generate_summary(text):
         TEXT DE REZUMAT:
         {text}
         """
+    return prompt
+
+def generate_summary(text):
+    """Generates a short summary of a section provided."""
+    llm = ChatOpenAI(model="gpt-4o-mini", temperature=0) 
 
     try:
-        return llm.invoke(prompt).content.strip()   
+        return llm.invoke(build_summary_prompt(text)).content.strip()   
     except Exception as e:
         print(f"Error generating chunk summary: {e}")
-        return "Summary generation failed due to an error."
+        return SUMMARY_FAILED
 
-def generate_final_summary(sections, document_title=None):
-    """Combines multiple section summaries into a final summary."""
-    
-    print(f"Generating final summary for {len(sections)} sections")
+async def agenerate_summary(text, lang=None):
+    """Async variant of generate_summary."""
     llm = ChatOpenAI(model="gpt-4o-mini", temperature=0)
+    prompt = build_summary_prompt(text, lang)
+
+    try:
+        async with llm_semaphore:
+            response = await llm.ainvoke(prompt)
+        return response.content.strip()
+    except Exception as e:
+        print(f"Error generating chunk summary: {e}")
+        return SUMMARY_FAILED
 
+def build_final_summary_prompt(sections, document_title=None):
+    """Builds the prompt combining section summaries into the document summary."""
     combined_summaries = "\n\n".join([f"Section {i+1}: {summary}" for i, summary in enumerate(sections)])
 
     title_info = f"Document Title: {document_title}\n\n" if document_title else ""
@@ -351,56 +649,133 @@ def generate_final_summary(sections, document_title=None):
         Rezumate de secțiuni:
         {combined_summaries}
         """
+    return prompt
+
+def generate_final_summary(sections, document_title=None):
+    """Combines multiple section summaries into a final summary."""
+    
+    print(f"Generating final summary for {len(sections)} sections")
+    llm = ChatOpenAI(model="gpt-4o-mini", temperature=0)
 
     try:
-        return llm.invoke(prompt).content.strip()
+        return llm.invoke(build_final_summary_prompt(sections, document_title)).content.strip()
     except Exception as e:
         print(f"Error generating final summary: {e}")
         return "Final summary generation failed due to an error."
-    
-def generate_summary_for_chunks(chunks, max_length=5000, document_title=None):
-    """Generates summaries for each chunk of text. Groups chunks into sections and generates a final summary."""
-    
-    if len(chunks) <= 3:
-        combined_text = "\n\n".join(chunks)
-        return generate_summary(combined_text)
-    
-    unique_chunks = []
-    content_hashes = set()
-    
-    for chunk in chunks:
-        chunk_hash = hashlib.md5((chunk[:50] + chunk[-50:]).encode('utf-8')).hexdigest()  # hash based on first and last 50 characters
-        if chunk_hash not in content_hashes:
-            content_hashes.add(chunk_hash)
-            unique_chunks.append(chunk)
-    
-    print(f"Reduced {len(chunks)} chunks to {len(unique_chunks)} unique chunks")
-    
-    groups = []
-    current_group = []
-    current_length = 0
-
-    for chunk in unique_chunks:
-        if current_length + len(chunk) > max_length:
-            groups.append("\n\n".join(current_group))
-            current_group = [chunk]
-            current_length = len(chunk)
-        else:
-            current_group.append(chunk)
-            current_length += len(chunk)
-    
-    if current_group:
-        groups.append("\n\n".join(current_group))
 
-    print(f"Created {len(groups)} groups of chunks")
-    group_summaries = []
-    for i, group in enumerate(groups):
-        print(f"Group {i+1} length: {len(group)} characters")
-        group_summary = generate_summary(group)
-        print(f" ✓ Group {i+1} summary done.")
-        group_summaries.append(group_summary)
+async def agenerate_final_summary(sections, document_title=None):
+    """Async variant of generate_final_summary."""
+    print(f"Generating final summary for {len(sections)} sections")
+    llm = ChatOpenAI(model="gpt-4o-mini", temperature=0)
+    prompt = build_final_summary_prompt(sections, document_title)
+
+    try:
+        async with llm_semaphore:
+            response = await llm.ainvoke(prompt)
+        return response.content.strip()
+    except Exception as e:
+        print(f"Error generating final summary: {e}")
+        return "Final summary generation failed due to an error."
 
-    final_summary = generate_final_summary(group_summaries, document_title=document_title)
-    print("Final summary generated successfully.")
+async def agenerate_merged_summary(sections):
+    """Merges consecutive section summaries into one intermediate summary.
 
-    return final_summary
\ No newline at end of file
+    Used by the reduce tree of long documents, keeps the detail the final summary needs.
+    """
+    llm = ChatOpenAI(model="gpt-4o-mini", temperature=0)
+    combined_summaries = "\n\n".join(sections)
+    lang = detect_language(sections[0])
+
+    if lang == 'ro':
+        prompt = f"""
+        Combinați următoarele rezumate de secțiuni consecutive într-un singur rezumat.
+
+        Ghiduri:
+        1. Păstrați toate subiectele, conceptele și punctele cheie, în ordinea în care apar
+        2. Păstrați termenii tehnici importanți, numele și datele numerice
+        3. Eliminați repetițiile dintre secțiuni
+        4. Nu adăugați introduceri sau concluzii
+
+        Rezumate de secțiuni:
+        {combined_summaries}
+        """
+    else:
+        prompt = f"""
+        Combine the following summaries of consecutive sections into a single summary.
+
+        Guidelines:
+        1. Keep every main topic, concept and key point, in the order they appear
+        2. Preserve important technical terms, names, and numerical data
+        3. Remove repetition between sections
+        4. Do not add an introduction or a conclusion
+
+        Section Summaries:
+        {combined_summaries}
+        """
+
+    try:
+        async with llm_semaphore:
+            response = await llm.ainvoke(prompt)
+        return response.content.strip()
+    except Exception as e:
+        print(f"Error merging section summaries: {e}")
+        return SUMMARY_FAILED
+
+def build_history_summary_prompt(summary, turns):
+    """Builds the prompt folding older conversation turns into the running summary.
+
+    turns are (role, content) pairs, oldest first. Long messages are cut so one
+    update stays small whatever the length of the answers.
+    """
+    transcript = "\n".join(
+        f"{'Human' if role == 'user' else 'AI'}: {truncate_to_tokens(content, HISTORY_SUMMARY_TOKENS)}"
+        for role, content in turns
+    )
+    lang = detect_language(transcript)
+
+    if lang == 'ro':
+        prompt = f"""
+        Actualizați rezumatul unei conversații cu mesajele noi de mai jos.
+
+        Ghiduri:
+        1. Păstrați întrebările utilizatorului, răspunsurile primite și conceptele discutate, în ordine
+        2. Păstrați termenii tehnici importanți, numele și datele numerice
+        3. Nu repetați detalii deja prezente în rezumat
+        4. Rezumatul complet să fie sub {HISTORY_SUMMARY_TOKENS // 2} de cuvinte
+
+        Rezumatul de până acum:
+        {summary or "(gol)"}
+
+        Mesaje noi:
+        {transcript}
+        """
+    else:
+        prompt = f"""
+        Update the summary of a conversation with the new messages below.
+
+        Guidelines:
+        1. Keep the user's questions, the answers given and the concepts discussed, in order
+        2. Preserve important technical terms, names, and numerical data
+        3. Do not repeat details already in the summary
+        4. Keep the whole summary under {HISTORY_SUMMARY_TOKENS // 2} words
+
+        Summary so far:
+        {summary or "(empty)"}
+
+        New messages:
+        {transcript}
+        """
+    return prompt
+
+async def agenerate_history_summary(summary, turns):
+    """Returns the running summary of a conversation extended with turns, or None if the LLM call fails."""
+    llm = ChatOpenAI(model="gpt-4o-mini", temperature=0)
+    prompt = build_history_summary_prompt(summary, turns)
+
+    try:
+        async with llm_semaphore:
+            response = await llm.ainvoke(prompt)
+        return truncate_to_tokens(response.content.strip(), HISTORY_SUMMARY_TOKENS)
+    except Exception as e:
+        print(f"Error updating conversation summary: {e}")
+        return None
@@ -0,0 +1,382 @@
+import os
+import time
+import weakref
+import threading
+from collections import OrderedDict
+import chromadb
+from langchain_chroma import Chroma
+from chromadb.api.shared_system_client import SharedSystemClient
+from nlp.embeddings import get_embeddings
+from nlp.dense_index import DenseVectorStore
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+VECTORSTORE_ROOT = "./vectorstore"
+
+# "per_file" keeps one chroma store per document, "per_user" writes new documents into one
+# collection per user filtered by file_id metadata. Reads follow what is on disk, so both
+# layouts can coexist while migrate_vectorstores.py compacts old per-file stores.
+VECTORSTORE_MODE = os.getenv("VECTORSTORE_MODE", "per_file")
+USER_COLLECTION_DIRNAME = "collection"
+
+# backend of per-file stores: "chroma", or "numpy" for the memory-mapped exact index.
+# DENSE_INDEX_DTYPE=float16 halves the size of numpy stores but each query upcasts the matrix, so it is slower.
+VECTORSTORE_BACKEND = os.getenv("VECTORSTORE_BACKEND", "chroma")
+DENSE_INDEX_DTYPE = os.getenv("DENSE_INDEX_DTYPE", "float32")
+CHROMA_DB_FILENAME = "chroma.sqlite3"
+
+VECTORSTORE_CACHE_SIZE = int(os.getenv("VECTORSTORE_CACHE_SIZE", "32"))
+VECTORSTORE_CACHE_TTL = float(os.getenv("VECTORSTORE_CACHE_TTL", "900"))  # seconds of inactivity
+
+
+def get_persist_dir(user_id: int, file_id: int) -> str:
+    """Returns the directory holding the vectorstore and lexical index of a document."""
+    return os.path.abspath(os.path.join(VECTORSTORE_ROOT, str(user_id), str(file_id)))
+
+
+def get_user_collection_dir(user_id: int) -> str:
+    """Returns the directory of the consolidated collection holding every document of a user."""
+    return os.path.abspath(os.path.join(VECTORSTORE_ROOT, str(user_id), USER_COLLECTION_DIRNAME))
+
+
+def has_file_store(user_id: int, file_id: int) -> bool:
+    """True if the document has its own chroma or dense store (per_file layout)."""
+    persist_dir = get_persist_dir(user_id, file_id)
+    return os.path.exists(os.path.join(persist_dir, CHROMA_DB_FILENAME)) or DenseVectorStore.exists(persist_dir)
+
+
+def has_collection_chunks(user_id: int, file_id: int) -> bool:
+    """True if the document has chunks in its user's collection (per_user layout)."""
+    if not os.path.exists(get_user_collection_dir(user_id)):
+        return False
+    stored = open_user_collection(user_id)._collection.get(where={"file_id": file_id}, limit=1, include=[])
+    return bool(stored["ids"])
+
+
+def make_chunk_id(file_id: int, chunk_id: int) -> str:
+    """Id of a chunk in a user collection, unique across the user's documents."""
+    return f"{file_id}:{chunk_id}"
+
+
+# chroma versions whose SharedSystemClient keeps one System per persist directory in the class-level
+# _identifier_to_system dict. On other versions systems are left to chroma and never stopped here.
+CHROMA_SYSTEM_REGISTRY_VERSIONS = ("0.5.", "0.6.")
+
+
+def _stop_chroma_system(identifier: str):
+    """Stops the chroma System of a persist directory, closing its SQLite files.
+
+    chroma has no public way to close a persistent client, so this pops the
+    System from SharedSystemClient's private registry, on the versions known to have it.
+    """
+    registry = getattr(SharedSystemClient, "_identifier_to_system", None)
+    if not chromadb.__version__.startswith(CHROMA_SYSTEM_REGISTRY_VERSIONS) or not isinstance(registry, dict):
+        return
+    system = registry.pop(identifier, None)
+    if system is not None:
+        try:
+            system.stop()
+        except Exception as e:
+            print(f"Error stopping chroma system for {identifier}: {e}")
+
+
+# live chroma handles per System identifier. Every handle on a persist directory shares
+# its System, which is stopped when the last handle is garbage collected, so a request
+# still searching an evicted or invalidated handle keeps working.
+_chroma_handles = {}
+# reentrant, a handle may be collected while a thread holding the lock opens another one
+_chroma_handles_lock = threading.RLock()
+# finalizers of the open handles, close_vectorstore runs them early
+_chroma_releases = weakref.WeakKeyDictionary()
+
+
+def _release_chroma_handle(identifier: str):
+    with _chroma_handles_lock:
+        _chroma_handles[identifier] -= 1
+        if _chroma_handles[identifier] == 0:
+            del _chroma_handles[identifier]
+            _stop_chroma_system(identifier)
+
+
+def _open_chroma(persist_dir: str) -> Chroma:
+    """Opens a chroma store counted on its System. Only vectorstore cache openers call this."""
+    # opened under the lock, so a System being stopped is never handed to a new handle
+    with _chroma_handles_lock:
+        vectorstore = Chroma(persist_directory=persist_dir, embedding_function=get_embeddings())
+        identifier = vectorstore._client._identifier
+        _chroma_handles[identifier] = _chroma_handles.get(identifier, 0) + 1
+        _chroma_releases[vectorstore] = weakref.finalize(vectorstore, _release_chroma_handle, identifier)
+    return vectorstore
+
+
+def close_vectorstore(vectorstore):
+    """Releases a store now instead of when it is collected, so its files can be removed.
+
+    Only for stores no other request is using, the handle must not be searched afterwards.
+    """
+    if isinstance(vectorstore, DenseVectorStore):
+        vectorstore.close()
+        return
+    release = _chroma_releases.pop(vectorstore, None)
+    if release is not None:
+        release()  # runs at most once, the later collection does nothing
+
+
+class VectorstoreCache:
+    """Bounded LRU cache of open vectorstores keyed by (user_id, file_id), with idle TTL.
+
+    Evicted and invalidated handles are only dropped by the cache, their files are
+    closed once the requests still using them let them go: chroma Systems through
+    _open_chroma's handle count, dense stores when their memory map is collected.
+    """
+
+    def __init__(self, max_size: int = VECTORSTORE_CACHE_SIZE, ttl: float = VECTORSTORE_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()  # key -> (vectorstore, last_used)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def _expire(self, now: float) -> list:
+        """Drops entries idle for longer than the TTL and returns them. Called with the lock held."""
+        expired = [key for key, (_, last_used) in self._entries.items() if now - last_used > self.ttl]
+        dropped = [self._entries.pop(key) for key in expired]
+        self.evictions += len(dropped)
+        return dropped
+
+    def get(self, key, opener):
+        """Returns the cached vectorstore for key, opening it with opener() on a miss."""
+        now = time.monotonic()
+        with self._lock:
+            # released when this call returns, outside the lock
+            dropped = self._expire(now)
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries[key] = (entry[0], now)
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+        dropped.clear()
+
+        # open outside the lock, opening a store takes tens of milliseconds
+        vectorstore = opener()
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                # another request opened it meanwhile, keep a single handle
+                return entry[0]
+            self._entries[key] = (vectorstore, now)
+            while len(self._entries) > self.max_size:
+                dropped.append(self._entries.popitem(last=False)[1])
+                self.evictions += 1
+        dropped.clear()
+        return vectorstore
+
+    def invalidate(self, key):
+        """Removes an entry, used when the files on disk go away or change."""
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self.invalidations += 1
+        del entry
+
+    def clear(self):
+        with self._lock:
+            entries = list(self._entries.values())
+            self._entries.clear()
+        entries.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "ttl_seconds": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+                "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+            }
+
+
+vectorstore_cache = VectorstoreCache()
+
+
+class FileScopedVectorStore:
+    """View of a user collection restricted to some of the user's documents.
+
+    Exposes the subset of the Chroma interface used by the NLP pipeline, with
+    every query filtered by file_id metadata.
+    """
+
+    def __init__(self, collection, user_id: int, file_ids: list):
+        self.collection = collection
+        self.user_id = user_id
+        self.file_ids = list(file_ids)
+        if len(self.file_ids) == 1:
+            self.filter = {"file_id": self.file_ids[0]}
+        else:
+            self.filter = {"file_id": {"$in": self.file_ids}}
+
+    @property
+    def _persist_directory(self):
+        return get_persist_dir(self.user_id, self.file_ids[0])
+
+    def file_parts(self) -> list:
+        """(persist_dir, single-document store) pairs, used to find the lexical indexes."""
+        return [
+            (get_persist_dir(self.user_id, file_id), FileScopedVectorStore(self.collection, self.user_id, [file_id]))
+            for file_id in self.file_ids
+        ]
+
+    def similarity_search_by_vector_with_relevance_scores(self, embedding, k: int = 4, **kwargs):
+        kwargs.pop("filter", None)
+        return self.collection.similarity_search_by_vector_with_relevance_scores(
+            embedding, k=k, filter=self.filter, **kwargs
+        )
+
+    def similarity_search_with_relevance_scores(self, query: str, k: int = 4, **kwargs):
+        kwargs.pop("filter", None)
+        return self.collection.similarity_search_with_relevance_scores(query, k=k, filter=self.filter, **kwargs)
+
+    def _select_relevance_score_fn(self):
+        return self.collection._select_relevance_score_fn()
+
+    def get(self, include=None, **kwargs):
+        kwargs.pop("where", None)
+        return self.collection.get(where=self.filter, include=include, **kwargs)
+
+
+class MergedVectorStore:
+    """Searches several stores and merges the hits by distance.
+
+    Used for cross-document questions over documents that are not all in the
+    same user collection. Every store uses the same embedding model and
+    distance, so distances are comparable.
+    """
+
+    def __init__(self, stores: list):
+        self.stores = stores
+
+    @property
+    def _persist_directory(self):
+        return self.stores[0]._persist_directory
+
+    def file_parts(self) -> list:
+        parts = []
+        for store in self.stores:
+            if hasattr(store, "file_parts"):
+                parts.extend(store.file_parts())
+            else:
+                parts.append((store._persist_directory, store))
+        return parts
+
+    def similarity_search_by_vector_with_relevance_scores(self, embedding, k: int = 4, **kwargs):
+        results = []
+        for store in self.stores:
+            results.extend(store.similarity_search_by_vector_with_relevance_scores(embedding, k=k))
+        results.sort(key=lambda x: x[1])
+        return results[:k]
+
+    def similarity_search_with_relevance_scores(self, query: str, k: int = 4, **kwargs):
+        results = []
+        for store in self.stores:
+            results.extend(store.similarity_search_with_relevance_scores(query, k=k))
+        results.sort(key=lambda x: x[1], reverse=True)
+        return results[:k]
+
+    def _select_relevance_score_fn(self):
+        return self.stores[0]._select_relevance_score_fn()
+
+    def get(self, include=None, **kwargs):
+        """Concatenates the Chroma.get results of every store, for each key in include."""
+        merged = {key: [] for key in ["ids"] + list(include or ["documents", "metadatas"])}
+        for store in self.stores:
+            result = store.get(include=include, **kwargs)
+            for key in merged:
+                values = result.get(key)
+                if values is not None:
+                    # embeddings come back as numpy arrays
+                    merged[key].extend(list(values))
+        return merged
+
+
+def _open_file_store(user_id: int, file_id: int):
+    persist_dir = get_persist_dir(user_id, file_id)
+
+    def opener():
+        if DenseVectorStore.exists(persist_dir):
+            return DenseVectorStore(persist_dir, embedding_function=get_embeddings())
+        return _open_chroma(persist_dir)
+
+    return vectorstore_cache.get((user_id, file_id), opener)
+
+
+def open_file_collection(user_id: int, file_id: int):
+    """Returns the chroma store in a document's own directory, creating it. Used by ingestion,
+    so its writes go through the same cached client as searches."""
+    persist_dir = get_persist_dir(user_id, file_id)
+
+    def opener():
+        os.makedirs(persist_dir, exist_ok=True)
+        return _open_chroma(persist_dir)
+
+    return vectorstore_cache.get((user_id, file_id), opener)
+
+
+def open_user_collection(user_id: int, create: bool = False):
+    """Returns the consolidated collection of a user, creating its directory if asked to."""
+    collection_dir = get_user_collection_dir(user_id)
+
+    def opener():
+        if not create and not os.path.exists(collection_dir):
+            raise FileNotFoundError(f"User collection does not exist: {collection_dir}")
+        os.makedirs(collection_dir, exist_ok=True)
+        return _open_chroma(collection_dir)
+
+    return vectorstore_cache.get((user_id, None), opener)
+
+
+def open_vectorstore_for_files(user_id: int, file_ids: list):
+    """Returns one store searching all the given documents of a user, whatever their layout."""
+    file_stores = []
+    collection_files = []
+    for file_id in file_ids:
+        if has_file_store(user_id, file_id):
+            file_stores.append(_open_file_store(user_id, file_id))
+        elif os.path.exists(get_persist_dir(user_id, file_id)):
+            collection_files.append(file_id)
+        else:
+            raise FileNotFoundError(f"Vectorstore directory does not exist: {get_persist_dir(user_id, file_id)}")
+
+    stores = list(file_stores)
+    if collection_files:
+        stores.append(FileScopedVectorStore(open_user_collection(user_id), user_id, collection_files))
+
+    return stores[0] if len(stores) == 1 else MergedVectorStore(stores)
+
+
+def open_vectorstore(user_id: int, file_id: int):
+    """Returns an open vectorstore for a document, reusing a cached handle when possible."""
+    return open_vectorstore_for_files(user_id, [file_id])
+
+
+def invalidate_vectorstore(user_id: int, file_id: int):
+    """Forgets the cached handle of a document, must be called before its files change."""
+    vectorstore_cache.invalidate((user_id, file_id))
+
+
+def delete_from_user_collection(user_id: int, file_id: int):
+    """Removes the chunks of a document from its user's collection, if the user has one."""
+    if not os.path.exists(get_user_collection_dir(user_id)):
+        return
+    open_user_collection(user_id)._collection.delete(where={"file_id": file_id})
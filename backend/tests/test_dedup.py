@@ -0,0 +1,43 @@
+from langchain.schema import Document
+from nlp.dedup import mark_near_duplicates, minhash, rank_repeats_last, NearDuplicateIndex
+
+
+def _chunks(texts):
+    return [Document(page_content=text, metadata={"chunk_id": i}) for i, text in enumerate(texts)]
+
+
+def _dup_of(texts):
+    return [doc.metadata.get("dup_of") for doc in mark_near_duplicates(_chunks(texts), threshold=0.8)]
+
+
+def test_different_numeric_chunks_are_not_duplicates():
+    assert _dup_of(["12 34", "56 78"]) == [None, None]
+    assert _dup_of(["2019 2020 2021 2022", "1 2 3 4 5"]) == [None, None]
+
+
+def test_chunks_without_tokens_are_not_duplicates():
+    assert _dup_of(["--- | ---", "*** ***", "+ - +"]) == [None, None, None]
+
+
+def test_short_chunks_are_skipped():
+    assert minhash("Anexa 1") is None
+    index = NearDuplicateIndex(threshold=0.8)
+    assert index.find_or_add(0, "Anexa 1") is None
+    assert index.find_or_add(1, "Anexa 1") is None
+    assert index.signatures == {}
+
+
+def test_repeated_chunk_is_duplicate():
+    text = "Contractul se incheie pe o perioada de doi ani de la data semnarii de catre ambele parti."
+    assert _dup_of([text, "Alt paragraf despre plata facturilor lunare.", text]) == [None, None, 0]
+
+
+def test_repeats_are_ranked_after_their_group():
+    metadatas = [
+        {"file_id": 1, "chunk_id": 0},
+        {"file_id": 1, "chunk_id": 5, "dup_of": 0},
+        {"file_id": 2, "chunk_id": 0},
+        {"file_id": 1, "chunk_id": 3},
+    ]
+    assert rank_repeats_last(metadatas, 3) == [0, 2, 3]
+    assert rank_repeats_last(metadatas, 4) == [0, 2, 3, 1]
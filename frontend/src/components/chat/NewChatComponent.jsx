@@ -125,8 +125,9 @@ export default function NewChatComponent() {
         let documentId = null;
 
         try {
+            // the upload fills the bar up to 20%, server-side processing the rest
             const uploadProgressHandler = (progress) => {
-                setUploadProgress(Math.min(progress, 90));
+                setUploadProgress(Math.round(progress * 0.2));
             };
 
             const result = await uploadDocument(file, uploadProgressHandler);
@@ -134,7 +135,7 @@ export default function NewChatComponent() {
 
             let processingComplete = false;
             let attemps = 0;
-            const maxAttempts = 30;
+            const maxAttempts = 600;
 
             const checkStatus = async () => {
                 if (processingComplete || attemps >= maxAttempts) return;
@@ -152,15 +153,19 @@ export default function NewChatComponent() {
                         await startNewConversation(documentId, result.filename);
                         setUploadedFile(result);
                         // toast.success("File uploaded and processed successfully!");
+                    } else if (statusResult.status === "failed") {
+                        processingComplete = true;
+                        setLoading(false);
+                        toast.error(`Document processing failed: ${statusResult.error || "unknown error"}`);
                     } else {
-                        const processingProgress = 90 + Math.min(9, attemps);
+                        const processingProgress = 20 + Math.round((statusResult.percent || 0) * 0.79);
                         setUploadProgress(processingProgress);
                         setTimeout(checkStatus, 1000);
                     }
                 } catch (error) {
                     console.error("Error checking document status:", error);
                     toast.error("Error checking document processing status");
-                    setUploadProgress(90);
+                    setUploadProgress(20);
                 }
             };
 
@@ -5,9 +5,32 @@ import { toast } from 'react-toastify';
 
 const SUMMARY_API_URL = "http://localhost:8000/nlp/summary";
 
+const SUMMARY_POLL_INTERVAL_MS = 2000;
+
 // global state to track if a summary is being processed
 let isProcessingSummary = false;
 
+const sleep = (ms) => new Promise((resolve) => setTimeout(resolve, ms));
+
+// polls a background summary job until it completes or fails
+const waitForSummaryJob = async (jobId, token) => {
+    while (true) {
+        const response = await axios.get(`${SUMMARY_API_URL}/jobs/${jobId}`, {
+            headers: { Authorization: `Bearer ${token}` },
+        });
+        const job = response.data;
+
+        if (job.status === 'completed') {
+            return job.result;
+        }
+        if (job.status === 'failed') {
+            throw new Error(job.error || 'Summary generation failed');
+        }
+        console.log(`Summary job ${jobId}: ${job.stage || job.status} (${job.groups_done}/${job.groups_total} groups)`);
+        await sleep(SUMMARY_POLL_INTERVAL_MS);
+    }
+};
+
 export const generateDocumentSummary = async({ documentId }) => {
     const token = sessionStorage.getItem('access_token');
     if (!token) {
@@ -19,6 +42,10 @@ export const generateDocumentSummary = async({ documentId }) => {
             headers: { Authorization: `Bearer ${token}` },
         });
 
+        // a stored summary comes back directly, otherwise the server started a job
+        if (response.data.job_id) {
+            return await waitForSummaryJob(response.data.job_id, token);
+        }
         return response.data;
     } catch (error) {
         console.error("Error generating summary:", error);